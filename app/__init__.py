@@ -1,7 +1,18 @@
 from flask import Flask, current_app, url_for, session
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
 from app.extensions import db, migrate, login_manager, mail, csrf
 from app.models import init_database, User
+from app.utils.audit_writer import audit_writer
+from app.utils.login_throttle import login_throttle
+from app.utils.passwords import password_hasher
+from app.utils.identity import identity_cache
+from app.utils.session_store import init_session_store
+from app.utils.sms_outbox import sms_outbox
+from app.utils.email_outbox import email_outbox
+from app.utils.metrics import metrics
+from app.utils.compression import init_compression
+from app.utils.assets import init_static_assets, asset_url
 import logging
 import os
 from datetime import datetime
@@ -39,6 +50,7 @@ def register_context_processors(app):
             now=datetime.now,
             current_year=datetime.now().year,
             static_url=lambda filename: url_for('static', filename=filename, _external=True),
+            asset_url=asset_url,
             datetime=datetime,
             session=session
         )
@@ -53,7 +65,11 @@ def create_app(config_class=Config):
     
     if os.environ.get('FLASK_ENV') == 'production':
         app.config['STATIC_FOLDER'] = '/opt/render/project/src/app/static'
-        app.config['SESSION_FILE_DIR'] = '/opt/render/project/src/sessions'
+    
+    # آدرس واقعی کاربر از X-Forwarded-For؛ فقط به تعداد proxyهای تنظیم‌شده اعتماد می‌شود
+    if app.config.get('PROXY_FIX_X_FOR', 0) or app.config.get('PROXY_FIX_X_PROTO', 0):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config.get('PROXY_FIX_X_FOR', 0),
+                                x_proto=app.config.get('PROXY_FIX_X_PROTO', 0))
     
     # Initialize extensions
     db.init_app(app)
@@ -61,6 +77,14 @@ def create_app(config_class=Config):
     login_manager.init_app(app)
     mail.init_app(app)
     csrf.init_app(app)
+    audit_writer.init_app(app)
+    login_throttle.init_app(app)
+    password_hasher.init_app(app)
+    identity_cache.init_app(app)
+    init_session_store(app)
+    sms_outbox.init_app(app)
+    email_outbox.init_app(app)
+    metrics.init_app(app)
     
     # Configure login manager
     login_manager.login_view = 'auth.login'
@@ -80,6 +104,10 @@ def create_app(config_class=Config):
     # Setup security headers
     setup_security(app)
     
+    # Compress dynamic responses and serve fingerprinted static assets
+    init_compression(app)
+    init_static_assets(app)
+    
     # Register blueprints
     register_blueprints(app)
     
@@ -90,6 +118,12 @@ def create_app(config_class=Config):
     # Register shell context
     register_shell_context(app)
     
+    # Register CLI commands
+    register_cli_commands(app)
+    
+    # Register readiness probes
+    register_health_probes(app)
+    
     return app
 
 def setup_logging(app):
@@ -151,11 +185,41 @@ def register_shell_context(app):
             # 'School': School,
         }
 
+def register_cli_commands(app):
+    """Register maintenance commands for the Flask CLI"""
+    from app.utils.audit_archive import archive_command
+    from app.utils.analytics import refresh_command
+    from app.utils.sync import prune_command
+    from app.utils.assets import assets_cli
+    from app.utils.passwords import passwords_cli
+    from app.utils.session_store import sweep_command
+    from app.utils.sms_outbox import sms_cli
+    from app.utils.email_outbox import email_cli
+    from app.utils.phone import backfill_command
+    app.cli.add_command(archive_command)
+    app.cli.add_command(refresh_command)
+    app.cli.add_command(prune_command)
+    app.cli.add_command(assets_cli)
+    app.cli.add_command(passwords_cli)
+    app.cli.add_command(sweep_command)
+    app.cli.add_command(sms_cli)
+    app.cli.add_command(email_cli)
+    app.cli.add_command(backfill_command)
+
+def register_health_probes(app):
+    """Expose in-process backlogs on the readiness endpoint"""
+    from app.utils.health import register_queue_probe
+    register_queue_probe('audit_log', lambda: audit_writer.queue_depth, 'HEALTH_MAX_AUDIT_QUEUE')
+    # صف SMS بین همه workerها مشترک است؛ فقط گزارش می‌شود تا قطعی سرویس SMS همه instanceها را unready نکند
+    register_queue_probe('sms_outbox', lambda: sms_outbox.backlog)
+    register_queue_probe('email_outbox', lambda: email_outbox.backlog)
+    register_queue_probe('password_hash', lambda: password_hasher.pending)
+
 @login_manager.user_loader
 def load_user(user_id):
-    """Load user from database for Flask-Login"""
+    """Load the cached identity snapshot for Flask-Login"""
     try:
-        return User.query.get(int(user_id))
+        return identity_cache.get(int(user_id))
     except Exception as e:
         current_app.logger.error(f"Error loading user with ID {user_id}: {str(e)}")
         return None
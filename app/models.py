@@ -1,13 +1,22 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date
 import logging
 from app import db
 from config import Config
 from flask_login import UserMixin  
+from sqlalchemy.orm import validates
+from app.utils.passwords import password_hasher
+from app.utils.phone import normalize_phone
 
 logger = logging.getLogger(__name__)
 
+SCHOOL_TYPES_FA = {
+    'elementary': 'ابتدایی',
+    'middle': 'متوسطه اول',
+    'high': 'متوسطه دوم',
+    'combined': 'یکپارچه'
+}
+
 class School(db.Model):
     __tablename__ = 'schools'
     
@@ -41,13 +50,7 @@ class School(db.Model):
     
     @property
     def type_fa(self):
-        type_map = {
-            'elementary': 'ابتدایی',
-            'middle': 'متوسطه اول',
-            'high': 'متوسطه دوم',
-            'combined': 'یکپارچه'
-        }
-        return type_map.get(self.type, self.type)
+        return SCHOOL_TYPES_FA.get(self.type, self.type)
     
     def __repr__(self):
         return f'<School {self.name} ({self.type})>'
@@ -82,11 +85,18 @@ class User(db.Model, UserMixin):  # ✅ ارث‌بری از UserMixin
         """Hash and set password"""
         if len(password) < 8:
             raise ValueError("Password must be at least 8 characters long")
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
         """Check password against hash"""
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+    
+    def rehash_password_if_needed(self, password):
+        """Re-hash a verified password when the configured hash method or cost changed"""
+        if not password_hasher.needs_rehash(self.password_hash):
+            return False
+        self.password_hash = password_hasher.hash(password)
+        return True
     
     @property
     def is_super_admin(self):
@@ -117,6 +127,7 @@ class Student(db.Model):
     last_name = db.Column(db.String(50), nullable=False)
     grade = db.Column(db.String(20), nullable=False)
     parent_phone = db.Column(db.String(20))
+    parent_phone_normalized = db.Column(db.String(10))  # 9xxxxxxxxx - هنگام ذخیره از parent_phone ساخته می‌شود
     parent_email = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
@@ -134,8 +145,14 @@ class Student(db.Model):
         db.Index('ix_students_code', 'code'),
         db.Index('ix_students_school_id', 'school_id'),
         db.Index('ix_students_grade', 'grade'),
+        db.Index('ix_students_parent_phone_normalized', 'parent_phone_normalized'),
     )
     
+    @validates('parent_phone')
+    def _normalize_parent_phone(self, key, value):
+        self.parent_phone_normalized = normalize_phone(value)
+        return value
+    
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
@@ -244,6 +261,7 @@ class Attendance(db.Model):
     teacher_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
     
     __table_args__ = (
         db.UniqueConstraint('class_id', 'student_id', 'date', name='uix_attendance_class_student_date'),
@@ -284,6 +302,7 @@ class Grade(db.Model):
     date = db.Column(db.Date, default=date.today, nullable=False)
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
     
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
     subject_id = db.Column(db.Integer, db.ForeignKey('subjects.id'), nullable=False)
@@ -347,6 +366,275 @@ class SkillAssessment(db.Model):
     def __repr__(self):
         return f'<SkillAssessment {self.skill_id} for student {self.student_id}>'
 
+class SchoolCounter(db.Model):
+    """Maintained per-school totals so listing pages don't aggregate users and students"""
+    __tablename__ = 'school_counters'
+    
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='CASCADE'), primary_key=True)
+    admins = db.Column(db.Integer, default=0, nullable=False)
+    teachers = db.Column(db.Integer, default=0, nullable=False)
+    students = db.Column(db.Integer, default=0, nullable=False)
+    classes = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<SchoolCounter {self.school_id}>'
+
+class SchoolDailyStat(db.Model):
+    """Per-school daily aggregates of attendance, grades and discipline for analytics"""
+    __tablename__ = 'school_daily_stats'
+    
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    
+    present_count = db.Column(db.Integer, default=0, nullable=False)
+    absent_count = db.Column(db.Integer, default=0, nullable=False)
+    late_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    # مجموع score/max_score برای نمرات عددی
+    grade_count = db.Column(db.Integer, default=0, nullable=False)
+    normalized_score_sum = db.Column(db.Float, default=0.0, nullable=False)
+    
+    positive_points = db.Column(db.Integer, default=0, nullable=False)
+    negative_points = db.Column(db.Integer, default=0, nullable=False)
+    
+    refreshed_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    
+    __table_args__ = (
+        db.Index('ix_school_daily_stats_date', 'date'),
+    )
+    
+    def __repr__(self):
+        return f'<SchoolDailyStat {self.school_id} on {self.date}>'
+
+class AnalyticsDay(db.Model):
+    """Days already aggregated into school_daily_stats; edits to a day mark it dirty"""
+    __tablename__ = 'analytics_days'
+    
+    date = db.Column(db.Date, primary_key=True)
+    dirty = db.Column(db.Boolean, default=False, nullable=False)
+    refreshed_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    
+    def __repr__(self):
+        return f'<AnalyticsDay {self.date}{" dirty" if self.dirty else ""}>'
+
+class SyncChange(db.Model):
+    """Append-only change log for offline clients; the id is the sync cursor"""
+    __tablename__ = 'sync_changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(30), nullable=False)  # attendance, grades, discipline, skill_assessments
+    entity_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)  # upsert, delete
+    class_id = db.Column(db.Integer)
+    student_id = db.Column(db.Integer)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_sync_changes_class_id', 'class_id', 'id'),
+        db.Index('ix_sync_changes_student_id', 'student_id', 'id'),
+        db.Index('ix_sync_changes_changed_at', 'changed_at'),
+    )
+
+    def __repr__(self):
+        return f'<SyncChange {self.id} {self.operation} {self.entity}:{self.entity_id}>'
+
+class SyncOperation(db.Model):
+    """Client write operations already applied, so replayed offline batches are idempotent"""
+    __tablename__ = 'sync_operations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    op_id = db.Column(db.String(64), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    entity = db.Column(db.String(30), nullable=False)
+    entity_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'op_id', name='uix_sync_operations_user_op'),
+    )
+
+    def __repr__(self):
+        return f'<SyncOperation {self.op_id} by {self.user_id}>'
+
+class LoginThrottle(db.Model):
+    """Failed-login counters shared by all workers, one row per username or IP"""
+    __tablename__ = 'login_throttles'
+
+    key = db.Column(db.String(150), primary_key=True)  # user:<username> or ip:<address>
+    window = db.Column(db.Integer, nullable=False)  # index of the current fixed window
+    current_count = db.Column(db.Integer, default=0, nullable=False)
+    previous_count = db.Column(db.Integer, default=0, nullable=False)
+    locked_until = db.Column(db.Float, default=0, nullable=False)  # epoch seconds
+
+    __table_args__ = (
+        db.Index('ix_login_throttles_window', 'window'),
+    )
+
+    def __repr__(self):
+        return f'<LoginThrottle {self.key}>'
+
+class ServerSession(db.Model):
+    """Server-side Flask session; the cookie only carries the signed session ID and version"""
+    __tablename__ = 'server_sessions'
+
+    id = db.Column(db.String(64), primary_key=True)  # sha256 of the session ID, never the ID itself
+    data = db.Column(db.Text, nullable=False)
+    version = db.Column(db.Integer, default=1, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_server_sessions_expires_at', 'expires_at'),
+    )
+
+    def __repr__(self):
+        return f'<ServerSession {self.id[:8]} v{self.version}>'
+
+class RateLimitBucket(db.Model):
+    """Token bucket shared by all workers, e.g. the send budget of an SMS provider"""
+    __tablename__ = 'rate_limit_buckets'
+
+    name = db.Column(db.String(50), primary_key=True)  # e.g. sms:kavenegar
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # epoch seconds of the last refill
+
+    def __repr__(self):
+        return f'<RateLimitBucket {self.name} {self.tokens:.1f}>'
+
+class MetricSeries(db.Model):
+    """Running total of one metric series, summed from every worker's flushed deltas"""
+    __tablename__ = 'metric_series'
+
+    name = db.Column(db.String(100), primary_key=True)  # e.g. sms_messages_sent_total or <histogram>_bucket
+    labels = db.Column(db.String(255), primary_key=True, default='')  # rendered label set, e.g. category="welcome"
+    value = db.Column(db.Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<MetricSeries {self.name}{{{self.labels}}} {self.value}>'
+
+class SmsOutbox(db.Model):
+    """SMS waiting to be sent, written in the same transaction as the change that triggered it"""
+    __tablename__ = 'sms_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(150), unique=True, nullable=False)  # e.g. attendance:<student>:<date>:<status>
+    category = db.Column(db.String(30), nullable=False)
+    phone = db.Column(db.String(20), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='SET NULL'), nullable=True)
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='SET NULL'), nullable=True)  # برای گزارش‌گیری
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sending, sent, failed, coalesced, held
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    coalesce_key = db.Column(db.String(120), index=True)  # <phone>:<student>:<date> - پیام جدیدتر، پیام در انتظار قبلی را جایگزین می‌کند
+    digest_key = db.Column(db.String(60), index=True)  # <phone>:<date> - در حالت خلاصه روزانه ادغام می‌شوند
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_sms_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+        db.Index('ix_sms_outbox_created_at', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f'<SmsOutbox {self.id} {self.category} {self.status}>'
+
+class SmsCampaign(db.Model):
+    """Announcement SMS to the parents of a whole school or one grade"""
+    __tablename__ = 'sms_campaigns'
+
+    id = db.Column(db.Integer, primary_key=True)
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='CASCADE'), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    title = db.Column(db.String(100), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    grade = db.Column(db.String(20))  # None = همه پایه‌ها
+    status = db.Column(db.String(20), default='running', nullable=False)  # running, paused, completed, cancelled
+    total_recipients = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    completed_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_sms_campaigns_school_created', 'school_id', 'created_at'),
+        db.Index('ix_sms_campaigns_status', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<SmsCampaign {self.id} {self.title} {self.status}>'
+
+class SmsCampaignRecipient(db.Model):
+    """One parent phone of a campaign; siblings share a row"""
+    __tablename__ = 'sms_campaign_recipients'
+
+    id = db.Column(db.Integer, primary_key=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('sms_campaigns.id', ondelete='CASCADE'), nullable=False)
+    phone = db.Column(db.String(10), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='SET NULL'), nullable=True)  # اولین فرزند
+    student_count = db.Column(db.Integer, default=1, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, queued, sent, failed, cancelled
+    outbox_id = db.Column(db.Integer)  # بدون کلید خارجی؛ ردیف‌های قدیمی outbox حذف می‌شوند
+    last_error = db.Column(db.String(255))
+
+    __table_args__ = (
+        db.UniqueConstraint('campaign_id', 'phone', name='uq_sms_campaign_recipients_phone'),
+        db.Index('ix_sms_campaign_recipients_status', 'campaign_id', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<SmsCampaignRecipient {self.campaign_id}:{self.phone} {self.status}>'
+
+class EmailOutbox(db.Model):
+    """Email waiting to be sent, written in the same transaction as the change that triggered it"""
+    __tablename__ = 'email_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(150), unique=True, nullable=False)  # e.g. attendance:<student>:<date>:<status>
+    category = db.Column(db.String(30), nullable=False)
+    recipient = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete='SET NULL'), nullable=True)
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id', ondelete='SET NULL'), nullable=True)  # برای گزارش‌گیری
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sending, sent, failed, coalesced
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    coalesce_key = db.Column(db.String(150), index=True)  # <email>:<student>:<date>
+    digest_key = db.Column(db.String(120), index=True)  # <email>:<date>
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+        db.Index('ix_email_outbox_created_at', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f'<EmailOutbox {self.id} {self.category} {self.status}>'
+
+class AuditUserAgent(db.Model):
+    """Interned user agent strings referenced by audit log rows"""
+    __tablename__ = 'audit_user_agents'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    value_hash = db.Column(db.String(64), unique=True, nullable=False)  # sha256 of value
+    value = db.Column(db.Text, nullable=False)
+    
+    def __repr__(self):
+        return f'<AuditUserAgent {self.id}>'
+
+class AuditIpAddress(db.Model):
+    """Interned client IP addresses referenced by audit log rows"""
+    __tablename__ = 'audit_ip_addresses'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(45), unique=True, nullable=False)
+    
+    def __repr__(self):
+        return f'<AuditIpAddress {self.value}>'
+
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
     
@@ -357,18 +645,44 @@ class AuditLog(db.Model):
     timestamp = db.Column(db.DateTime, default=db.func.current_timestamp())
     school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=True)
     target_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
-    ip_address = db.Column(db.String(45))
-    user_agent = db.Column(db.Text)
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('audit_user_agents.id'), nullable=True)
+    ip_address_id = db.Column(db.Integer, db.ForeignKey('audit_ip_addresses.id'), nullable=True)
+    
+    # ستون‌های متنی قدیمی؛ فقط برای ردیف‌های قبل از interning پر هستند
+    legacy_ip_address = db.Column('ip_address', db.String(45))
+    legacy_user_agent = db.Column('user_agent', db.Text)
     
     user = db.relationship('User', foreign_keys=[user_id], backref='audit_logs')
     target_user = db.relationship('User', foreign_keys=[target_user_id], backref='targeted_audit_logs')
     school = db.relationship('School', backref='audit_logs')
+    user_agent_ref = db.relationship('AuditUserAgent', lazy='joined')
+    ip_address_ref = db.relationship('AuditIpAddress', lazy='joined')
     
+    # Composite indexes back keyset pagination on (timestamp, id) for each viewer filter
     __table_args__ = (
-        db.Index('ix_audit_logs_timestamp', 'timestamp'),
-        db.Index('ix_audit_logs_action', 'action'),
+        db.Index('ix_audit_logs_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_audit_logs_action_timestamp', 'action', 'timestamp'),
+        db.Index('ix_audit_logs_school_timestamp', 'school_id', 'timestamp'),
+        db.Index('ix_audit_logs_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_audit_logs_target_user_timestamp', 'target_user_id', 'timestamp'),
     )
     
+    @property
+    def user_agent(self):
+        return self.user_agent_ref.value if self.user_agent_ref else self.legacy_user_agent
+    
+    @user_agent.setter
+    def user_agent(self, value):
+        self.legacy_user_agent = value
+    
+    @property
+    def ip_address(self):
+        return self.ip_address_ref.value if self.ip_address_ref else self.legacy_ip_address
+    
+    @ip_address.setter
+    def ip_address(self, value):
+        self.legacy_ip_address = value
+    
     def __repr__(self):
         return f'<AuditLog {self.action} by {self.user_id}>'
 
@@ -380,12 +694,26 @@ def init_database(app):
             db.create_all()
             app.logger.info("Database tables created successfully")
             
+            # Columns added to existing tables after they were created
+            from app.utils.conditional import ensure_updated_at_columns
+            ensure_updated_at_columns()
+            from app.utils.audit_writer import ensure_audit_log_columns
+            ensure_audit_log_columns()
+            
             # Create Super Admin if not exists
             create_super_admin(app)
             
             # Create default skills
             create_default_skills(app)
             
+            # Backfill counters for schools created before they were maintained
+            from app.utils.school_counters import create_missing_school_counters
+            create_missing_school_counters()
+            
+            # Normalized parent phones for databases created before the column existed
+            from app.utils.phone import migrate_parent_phones
+            migrate_parent_phones()
+            
         except Exception as e:
             app.logger.error(f"Database initialization failed: {str(e)}")
             raise
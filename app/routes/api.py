@@ -1,35 +1,110 @@
-from flask import Blueprint, jsonify, request
-from flask_login import login_required
+from flask import Blueprint, jsonify, request, current_app
+from flask_login import login_required, current_user
 from app.decorators import role_required
 from datetime import datetime
-from app.models import db, Student, Grade, Attendance, Class
+from app.models import db, Student, Grade, Attendance, Class, Subject, class_students
+from app.utils.conditional import conditional_response, latest_timestamp
+from app.utils.health import get_liveness, get_readiness
+from app.utils.metrics import metrics
+from app.utils.sync import get_teacher_class_ids, is_cursor_expired, pull_changes, build_snapshot, apply_operations
+import hmac
 import logging
 
 logger = logging.getLogger(__name__)
 bp = Blueprint('api', __name__, url_prefix='/api')
 
+MAX_ATTENDANCE_RANGE_DAYS = 31
+MAX_BATCH_STUDENTS = 100
+MAX_GRADES_PER_STUDENT = 50
+
 @bp.route('/health')
 def health_check():
-    """Health check endpoint"""
+    """Liveness: the worker is up and serving requests, no database I/O"""
+    return jsonify(get_liveness()), 200
+
+@bp.route('/health/ready')
+def readiness_check():
+    """Readiness: database, connection pool and backlogs; 503 tells the load balancer to back off"""
+    ready, report = get_readiness()
+    response = jsonify(report)
+    response.headers['Cache-Control'] = 'no-store'
+    return response, 200 if ready else 503
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics summed over all workers; METRICS_TOKEN bearer or a super admin session"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return jsonify({'error': 'Unauthorized'}), 401
+    elif not (current_user.is_authenticated and current_user.is_super_admin):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    response = current_app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def student_grades_version(student_id):
+    """Cheap version of a student's grades: row count, newest id and newest change"""
+    student_updated_at = db.session.query(Student.updated_at).filter(Student.id == student_id).first()
+    if student_updated_at is None:
+        return None
+
+    count, max_id, updated_at = db.session.query(
+        db.func.count(Grade.id),
+        db.func.max(Grade.id),
+        db.func.max(Grade.updated_at)
+    ).filter(Grade.student_id == student_id).one()
+
+    return (count, max_id, updated_at, student_updated_at[0]), latest_timestamp(updated_at, student_updated_at[0])
+
+def parse_attendance_range():
+    """Read ?date= or ?start_date=&end_date= (YYYY-MM-DD); defaults to today"""
+    single = request.args.get('date')
+    start = request.args.get('start_date')
+    end = request.args.get('end_date')
+
+    if single:
+        start_date = end_date = datetime.strptime(single, '%Y-%m-%d').date()
+    elif start or end:
+        start_date = datetime.strptime(start or end, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end or start, '%Y-%m-%d').date()
+    else:
+        start_date = end_date = datetime.now().date()
+
+    if end_date < start_date:
+        raise ValueError('end_date must not be before start_date')
+    if (end_date - start_date).days >= MAX_ATTENDANCE_RANGE_DAYS:
+        raise ValueError(f'Date range cannot exceed {MAX_ATTENDANCE_RANGE_DAYS} days')
+    return start_date, end_date
+
+def class_attendance_version(class_id):
+    """Cheap version of a class's attendance over the requested dates"""
+    class_updated_at = db.session.query(Class.updated_at).filter(Class.id == class_id).first()
+    if class_updated_at is None:
+        return None
+
     try:
-        # Check database connection
-        db.session.execute('SELECT 1')
-        db_status = 'connected'
-    except Exception as e:
-        db_status = f'disconnected: {str(e)}'
-        logger.error(f"Database health check failed: {str(e)}")
+        start_date, end_date = parse_attendance_range()
+    except ValueError:
+        return None
 
-    return jsonify({
-        'status': 'healthy',
-        'service': 'school-management-system',
-        'database': db_status,
-        'timestamp': datetime.now().isoformat(),
-        'environment': app.config.get('FLASK_ENV', 'development')
-    }), 200
+    count, max_id, updated_at = db.session.query(
+        db.func.count(Attendance.id),
+        db.func.max(Attendance.id),
+        db.func.max(Attendance.updated_at)
+    ).filter(Attendance.class_id == class_id, Attendance.date.between(start_date, end_date)).one()
+
+    student_count = db.session.query(db.func.count(class_students.c.student_id))\
+        .filter(class_students.c.class_id == class_id).scalar()
+
+    parts = (start_date, end_date, count, max_id, updated_at, student_count, class_updated_at[0])
+    return parts, latest_timestamp(updated_at, class_updated_at[0])
 
 @bp.route('/students/<int:student_id>/grades')
 @login_required
 @role_required('teacher', 'school_admin', 'super_admin')
+@conditional_response(student_grades_version)
 def get_student_grades(student_id):
     """Get grades for a specific student"""
     try:
@@ -73,47 +148,202 @@ def get_student_grades(student_id):
             'error': str(e)
         }), 500
 
+@bp.route('/grades/batch')
+@login_required
+@role_required('teacher', 'school_admin', 'super_admin')
+def get_grades_batch():
+    """Most recent grades for many students (?student_ids=1,2,3 or ?class_id=) in one query"""
+    try:
+        limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_GRADES_PER_STUDENT)
+        class_id = request.args.get('class_id', type=int)
+        raw_ids = request.args.get('student_ids', '').strip()
+
+        students_query = db.session.query(
+            Student.id,
+            Student.first_name,
+            Student.last_name,
+            Student.code,
+            Student.grade
+        )
+
+        if class_id:
+            students_query = students_query.join(class_students, class_students.c.student_id == Student.id)\
+                .filter(class_students.c.class_id == class_id)
+        elif raw_ids:
+            try:
+                student_ids = {int(value) for value in raw_ids.split(',') if value.strip()}
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'error': 'student_ids must be a comma-separated list of integers'
+                }), 400
+            students_query = students_query.filter(Student.id.in_(student_ids))
+        else:
+            return jsonify({
+                'success': False,
+                'error': 'student_ids or class_id is required'
+            }), 400
+
+        if not current_user.is_super_admin:
+            students_query = students_query.filter(Student.school_id == current_user.school_id)
+
+        students = students_query.order_by(Student.last_name, Student.first_name)\
+            .limit(MAX_BATCH_STUDENTS + 1)\
+            .all()
+
+        if len(students) > MAX_BATCH_STUDENTS:
+            return jsonify({
+                'success': False,
+                'error': f'At most {MAX_BATCH_STUDENTS} students can be requested at once'
+            }), 400
+
+        grades_by_student = {student.id: [] for student in students}
+
+        if students:
+            # شماره‌گذاری نمرات هر دانش‌آموز از جدیدترین؛ فقط N ردیف اول هر دانش‌آموز برگردانده می‌شود
+            ranked = db.session.query(
+                Grade.id.label('id'),
+                Grade.student_id.label('student_id'),
+                db.func.row_number().over(
+                    partition_by=Grade.student_id,
+                    order_by=(Grade.date.desc(), Grade.id.desc())
+                ).label('row_number')
+            ).filter(Grade.student_id.in_(list(grades_by_student))).subquery()
+
+            grades = db.session.query(
+                Grade.id,
+                Grade.student_id,
+                Grade.date,
+                Subject.name,
+                Class.name,
+                Grade.score,
+                Grade.max_score,
+                Grade.level,
+                Grade.description
+            ).join(ranked, ranked.c.id == Grade.id)\
+             .join(Subject, Grade.subject_id == Subject.id)\
+             .join(Class, Grade.class_id == Class.id)\
+             .filter(ranked.c.row_number <= limit)\
+             .order_by(Grade.student_id, ranked.c.row_number)\
+             .all()
+
+            for grade_id, student_id, grade_date, subject_name, class_name, score, max_score, level, description in grades:
+                grades_by_student[student_id].append({
+                    'id': grade_id,
+                    'date': grade_date.strftime('%Y-%m-%d'),
+                    'subject': subject_name,
+                    'class': class_name,
+                    'score': score,
+                    'max_score': max_score,
+                    'level': level,
+                    'description': description
+                })
+
+        students_data = [{
+            'id': student.id,
+            'name': f"{student.first_name} {student.last_name}",
+            'code': student.code,
+            'grade': student.grade,
+            'grades': grades_by_student[student.id],
+            'total_grades': len(grades_by_student[student.id])
+        } for student in students]
+
+        response = {
+            'success': True,
+            'limit': limit,
+            'students': students_data,
+            'total_students': len(students_data)
+        }
+        if not class_id:
+            response['missing_ids'] = sorted(student_ids - set(grades_by_student))
+
+        return jsonify(response), 200
+
+    except Exception as e:
+        logger.error(f"Error getting batch grades: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @bp.route('/classes/<int:class_id>/attendance')
 @login_required
 @role_required('teacher', 'school_admin', 'super_admin')
+@conditional_response(class_attendance_version)
 def get_class_attendance(class_id):
-    """Get attendance for a specific class"""
+    """Get attendance for a specific class on a date or date range"""
     try:
-        class_obj = Class.query.get_or_404(class_id)
-        
-        # Get today's attendance
-        today = datetime.now().date()
-        attendance_records = Attendance.query.filter_by(
-            class_id=class_id,
-            date=today
-        ).join(Attendance.student).all()
-        
+        try:
+            start_date, end_date = parse_attendance_range()
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+
+        class_row = db.session.query(Class.id, Class.name, Class.grade).filter(Class.id == class_id).first()
+        if class_row is None:
+            return jsonify({
+                'success': False,
+                'error': 'Class not found'
+            }), 404
+
+        records = db.session.query(
+            Attendance.date,
+            Attendance.student_id,
+            Student.first_name,
+            Student.last_name,
+            Student.code,
+            Attendance.status,
+            Attendance.created_at
+        ).join(Student, Attendance.student_id == Student.id)\
+         .filter(Attendance.class_id == class_id,
+                 Attendance.date.between(start_date, end_date))\
+         .order_by(Attendance.date, Student.last_name, Student.first_name)\
+         .all()
+
         attendance_data = [{
-            'student_id': record.student_id,
-            'student_name': record.student.full_name,
-            'student_code': record.student.code,
-            'status': record.status,
-            'status_text': get_status_text(record.status),
-            'timestamp': record.created_at.isoformat() if record.created_at else None
-        } for record in attendance_records]
-        
-        stats = {
-            'total_students': len(class_obj.students),
-            'present': sum(1 for r in attendance_records if r.status == 'present'),
-            'absent': sum(1 for r in attendance_records if r.status == 'absent'),
-            'late': sum(1 for r in attendance_records if r.status == 'late')
-        }
-        
+            'date': record_date.isoformat(),
+            'student_id': student_id,
+            'student_name': f"{first_name} {last_name}",
+            'student_code': code,
+            'status': status,
+            'status_text': get_status_text(status),
+            'timestamp': created_at.isoformat() if created_at else None
+        } for record_date, student_id, first_name, last_name, code, status, created_at in records]
+
+        status_counts = db.session.query(
+            Attendance.date,
+            Attendance.status,
+            db.func.count(Attendance.id)
+        ).filter(Attendance.class_id == class_id,
+                 Attendance.date.between(start_date, end_date))\
+         .group_by(Attendance.date, Attendance.status)\
+         .all()
+
+        total_students = db.session.query(db.func.count(class_students.c.student_id))\
+            .filter(class_students.c.class_id == class_id).scalar()
+
+        stats = {'total_students': total_students, 'present': 0, 'absent': 0, 'late': 0}
+        daily_stats = {}
+        for record_date, status, count in status_counts:
+            day = daily_stats.setdefault(record_date.isoformat(), {'present': 0, 'absent': 0, 'late': 0})
+            day[status] = day.get(status, 0) + count
+            stats[status] = stats.get(status, 0) + count
+
         return jsonify({
             'success': True,
             'class': {
-                'id': class_obj.id,
-                'name': class_obj.name,
-                'grade': class_obj.grade
+                'id': class_row.id,
+                'name': class_row.name,
+                'grade': class_row.grade
             },
-            'date': today.isoformat(),
+            'date': start_date.isoformat() if start_date == end_date else None,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
             'attendance': attendance_data,
             'stats': stats,
+            'daily_stats': daily_stats,
             'total_records': len(attendance_data)
         }), 200
         
@@ -124,6 +354,70 @@ def get_class_attendance(class_id):
             'error': str(e)
         }), 500
 
+@bp.route('/sync')
+@login_required
+@role_required('teacher')
+def sync_pull():
+    """Changes to the teacher's classes since ?cursor=, or a recent snapshot without a cursor"""
+    try:
+        cursor = request.args.get('cursor', type=int)
+        limit = min(max(request.args.get('limit', current_app.config['SYNC_PULL_LIMIT'], type=int), 1),
+                    current_app.config['SYNC_PULL_LIMIT'])
+        class_ids = get_teacher_class_ids(current_user)
+
+        if cursor and is_cursor_expired(cursor):
+            return jsonify({
+                'success': False,
+                'reset_required': True,
+                'error': 'Cursor is older than the retained sync history; request a snapshot'
+            }), 410
+
+        result = pull_changes(class_ids, cursor, limit) if cursor else build_snapshot(class_ids)
+        return jsonify({'success': True, **result}), 200
+
+    except Exception as e:
+        logger.error(f"Error pulling sync changes: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@bp.route('/sync', methods=['POST'])
+@login_required
+@role_required('teacher')
+def sync_push():
+    """Apply a batch of offline writes: {"operations": [{"op_id", "entity", "action", "data"}]}"""
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get('operations')
+
+    if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+        return jsonify({
+            'success': False,
+            'error': 'operations must be a list of objects'
+        }), 400
+
+    if len(operations) > current_app.config['SYNC_MAX_PUSH_OPERATIONS']:
+        return jsonify({
+            'success': False,
+            'error': f"At most {current_app.config['SYNC_MAX_PUSH_OPERATIONS']} operations can be pushed at once"
+        }), 400
+
+    try:
+        results = apply_operations(current_user, operations)
+        return jsonify({
+            'success': True,
+            'results': results,
+            'applied': sum(1 for result in results if result['status'] == 'applied')
+        }), 200
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error applying sync operations: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @bp.route('/students/search')
 @login_required
 @role_required('teacher', 'school_admin', 'super_admin')
@@ -184,7 +478,7 @@ def search_students():
 @bp.route('/error')
 def trigger_error():
     """Endpoint for testing error handling (remove in production)"""
-    if app.config.get('FLASK_ENV') == 'production':
+    if current_app.config.get('FLASK_ENV') == 'production':
         return jsonify({
             'success': False,
             'error': 'This endpoint is disabled in production'
@@ -8,10 +8,15 @@ from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationE
 from werkzeug.security import generate_password_hash, check_password_hash  
 from app.models import db, User
 from app.decorators import is_account_locked, record_failed_attempt, clear_failed_attempts
+from app.utils.passwords import PasswordHasherBusy
 from app.utils.sms_service import sms_service
+from app.utils.email_service import email_service
 from app.utils.audit_log import log_audit_action
 from flask_wtf import FlaskForm
 from urllib.parse import urlparse  
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+import hashlib
+import hmac
 import logging
 import time
 from datetime import datetime, timedelta
@@ -49,6 +54,30 @@ class PasswordResetForm(FlaskForm):
     ])
     submit = SubmitField('تغییر رمز عبور')
 
+def _reset_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='password-reset')
+
+def _password_fingerprint(user):
+    # با تغییر رمز عبور، لینک‌های قبلی باطل می‌شوند
+    return hashlib.sha256(user.password_hash.encode()).hexdigest()[:16]
+
+def generate_reset_token(user):
+    """Signed, expiring token that works until the user's password changes"""
+    return _reset_serializer().dumps({'user': user.id, 'password': _password_fingerprint(user)})
+
+def user_for_reset_token(token):
+    """Active user a reset token was issued for, or None if it is invalid, expired or used"""
+    try:
+        data = _reset_serializer().loads(token, max_age=current_app.config.get('PASSWORD_RESET_TOKEN_SECONDS', 3600))
+    except BadSignature:
+        return None
+    user = db.session.get(User, data.get('user')) if isinstance(data, dict) else None
+    if not user or not user.is_active:
+        return None
+    if not hmac.compare_digest(_password_fingerprint(user), str(data.get('password', ''))):
+        return None
+    return user
+
 @bp.route('/')
 def index():
     """Redirect to appropriate dashboard based on user role"""
@@ -73,9 +102,29 @@ def login():
         username = form.username.data.strip()
         password = form.password.data
         
+        # حساب یا IP قفل شده قبل از هر کوئری و هش رمز عبور رد می‌شود
+        if is_account_locked(username):
+            flash('به دلیل تلاش‌های ناموفق متعدد، ورود موقتاً مسدود شده است. لطفاً چند دقیقه بعد تلاش کنید.', 'danger')
+            current_app.logger.warning(f"Locked login attempt for username: {username}")
+            return render_template('auth/login.html', form=form), 429
+        
         user = User.query.filter_by(username=username).first()
         
-        if user and user.check_password(password) and user.is_active:
+        try:
+            password_ok = user is not None and user.check_password(password)
+        except PasswordHasherBusy:
+            current_app.logger.warning(f"Password hash queue full, rejecting login for {username}")
+            flash('سرور در حال حاضر شلوغ است. لطفاً چند لحظه دیگر دوباره تلاش کنید.', 'warning')
+            return render_template('auth/login.html', form=form), 503
+        
+        if password_ok and user.is_active:
+            clear_failed_attempts(username)
+            
+            # هش‌های ساخته‌شده با تنظیمات قدیمی هنگام ورود موفق به‌روزرسانی می‌شوند
+            if user.rehash_password_if_needed(password):
+                db.session.commit()
+                current_app.logger.info(f"Password hash upgraded for user {username}")
+            
             login_user(user, remember=form.remember.data)
             session['user_id'] = user.id  # ذخیره ID واقعی
             
@@ -100,6 +149,7 @@ def login():
             # حذف مشکل حلقه ریدایرکت
             return redirect(next_page)
         
+        record_failed_attempt(username)
         flash('نام کاربری یا رمز عبور اشتباه است', 'danger')
         #  اصلاح: استفاده از current_app برای لاگ خطاها
         current_app.logger.warning(f"Failed login attempt for username: {username}")
@@ -134,6 +184,11 @@ def password_reset_request():
     if current_user.is_authenticated:
         return redirect(url_for('auth.index'))
     
+    if not current_app.config.get('EMAIL_ACTIVE', False):
+        # بدون ارسال واقعی ایمیل لینکی صادر نمی‌شود؛ لینک فقط در لاگ ثبت می‌شد
+        flash('بازیابی رمز عبور از طریق ایمیل در حال حاضر فعال نیست. لطفاً با مدیر سیستم تماس بگیرید.', 'warning')
+        return redirect(url_for('auth.login'))
+    
     form = PasswordResetRequestForm()
     
     if form.validate_on_submit():
@@ -141,9 +196,13 @@ def password_reset_request():
         try:
             user = User.query.filter_by(email=email).first()
             
-            if user:
-                # In a real application, generate a secure token and send email
-                # For now, just log the request
+            if user and user.is_active:
+                link = url_for('auth.reset_password', token=generate_reset_token(user), _external=True)
+                # حداکثر یک ایمیل در هر پنج دقیقه؛ درخواست‌های تکراری صندوق کاربر را پر نمی‌کنند
+                email_service.send_password_reset(
+                    user, link, idempotency_key=f"password_reset:{user.id}:{int(time.time() // 300)}"
+                )
+                db.session.commit()
                 logger.info(f"Password reset requested for {email}")
                 flash('لینک بازیابی رمز عبور به ایمیل شما ارسال شد', 'success')
             else:
@@ -154,6 +213,7 @@ def password_reset_request():
             return redirect(url_for('auth.login'))
             
         except Exception as e:
+            db.session.rollback()
             logger.error(f"Error in password reset request: {str(e)}")
             flash('خطا در پردازش درخواست. لطفاً با پشتیبانی تماس بگیرید.', 'danger')
     
@@ -165,8 +225,11 @@ def reset_password(token):
     if current_user.is_authenticated:
         return redirect(url_for('auth.index'))
     
-    # In a real application, validate the token here
-    # For now, just show the form
+    user = user_for_reset_token(token)
+    if not user:
+        flash('لینک بازیابی نامعتبر است یا منقضی شده است. لطفاً دوباره درخواست دهید.', 'danger')
+        return redirect(url_for('auth.password_reset_request'))
+    
     form = PasswordResetForm()
     
     if form.validate_on_submit():
@@ -175,12 +238,21 @@ def reset_password(token):
             return render_template('auth/reset_password.html', form=form, token=token)
         
         try:
-            # In a real application, find user by token and update password
+            user.set_password(form.new_password.data)
+            db.session.commit()
+            clear_failed_attempts(user.username)
+            
+            log_audit_action(
+                user_id=user.id,
+                action='password_reset',
+                description=f'User {user.username} reset their password by email'
+            )
             flash('رمز عبور شما با موفقیت تغییر کرد. اکنون می‌توانید وارد سیستم شوید.', 'success')
-            logger.info("Password reset successful")
+            logger.info(f"Password reset successful for user {user.id}")
             return redirect(url_for('auth.login'))
             
         except Exception as e:
+            db.session.rollback()
             logger.error(f"Error resetting password: {str(e)}")
             flash('خطا در تغییر رمز عبور. لطفاً دوباره تلاش کنید.', 'danger')
     
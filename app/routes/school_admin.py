@@ -2,7 +2,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_required
 from flask_login import current_user
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SelectField, FileField, DateField, SelectMultipleField
+from wtforms import StringField, PasswordField, SelectField, FileField, DateField, SelectMultipleField, TextAreaField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, Optional
 from werkzeug.security import generate_password_hash, check_password_hash
 import pandas as pd
@@ -12,9 +12,13 @@ import logging
 from sqlalchemy.exc import SQLAlchemyError
 from functools import wraps
 
-from app.models import db, Student, Teacher, Class, Subject, Attendance, Discipline, Grade, SkillAssessment
+from app.models import db, Student, Teacher, Class, Subject, Attendance, Discipline, Grade, SkillAssessment, class_students
+from app.models import SmsCampaign, SmsCampaignRecipient
 from app.utils.sms_service import sms_service
+from app.utils.email_service import email_service
+from app.utils.campaigns import create_campaign, pause_campaign, resume_campaign, cancel_campaign, campaign_progress, refresh_campaigns
 from app.decorators import school_admin_required, role_required
+from app.utils.conditional import conditional_response, latest_timestamp
 
 logger = logging.getLogger(__name__)
 bp = Blueprint('school_admin', __name__, url_prefix='/school_admin')
@@ -118,6 +122,17 @@ class ReportForm(FlaskForm):
     start_date = DateField('تاریخ شروع', validators=[DataRequired(message='تاریخ شروع الزامی است')])
     end_date = DateField('تاریخ پایان', validators=[DataRequired(message='تاریخ پایان الزامی است')])
 
+class AnnouncementForm(FlaskForm):
+    title = StringField('عنوان', validators=[
+        DataRequired(message='عنوان الزامی است'),
+        Length(min=3, max=100, message='عنوان باید بین 3 تا 100 کاراکتر باشد')
+    ])
+    grade = SelectField('پایه', validators=[Optional()])
+    text = TextAreaField('متن اطلاعیه', validators=[
+        DataRequired(message='متن اطلاعیه الزامی است'),
+        Length(max=250, message='متن اطلاعیه باید حداکثر 250 کاراکتر باشد')
+    ])
+
 # === مسیرهای اصلی ===
 @bp.route('/dashboard')
 @login_required
@@ -198,24 +213,25 @@ def settings():
     try:
         form = SchoolSettingsForm()
         school = current_user.school
+        admin = current_user.user  # current_user فقط خواندنی است
         
         # تنظیم گزینه‌های پایه برای فرم
         if request.method == 'GET':
             form.school_name.data = school.name
-            form.admin_name.data = current_user.name
-            form.phone.data = current_user.phone
+            form.admin_name.data = admin.name
+            form.phone.data = admin.phone
         
         if form.validate_on_submit():
             # به‌روزرسانی نام مدرسه
             school.name = form.school_name.data
             
             # به‌روزرسانی اطلاعات مدیر
-            current_user.name = form.admin_name.data
-            current_user.phone = form.phone.data
+            admin.name = form.admin_name.data
+            admin.phone = form.phone.data
             
             # تغییر رمز عبور
             if form.new_password:
-                current_user.set_password(form.new_password.data)
+                admin.set_password(form.new_password.data)
             
             db.session.commit()
             flash('تنظیمات با موفقیت بروزرسانی شد', 'success')
@@ -225,7 +241,7 @@ def settings():
         return render_template('school_admin/settings.html', 
                              form=form, 
                              school=school,
-                             admin=current_user)
+                             admin=admin)
     
     except SQLAlchemyError as e:
         db.session.rollback()
@@ -555,11 +571,12 @@ def handle_attendance_submission(selected_class, students, date_str):
         attendance_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         teacher_id = current_user.id
         
-        # حذف حضور و غیاب قبلی برای این کلاس و تاریخ
-        Attendance.query.filter_by(
-            class_id=selected_class.id,
-            date=attendance_date
-        ).delete()
+        # رکوردهای قبلی همین کلاس و تاریخ در جا به‌روزرسانی می‌شوند تا فقط ردیف‌های تغییرکرده
+        # در تاریخچه همگام‌سازی ثبت شوند
+        existing_records = {
+            record.student_id: record
+            for record in Attendance.query.filter_by(class_id=selected_class.id, date=attendance_date).all()
+        }
         
         sent_sms_count = 0
         
@@ -569,24 +586,43 @@ def handle_attendance_submission(selected_class, students, date_str):
             if status not in ['present', 'absent', 'late']:
                 status = 'present'
             
-            attendance = Attendance(
-                class_id=selected_class.id,
-                student_id=student.id,
-                date=attendance_date,
-                status=status,
-                teacher_id=teacher_id
-            )
+            attendance = existing_records.pop(student.id, None)
+            if attendance:
+                attendance.status = status
+                attendance.teacher_id = teacher_id
+            else:
+                attendance = Attendance(
+                    class_id=selected_class.id,
+                    student_id=student.id,
+                    date=attendance_date,
+                    status=status,
+                    teacher_id=teacher_id
+                )
+                db.session.add(attendance)
             
-            db.session.add(attendance)
+            # ارسال SMS و ایمیل به والدین در صورت غیبت یا تأخیر؛ «حاضر» پیام در انتظار را پس می‌گیرد
+            if student.parent_phone_normalized:
+                if sms_service.send_attendance_notification(
+                    parent_phone=student.parent_phone_normalized,
+                    student_name=student.full_name,
+                    status=status,
+                    student_id=student.id,
+                    attendance_date=attendance_date
+                ):
+                    sent_sms_count += 1
             
-            # ارسال SMS به والدین در صورت غیبت یا تأخیر
-            if status in ['absent', 'late'] and student.parent_phone:
-                sms_service.send_attendance_notification(
-                    parent_phone=student.parent_phone,
+            if student.parent_email:
+                email_service.send_attendance_notification(
+                    parent_email=student.parent_email,
                     student_name=student.full_name,
-                    status=status
+                    status=status,
+                    student_id=student.id,
+                    attendance_date=attendance_date
                 )
-                sent_sms_count += 1
+        
+        # رکورد دانش‌آموزانی که دیگر در کلاس نیستند
+        for attendance in existing_records.values():
+            db.session.delete(attendance)
         
         db.session.commit()
         
@@ -633,10 +669,119 @@ def get_today_attendance_summary(school_id, date_str):
         logger.error(f"Error getting attendance summary: {str(e)}")
         return []
 
+# === اطلاعیه‌های پیامکی ===
+@bp.route('/announcements', methods=['GET', 'POST'])
+@login_required
+@school_admin_required
+def announcements():
+    """ارسال اطلاعیه به والدین کل مدرسه یا یک پایه"""
+    school_id = current_user.school_id
+    form = AnnouncementForm()
+    grades = db.session.query(Student.grade).filter_by(school_id=school_id).distinct().order_by(Student.grade).all()
+    form.grade.choices = [('', 'همه پایه‌ها')] + [(g[0], g[0]) for g in grades]
+    
+    if form.validate_on_submit():
+        try:
+            campaign = create_campaign(
+                current_user.school,
+                form.title.data.strip(),
+                form.text.data,
+                grade=form.grade.data or None,
+                created_by=current_user.id
+            )
+            db.session.commit()
+            flash(f'اطلاعیه برای {campaign.total_recipients} شماره در صف ارسال قرار گرفت', 'success')
+            logger.info(f"SMS campaign {campaign.id} created by {current_user.username} for {campaign.total_recipients} phones")
+            return redirect(url_for('school_admin.announcement_detail', campaign_id=campaign.id))
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Error creating SMS campaign: {str(e)}")
+            flash('خطا در ثبت اطلاعیه', 'danger')
+    
+    page = request.args.get('page', 1, type=int)
+    pagination = SmsCampaign.query.filter_by(school_id=school_id).order_by(
+        SmsCampaign.created_at.desc()
+    ).paginate(page=page, per_page=20, error_out=False)
+    
+    return render_template('school_admin/announcements.html',
+                         form=form,
+                         campaigns=pagination.items,
+                         progress=campaign_progress([campaign.id for campaign in pagination.items]),
+                         pagination=pagination)
+
+@bp.route('/announcements/<int:campaign_id>')
+@login_required
+@school_admin_required
+def announcement_detail(campaign_id):
+    """پیشرفت ارسال و وضعیت هر گیرنده"""
+    campaign = SmsCampaign.query.filter_by(id=campaign_id, school_id=current_user.school_id).first_or_404()
+    if campaign.status != 'completed':
+        # ردیف‌های در حال ارسال نتیجه خود را بعد از توقف یا لغو هم ثبت می‌کنند
+        refresh_campaigns([campaign.id])
+    
+    status = request.args.get('status', '')
+    recipients_query = SmsCampaignRecipient.query.filter_by(campaign_id=campaign.id)
+    if status:
+        recipients_query = recipients_query.filter_by(status=status)
+    page = request.args.get('page', 1, type=int)
+    pagination = recipients_query.order_by(SmsCampaignRecipient.id).paginate(page=page, per_page=50, error_out=False)
+    
+    return render_template('school_admin/announcement_detail.html',
+                         campaign=campaign,
+                         progress=campaign_progress([campaign.id])[campaign.id],
+                         recipients=pagination.items,
+                         pagination=pagination,
+                         selected_status=status)
+
+@bp.route('/announcements/<int:campaign_id>/<action>', methods=['POST'])
+@login_required
+@school_admin_required
+def announcement_action(campaign_id, action):
+    """توقف، ادامه یا لغو ارسال اطلاعیه"""
+    actions = {
+        'pause': (pause_campaign, 'ارسال اطلاعیه متوقف شد'),
+        'resume': (resume_campaign, 'ارسال اطلاعیه ادامه یافت'),
+        'cancel': (cancel_campaign, 'ارسال اطلاعیه لغو شد'),
+    }
+    if action not in actions:
+        return jsonify({'error': 'عملیات نامعتبر'}), 404
+    
+    campaign = SmsCampaign.query.filter_by(id=campaign_id, school_id=current_user.school_id).first_or_404()
+    handler, message = actions[action]
+    try:
+        if handler(campaign):
+            db.session.commit()
+            flash(message, 'success')
+            logger.info(f"SMS campaign {campaign.id} {action} by {current_user.username}")
+        else:
+            flash('این عملیات در وضعیت فعلی اطلاعیه ممکن نیست', 'warning')
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(f"Error in SMS campaign {action}: {str(e)}")
+        flash('خطا در تغییر وضعیت اطلاعیه', 'danger')
+    
+    return redirect(url_for('school_admin.announcement_detail', campaign_id=campaign.id))
+
 # === API Endpoints برای عملکردهای پویا ===
+def class_students_version(class_id):
+    """نسخه ارزان لیست دانش‌آموزان کلاس برای پاسخ 304"""
+    class_row = db.session.query(Class.school_id, Class.updated_at).filter(Class.id == class_id).first()
+    if class_row is None or class_row.school_id != current_user.school_id:
+        return None
+
+    count, id_sum, updated_at = db.session.query(
+        db.func.count(Student.id),
+        db.func.sum(Student.id),
+        db.func.max(Student.updated_at)
+    ).join(class_students, class_students.c.student_id == Student.id)\
+     .filter(class_students.c.class_id == class_id).one()
+
+    return (count, id_sum, updated_at, class_row.updated_at), latest_timestamp(updated_at, class_row.updated_at)
+
 @bp.route('/api/classes/<int:class_id>/students')
 @login_required
 @school_admin_required
+@conditional_response(class_students_version)
 def get_class_students(class_id):
     """دریافت دانش‌آموزان یک کلاس به صورت JSON"""
     try:
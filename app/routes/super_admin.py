@@ -6,14 +6,17 @@ from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationE
 from werkzeug.security import generate_password_hash
 import logging
 from sqlalchemy.exc import SQLAlchemyError
-from datetime import datetime
+from datetime import datetime, date
 from functools import wraps
 
 from app.models import db, School, User, Student, Teacher, Class
 from app.decorators import super_admin_required
-from app.utils.audit_log import log_audit_action
+from app.utils.audit_log import log_audit_action, resolve_audit_log_filters, fetch_audit_log_page
 from app.utils.sms_service import sms_service
 from app.utils.export_utils import export_to_excel
+from app.utils.analytics import get_school_comparison
+from app.utils.school_counters import get_school_summaries
+from app.utils.date_utils import get_school_year_start
 
 logger = logging.getLogger(__name__)
 bp = Blueprint('super_admin', __name__, url_prefix='/super_admin')
@@ -362,9 +365,9 @@ def admins():
     """Manage school admins"""
     form = AdminForm()
     
-    # Set school choices for form
-    schools = School.query.order_by(School.name).all()
-    form.school_id.choices = [(school.id, school.name) for school in schools]
+    # Set school choices for form from the cached per-school counters
+    schools = get_school_summaries()
+    form.school_id.choices = [(school['id'], school['name']) for school in schools]
     
     # Handle form submission
     if form.validate_on_submit():
@@ -414,7 +417,7 @@ def admins():
     search_query = request.args.get('search', '').strip()
     school_filter = request.args.get('school', type=int)
     
-    query = User.query.filter_by(role='school_admin').join(School)
+    query = User.query.filter_by(role='school_admin').join(School, User.school_id == School.id)
     
     if search_query:
         query = query.filter(
@@ -432,22 +435,13 @@ def admins():
         page=page, per_page=15, error_out=False
     )
     
-    # Get school statistics for filters
-    school_stats = db.session.query(
-        School.id,
-        School.name,
-        db.func.count(User.id).label('admin_count')
-    ).outerjoin(User, db.and_(User.school_id == School.id, User.role == 'school_admin'))\
-     .group_by(School.id, School.name)\
-     .order_by(School.name).all()
-    
     return render_template('super_admin/admins.html',
                          form=form,
                          admins=admins_pagination.items,
                          pagination=admins_pagination,
                          search_query=search_query,
                          school_filter=school_filter,
-                         school_stats=school_stats,
+                         school_stats=schools,
                          schools=schools)
 
 @bp.route('/impersonate', methods=['GET', 'POST'])
@@ -491,7 +485,7 @@ def impersonate():
         return redirect(url_for('school_admin.dashboard'))
     
     # Get list of admins for selection
-    admins = User.query.filter_by(role='school_admin').join(School).order_by(School.name, User.name).all()
+    admins = User.query.filter_by(role='school_admin').join(School, User.school_id == School.id).order_by(School.name, User.name).all()
     
     return render_template('super_admin/impersonate.html', form=form, admins=admins)
 
@@ -529,17 +523,73 @@ def stop_impersonation():
 @login_required
 @super_admin_required
 def get_audit_log():
-    """Get audit log"""
-    from app.models import AuditLog
-    
-    page = request.args.get('page', 1, type=int)
+    """Get audit log with keyset pagination and filters"""
     per_page = 20
+    action = request.args.get('action', '').strip()
+    school_filter = request.args.get('school', type=int)
+    user_filter = request.args.get('user', '').strip()
+    target_filter = request.args.get('target_user', '').strip()
+    cursor = request.args.get('cursor')
+    direction = request.args.get('direction', 'next')
     
-    logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else None
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else None
+    except ValueError:
+        flash('فرمت تاریخ نامعتبر است', 'warning')
+        start_date = end_date = None
+    
+    filters = {
+        'action': action,
+        'school_id': school_filter,
+        'user': user_filter,
+        'target_user': target_filter,
+        'start_date': start_date,
+        'end_date': end_date
+    }
+    
+    page = fetch_audit_log_page(resolve_audit_log_filters(**filters),
+                                cursor=cursor,
+                                direction=direction,
+                                per_page=per_page)
+    
+    # پارامترهای فیلتر برای ساخت لینک صفحات بعد/قبل
+    filter_args = {key: value for key, value in request.args.items() if key not in ('cursor', 'direction') and value}
+    schools = db.session.query(School.id, School.name).order_by(School.name).all()
+    
+    return render_template('super_admin/audit_log.html',
+                         logs=page.items,
+                         pagination=page,
+                         filter_args=filter_args,
+                         schools=schools,
+                         action=action,
+                         school_filter=school_filter,
+                         user_filter=user_filter,
+                         target_filter=target_filter,
+                         start_date=start_date.isoformat() if start_date else '',
+                         end_date=end_date.isoformat() if end_date else '')
+
+@bp.route('/analytics/schools')
+@login_required
+@super_admin_required
+def school_analytics():
+    """Cross-school attendance, grade and discipline comparison as JSON for charts"""
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date() if request.args.get('start_date') else get_school_year_start()
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date() if request.args.get('end_date') else date.today()
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid date format, expected YYYY-MM-DD'}), 400
+    
+    if start_date > end_date:
+        return jsonify({'success': False, 'error': 'start_date must not be after end_date'}), 400
     
-    return render_template('super_admin/audit_log.html', logs=logs.items, pagination=logs)
+    try:
+        comparison = get_school_comparison(start_date, end_date)
+        return jsonify({'success': True, **comparison}), 200
+    
+    except Exception as e:
+        logger.error(f"Error computing school analytics: {str(e)}")
+        return jsonify({'success': False, 'error': 'خطا در محاسبه آمار مدارس'}), 500
 
 # Helper functions
 def create_default_classes_for_school(school_id):
@@ -654,8 +704,10 @@ def send_welcome_notification(user):
 رمز عبور: (رمز عبور فعلی شما)
 لطفاً پس از ورود، رمز عبور خود را تغییر دهید.
             """
-            sms_service.send(user.phone, message)
-            logger.info(f"Welcome SMS sent to admin {user.username}")
+            if sms_service.queue(user.phone, message.strip(), idempotency_key=f"welcome:{user.id}",
+                                 category='welcome', school_id=user.school_id):
+                db.session.commit()
+                logger.info(f"Welcome SMS queued for admin {user.username}")
     
     except Exception as e:
         logger.error(f"Error sending welcome notification to {user.username}: {str(e)}")
@@ -8,11 +8,13 @@ import logging
 from datetime import date, datetime, timedelta
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import func, case, and_, or_
+from sqlalchemy.orm import contains_eager
 from functools import wraps
 
 from app.models import db, Class, Student, Subject, Grade, Attendance, Discipline, SkillAssessment, Skill
 from app.decorators import teacher_required, role_required
 from app.utils.sms_service import sms_service, get_status_text, get_status_badge
+from app.utils.email_service import email_service
 from app.utils.export_utils import export_to_excel
 
 logger = logging.getLogger(__name__)
@@ -43,12 +45,12 @@ class GradeForm(FlaskForm):
         if not super().validate(extra_validators):
             return False
         
-        school = current_user.school
-        if not school:
+        school_type = current_user.school_type
+        if not school_type:
             self.subject_id.errors.append('مدرسه یافت نشد')
             return False
         
-        if school.type in ['middle', 'high']:
+        if school_type in ['middle', 'high']:
             if self.score.data is None:
                 self.score.errors.append('نمره الزامی است')
                 return False
@@ -164,7 +166,7 @@ def grades(class_id):
         class_obj = Class.query.get_or_404(class_id)
         
         # بررسی دسترسی
-        if class_obj.teacher_id != current_user.teacher_profile.id:
+        if class_obj.teacher_id != current_user.teacher_id:
             flash('شما دسترسی به این کلاس را ندارید', 'danger')
             return redirect(url_for('teacher.dashboard'))
         
@@ -200,7 +202,7 @@ def grades(class_id):
                              grades=grades_list,
                              grades_summary=grades_summary,
                              selected_date=selected_date,
-                             school_type=current_user.school.type)
+                             school_type=current_user.school_type)
     
     except Exception as e:
         logger.error(f"Error in grades page: {str(e)}")
@@ -211,7 +213,7 @@ def handle_grade_submission(form, class_obj, selected_date):
     """پردازش ثبت نمره جدید"""
     try:
         school = current_user.school
-        teacher_id = current_user.teacher_profile.id
+        teacher_id = current_user.teacher_id
         student_id = int(form.student_id.data)
         
         # بررسی وجود نمره برای همین دانش‌آموز، درس و تاریخ
@@ -274,7 +276,7 @@ def get_class_grades(class_id, selected_date):
 
 def get_grades_summary(class_id, selected_date):
     """دریافت خلاصه نمرات کلاس"""
-    school_type = current_user.school.type
+    school_type = current_user.school_type
     
     if school_type in ['middle', 'high']:
         return db.session.query(
@@ -306,7 +308,7 @@ def attendance(class_id):
         class_obj = Class.query.get_or_404(class_id)
         
         # بررسی دسترسی
-        if class_obj.teacher_id != current_user.teacher_profile.id:
+        if class_obj.teacher_id != current_user.teacher_id:
             flash('شما دسترسی به این کلاس را ندارید', 'danger')
             return redirect(url_for('teacher.dashboard'))
         
@@ -346,14 +348,15 @@ def attendance(class_id):
 def handle_attendance_submission(class_obj, selected_date):
     """پردازش ثبت حضور و غیاب"""
     try:
-        teacher_id = current_user.teacher_profile.id
+        teacher_id = current_user.teacher_id
         school_id = current_user.school_id
         
-        # حذف حضور و غیاب قبلی برای این کلاس و تاریخ
-        Attendance.query.filter_by(
-            class_id=class_obj.id,
-            date=selected_date
-        ).delete()
+        # رکوردهای قبلی همین کلاس و تاریخ در جا به‌روزرسانی می‌شوند تا فقط ردیف‌های تغییرکرده
+        # در تاریخچه همگام‌سازی ثبت شوند
+        existing_records = {
+            record.student_id: record
+            for record in Attendance.query.filter_by(class_id=class_obj.id, date=selected_date).all()
+        }
         
         sent_sms_count = 0
         absent_count = 0
@@ -370,30 +373,49 @@ def handle_attendance_submission(class_obj, selected_date):
                 if status not in ['present', 'absent', 'late']:
                     status = 'present'
                 
-                # ایجاد رکورد حضور و غیاب
-                attendance = Attendance(
-                    class_id=class_obj.id,
-                    student_id=student.id,
-                    date=selected_date,
-                    status=status,
-                    teacher_id=teacher_id
-                )
+                attendance = existing_records.pop(student.id, None)
+                if attendance:
+                    attendance.status = status
+                    attendance.teacher_id = teacher_id
+                else:
+                    attendance = Attendance(
+                        class_id=class_obj.id,
+                        student_id=student.id,
+                        date=selected_date,
+                        status=status,
+                        teacher_id=teacher_id
+                    )
+                    db.session.add(attendance)
                 
-                db.session.add(attendance)
+                # ارسال SMS و ایمیل برای غیبت یا تأخیر (در همین تراکنش در صف قرار می‌گیرند)؛
+                # برای «حاضر» پیام در انتظار قبلی همان روز پس گرفته می‌شود
+                if student.parent_phone_normalized:
+                    if sms_service.send_attendance_notification(
+                        parent_phone=student.parent_phone_normalized,
+                        student_name=student.full_name,
+                        status=status,
+                        student_id=student.id,
+                        attendance_date=selected_date
+                    ):
+                        sent_sms_count += 1
+                        
+                        if status == 'absent':
+                            absent_count += 1
+                        else:
+                            late_count += 1
                 
-                # ارسال SMS برای غیبت یا تأخیر
-                if status in ['absent', 'late'] and student.parent_phone:
-                    sms_service.send_attendance_notification(
-                        parent_phone=student.parent_phone,
+                if student.parent_email:
+                    email_service.send_attendance_notification(
+                        parent_email=student.parent_email,
                         student_name=student.full_name,
-                        status=status
+                        status=status,
+                        student_id=student.id,
+                        attendance_date=selected_date
                     )
-                    sent_sms_count += 1
-                    
-                    if status == 'absent':
-                        absent_count += 1
-                    else:
-                        late_count += 1
+        
+        # دانش‌آموزانی که در فرم نبودند رکورد حضور و غیاب ندارند
+        for attendance in existing_records.values():
+            db.session.delete(attendance)
         
         db.session.commit()
         
@@ -430,7 +452,7 @@ def discipline(class_id):
         class_obj = Class.query.get_or_404(class_id)
         
         # بررسی دسترسی
-        if class_obj.teacher_id != current_user.teacher_profile.id:
+        if class_obj.teacher_id != current_user.teacher_id:
             flash('شما دسترسی به این کلاس را ندارید', 'danger')
             return redirect(url_for('teacher.dashboard'))
         
@@ -471,7 +493,7 @@ def discipline(class_id):
 def handle_discipline_submission(form, class_obj, selected_date):
     """پردازش ثبت نمره انضباطی"""
     try:
-        teacher_id = current_user.teacher_profile.id
+        teacher_id = current_user.teacher_id
         
         discipline = Discipline(
             student_id=form.student_id.data,
@@ -532,7 +554,7 @@ def skills(class_id):
         class_obj = Class.query.get_or_404(class_id)
         
         # بررسی دسترسی
-        if class_obj.teacher_id != current_user.teacher_profile.id:
+        if class_obj.teacher_id != current_user.teacher_id:
             flash('شما دسترسی به این کلاس را ندارید', 'danger')
             return redirect(url_for('teacher.dashboard'))
         
@@ -577,7 +599,7 @@ def skills(class_id):
 def handle_skill_assessment_submission(form, class_obj, selected_date):
     """پردازش ثبت ارزیابی مهارت"""
     try:
-        teacher_id = current_user.teacher_profile.id
+        teacher_id = current_user.teacher_id
         
         assessment = SkillAssessment(
             student_id=form.student_id.data,
@@ -639,7 +661,7 @@ def edit_grade(grade_id):
     grade = Grade.query.get_or_404(grade_id)
     
     # بررسی دسترسی
-    if grade.teacher_id != current_user.teacher_profile.id:
+    if grade.teacher_id != current_user.teacher_id:
         return jsonify({'error': 'دسترسی غیرمجاز'}), 403
     
     form = GradeForm()
@@ -658,7 +680,7 @@ def edit_grade(grade_id):
         form.date.data = grade.date
         form.description.data = grade.description
         
-        if current_user.school.type in ['middle', 'high']:
+        if current_user.school_type in ['middle', 'high']:
             form.score.data = grade.score
             form.max_score.data = grade.max_score
         else:
@@ -671,7 +693,7 @@ def edit_grade(grade_id):
             grade.date = form.date.data
             grade.description = form.description.data
             
-            if current_user.school.type in ['middle', 'high']:
+            if current_user.school_type in ['middle', 'high']:
                 grade.score = form.score.data
                 grade.max_score = form.max_score.data
             else:
@@ -707,7 +729,7 @@ def toggle_attendance():
         class_obj = Class.query.get_or_404(class_id)
         
         # بررسی دسترسی
-        if class_obj.teacher_id != current_user.teacher_profile.id:
+        if class_obj.teacher_id != current_user.teacher_id:
             return jsonify({'error': 'دسترسی غیرمجاز'}), 403
         
         attendance_date = datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -727,21 +749,31 @@ def toggle_attendance():
                 student_id=student_id,
                 date=attendance_date,
                 status=new_status,
-                teacher_id=current_user.teacher_profile.id
+                teacher_id=current_user.teacher_id
             )
             db.session.add(attendance)
         
-        db.session.commit()
+        # ارسال SMS و ایمیل در صورت نیاز - همراه با رکورد حضور در یک تراکنش
+        # (برگشت به حاضر، پیامی را که هنوز ارسال نشده پس می‌گیرد)
+        student = Student.query.get(student_id)
+        if student and student.parent_phone_normalized:
+            sms_service.send_attendance_notification(
+                parent_phone=student.parent_phone_normalized,
+                student_name=student.full_name,
+                status=new_status,
+                student_id=student.id,
+                attendance_date=attendance_date
+            )
+        if student and student.parent_email:
+            email_service.send_attendance_notification(
+                parent_email=student.parent_email,
+                student_name=student.full_name,
+                status=new_status,
+                student_id=student.id,
+                attendance_date=attendance_date
+            )
         
-        # ارسال SMS در صورت نیاز
-        if new_status in ['absent', 'late']:
-            student = Student.query.get(student_id)
-            if student and student.parent_phone:
-                sms_service.send_attendance_notification(
-                    parent_phone=student.parent_phone,
-                    student_name=student.full_name,
-                    status=new_status
-                )
+        db.session.commit()
         
         return jsonify({
             'success': True,
@@ -764,7 +796,7 @@ def export_grades(class_id):
         class_obj = Class.query.get_or_404(class_id)
         
         # بررسی دسترسی
-        if class_obj.teacher_id != current_user.teacher_profile.id:
+        if class_obj.teacher_id != current_user.teacher_id:
             flash('شما دسترسی به این کلاس را ندارید', 'danger')
             return redirect(url_for('teacher.dashboard'))
         
@@ -775,52 +807,44 @@ def export_grades(class_id):
         grades = Grade.query.filter(
             Grade.class_id == class_id,
             Grade.date.between(start_date, end_date)
-        ).join(Student).join(Subject).order_by(Grade.date, Student.last_name).all()
+        ).join(Student).join(Subject).options(
+            contains_eager(Grade.student), contains_eager(Grade.subject)
+        ).order_by(Grade.date, Student.last_name)
         
-        if not grades:
+        if not grades.first():
             flash('داده‌ای برای خروجی وجود ندارد', 'warning')
             return redirect(url_for('teacher.grades', class_id=class_id))
         
-        # ایجاد دیتافریم
-        data = []
-        for grade in grades:
-            row = {
-                'تاریخ': grade.date.strftime('%Y/%m/%d'),
-                'نام دانش‌آموز': grade.student.full_name,
-                'کد دانش‌آموز': grade.student.code,
-                'درس': grade.subject.name,
-                'توضیحات': grade.description or ''
-            }
-            
-            if current_user.school.type in ['middle', 'high']:
-                row.update({
-                    'نمره': grade.score,
-                    'حداکثر': grade.max_score,
-                    'درصد': f"{(grade.score / grade.max_score * 100):.1f}%" if grade.max_score > 0 else 'N/A'
-                })
-            else:
-                row.update({
-                    'سطح': get_level_text(grade.level),
-                    'نمره کیفی': grade.level
-                })
-            
-            data.append(row)
-        
-        df = pd.DataFrame(data)
-        
-        # ایجاد فایل اکسل
-        output = io.BytesIO()
-        df.to_excel(output, index=False, sheet_name='نمرات')
-        output.seek(0)
+        graded_by_score = current_user.school_type in ['middle', 'high']
+        
+        def rows():
+            # ردیف‌ها دسته‌ای از دیتابیس خوانده و همان‌جا در فایل نوشته می‌شوند
+            for grade in grades.yield_per(500):
+                row = {
+                    'تاریخ': grade.date.strftime('%Y/%m/%d'),
+                    'نام دانش‌آموز': grade.student.full_name,
+                    'کد دانش‌آموز': grade.student.code,
+                    'درس': grade.subject.name,
+                    'توضیحات': grade.description or ''
+                }
+                
+                if graded_by_score:
+                    row.update({
+                        'نمره': grade.score,
+                        'حداکثر': grade.max_score,
+                        'درصد': f"{(grade.score / grade.max_score * 100):.1f}%" if grade.max_score > 0 else 'N/A'
+                    })
+                else:
+                    row.update({
+                        'سطح': get_level_text(grade.level),
+                        'نمره کیفی': grade.level
+                    })
+                
+                yield row
         
         filename = f"grades_{class_obj.name}_{start_date.replace('-', '')}_{end_date.replace('-', '')}.xlsx"
         
-        return send_file(
-            output,
-            download_name=filename,
-            as_attachment=True,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return export_to_excel(rows(), filename, sheet_name='نمرات')
         
     except Exception as e:
         logger.error(f"Error exporting grades: {str(e)}")
@@ -0,0 +1,332 @@
+import logging
+import threading
+from datetime import date, timedelta
+
+import click
+import pandas as pd
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, case, select, update, delete, inspect
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+
+from app.models import (db, School, Class, Student, Attendance, Grade, Discipline, SchoolDailyStat, AnalyticsDay,
+                        SCHOOL_TYPES_FA)
+from app.utils.cache import TTLCache
+from app.utils.date_utils import get_school_year_start
+
+logger = logging.getLogger(__name__)
+
+analytics_cache = TTLCache(max_size=64, ttl=300)
+_refresh_lock = threading.Lock()
+
+# کلید قفل advisory در PostgreSQL تا دو worker همزمان یک بازه را دوباره تجمیع نکنند
+ANALYTICS_REFRESH_LOCK_KEY = 730301
+
+def refresh_school_daily_stats(start_date, end_date):
+    """Recompute per-school daily aggregates for [start_date, end_date] with three GROUP BY queries.
+
+    Runs in its own transaction on a separate connection, so calling it from a
+    request never commits (or rolls back) the request's session.
+    """
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # همان بازه در worker دیگر پس از commit این تراکنش دوباره خوانده می‌شود
+            connection.execute(select(func.pg_advisory_xact_lock(ANALYTICS_REFRESH_LOCK_KEY)))
+
+        # روزها قبل از خواندن داده‌ها پاک علامت می‌خورند؛ ویرایش همزمان دوباره آن‌ها را dirty می‌کند
+        _mark_days_clean(connection, start_date, end_date)
+        stats = _aggregate(connection, start_date, end_date)
+
+        table = SchoolDailyStat.__table__
+        connection.execute(delete(table).where(table.c.date.between(start_date, end_date)))
+        if stats:
+            connection.execute(table.insert(), list(stats.values()))
+
+    logger.info(f"School daily stats refreshed for {start_date} - {end_date} ({len(stats)} rows)")
+    return len(stats)
+
+def _aggregate(connection, start_date, end_date):
+    """{(school_id, date): row} for the range"""
+    stats = {}
+
+    def row_for(school_id, day):
+        return stats.setdefault((school_id, day), {
+            'school_id': school_id,
+            'date': day,
+            'present_count': 0,
+            'absent_count': 0,
+            'late_count': 0,
+            'grade_count': 0,
+            'normalized_score_sum': 0.0,
+            'positive_points': 0,
+            'negative_points': 0
+        })
+
+    attendance = select(
+        Class.school_id,
+        Attendance.date,
+        func.sum(case((Attendance.status == 'present', 1), else_=0)),
+        func.sum(case((Attendance.status == 'absent', 1), else_=0)),
+        func.sum(case((Attendance.status == 'late', 1), else_=0))
+    ).join(Class, Attendance.class_id == Class.id)\
+     .where(Attendance.date.between(start_date, end_date))\
+     .group_by(Class.school_id, Attendance.date)
+
+    for school_id, day, present, absent, late in connection.execute(attendance):
+        row = row_for(school_id, day)
+        row.update(present_count=int(present or 0), absent_count=int(absent or 0), late_count=int(late or 0))
+
+    grades = select(
+        Class.school_id,
+        Grade.date,
+        func.count(Grade.id),
+        func.sum(Grade.score / Grade.max_score)
+    ).join(Class, Grade.class_id == Class.id)\
+     .where(Grade.date.between(start_date, end_date),
+            Grade.score.isnot(None),
+            Grade.max_score > 0)\
+     .group_by(Class.school_id, Grade.date)
+
+    for school_id, day, count, score_sum in connection.execute(grades):
+        row = row_for(school_id, day)
+        row.update(grade_count=int(count or 0), normalized_score_sum=float(score_sum or 0.0))
+
+    discipline = select(
+        Student.school_id,
+        Discipline.date,
+        func.sum(case((Discipline.type == 'positive', func.abs(Discipline.points)), else_=0)),
+        func.sum(case((Discipline.type == 'negative', func.abs(Discipline.points)), else_=0))
+    ).join(Student, Discipline.student_id == Student.id)\
+     .where(Discipline.date.between(start_date, end_date))\
+     .group_by(Student.school_id, Discipline.date)
+
+    for school_id, day, positive, negative in connection.execute(discipline):
+        row = row_for(school_id, day)
+        row.update(positive_points=int(positive or 0), negative_points=int(negative or 0))
+
+    return stats
+
+def _days(start_date, end_date):
+    return [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+
+def _mark_days_clean(connection, start_date, end_date):
+    table = AnalyticsDay.__table__
+    connection.execute(
+        update(table).where(table.c.date.between(start_date, end_date))
+        .values(dirty=False, refreshed_at=func.current_timestamp())
+    )
+    known = set(connection.execute(select(table.c.date).where(table.c.date.between(start_date, end_date))).scalars())
+    missing = [{'date': day, 'dirty': False} for day in _days(start_date, end_date) if day not in known]
+    if not missing:
+        return
+
+    # worker دیگری ممکن است همین روزها را همزمان ثبت کرده باشد
+    dialect_insert = {'postgresql': postgresql_insert, 'sqlite': sqlite_insert}.get(connection.dialect.name)
+    if dialect_insert:
+        connection.execute(dialect_insert(table).on_conflict_do_nothing(index_elements=['date']), missing)
+        return
+    for row in missing:
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert(), row)
+        except IntegrityError:
+            pass
+
+def backfill_start(start_date):
+    """Earliest day get_school_comparison will aggregate on demand for a range starting at start_date"""
+    return max(start_date, get_school_year_start() - timedelta(days=current_app.config.get('ANALYTICS_BACKFILL_DAYS', 365)))
+
+def _stale_runs(start_date, end_date):
+    """Contiguous (first, last) runs of days never aggregated or edited since"""
+    table = AnalyticsDay.__table__
+    with db.engine.connect() as connection:
+        clean = set(connection.execute(
+            select(table.c.date).where(table.c.date.between(start_date, end_date), table.c.dirty.is_(False))
+        ).scalars())
+    runs = []
+    for day in _days(start_date, end_date):
+        if day in clean:
+            continue
+        if runs and runs[-1][1] == day - timedelta(days=1):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return runs
+
+def refresh_stale_days(start_date, end_date):
+    """Aggregate days in the range that are missing or dirty; returns how many runs were refreshed"""
+    start_date, end_date = backfill_start(start_date), min(end_date, date.today())
+    if start_date > end_date or not _stale_runs(start_date, end_date):
+        return 0
+
+    refreshed = 0
+    with _refresh_lock:
+        for first, last in _stale_runs(start_date, end_date):
+            try:
+                refresh_school_daily_stats(first, last)
+                refreshed += 1
+            except IntegrityError as e:
+                # worker دیگری همزمان همین روزها را تجمیع کرد
+                logger.warning(f"School daily stats for {first} - {last} refreshed concurrently: {str(e)}")
+    if refreshed:
+        # نتایج کش‌شده روزهای قدیمی را داشتند
+        analytics_cache.clear()
+    return refreshed
+
+def _refresh_recent_days():
+    """Refresh the trailing window that may still be changing, at most once per cache TTL"""
+    if analytics_cache.get('recent_refreshed'):
+        return
+
+    with _refresh_lock:
+        if analytics_cache.get('recent_refreshed'):
+            return
+        today = date.today()
+        days = current_app.config.get('ANALYTICS_REFRESH_DAYS', 2)
+        try:
+            refresh_school_daily_stats(today - timedelta(days=days - 1), today)
+        except IntegrityError as e:
+            logger.warning(f"Recent school daily stats refreshed concurrently: {str(e)}")
+            return
+        analytics_cache.set('recent_refreshed', True)
+
+def _summarize(frame):
+    """Vectorized rates over summed daily aggregates"""
+    marked = frame['present_count'] + frame['absent_count'] + frame['late_count']
+    summary = pd.DataFrame(index=frame.index)
+    summary['attendance_records'] = marked
+    summary['attendance_rate'] = (frame['present_count'] / marked.where(marked > 0)).round(4)
+    summary['absence_rate'] = (frame['absent_count'] / marked.where(marked > 0)).round(4)
+    summary['late_rate'] = (frame['late_count'] / marked.where(marked > 0)).round(4)
+    summary['grade_count'] = frame['grade_count']
+    summary['avg_normalized_grade'] = (frame['normalized_score_sum'] / frame['grade_count'].where(frame['grade_count'] > 0)).round(4)
+    summary['positive_points'] = frame['positive_points']
+    summary['negative_points'] = frame['negative_points']
+    summary['discipline_balance'] = frame['positive_points'] - frame['negative_points']
+    # NaN در JSON معتبر نیست
+    return summary.astype(object).where(summary.notna(), None)
+
+def compute_school_comparison(start_date, end_date):
+    """Compare schools and school types over a term from the daily aggregates"""
+    stats = db.session.query(
+        SchoolDailyStat.school_id,
+        SchoolDailyStat.present_count,
+        SchoolDailyStat.absent_count,
+        SchoolDailyStat.late_count,
+        SchoolDailyStat.grade_count,
+        SchoolDailyStat.normalized_score_sum,
+        SchoolDailyStat.positive_points,
+        SchoolDailyStat.negative_points
+    ).filter(SchoolDailyStat.date.between(start_date, end_date)).all()
+
+    schools = pd.DataFrame.from_records(
+        db.session.query(School.id, School.name, School.type).all(),
+        columns=['school_id', 'name', 'type']
+    ).set_index('school_id')
+
+    columns = ['school_id', 'present_count', 'absent_count', 'late_count',
+               'grade_count', 'normalized_score_sum', 'positive_points', 'negative_points']
+    daily = pd.DataFrame.from_records(stats, columns=columns)
+
+    per_school = daily.groupby('school_id').sum().reindex(schools.index, fill_value=0)
+    per_school = per_school.join(schools)
+    per_type = per_school.drop(columns=['name']).groupby('type').sum()
+
+    school_summary = _summarize(per_school).join(schools)
+    type_summary = _summarize(per_type)
+
+    return {
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'schools': [
+            dict(school_id=int(school_id), type_fa=SCHOOL_TYPES_FA.get(row['type'], row['type']), **row)
+            for school_id, row in school_summary.to_dict(orient='index').items()
+        ],
+        'school_types': [
+            dict(type=school_type, type_fa=SCHOOL_TYPES_FA.get(school_type, school_type), **row)
+            for school_type, row in type_summary.to_dict(orient='index').items()
+        ]
+    }
+
+def get_school_comparison(start_date, end_date):
+    """Cached cross-school comparison for a date range.
+
+    Days in the range that were never aggregated (first use, a new school year) or
+    were edited since their last aggregation are recomputed first, so back-dated
+    attendance and grades are never left out. Days before ``backfill_start`` are
+    only read as already aggregated (``flask analytics-refresh``); covered_from
+    reports where the guaranteed range begins.
+    """
+    _refresh_recent_days()
+    refresh_stale_days(start_date, end_date)
+    comparison = analytics_cache.get_or_set(
+        ('school_comparison', start_date, end_date),
+        lambda: compute_school_comparison(start_date, end_date)
+    )
+    return dict(comparison, covered_from=backfill_start(start_date).isoformat(),
+                covered_to=min(end_date, date.today()).isoformat())
+
+# === علامت‌گذاری روزهای تغییرکرده ===
+ANALYTICS_SOURCES = (Attendance, Grade, Discipline)
+
+def _recent_window_start():
+    # روزهای پنجره اخیر به هر حال هر چند دقیقه دوباره محاسبه می‌شوند؛ قدیمی‌ترین روز پنجره
+    # علامت می‌خورد چون ممکن است پیش از بازمحاسبه بعدی از پنجره بیرون برود
+    return date.today() - timedelta(days=current_app.config.get('ANALYTICS_REFRESH_DAYS', 2) - 2)
+
+def _mark_dirty(connection, days):
+    """One UPDATE for all days older than the recent window that are not dirty yet"""
+    window_start = _recent_window_start()
+    days = {day for day in days if day is not None and day < window_start}
+    if days:
+        table = AnalyticsDay.__table__
+        # ردیف‌هایی که از قبل dirty هستند دوباره نوشته و قفل نمی‌شوند
+        connection.execute(update(table).where(table.c.date.in_(days), table.c.dirty.is_(False)).values(dirty=True))
+
+def _after_change(mapper, connection, target):
+    # تغییر تاریخ یک رکورد هر دو روز قدیم و جدید را تغییر می‌دهد
+    history = inspect(target).attrs.date.history
+    object_session(target).info.setdefault('analytics_days', set()).update([target.date, *history.deleted])
+
+def _mark_flushed_days(session, flush_context):
+    days = session.info.pop('analytics_days', None)
+    if days:
+        _mark_dirty(session.connection(), days)
+
+def _mark_bulk_changes(orm_execute_state):
+    """Query.delete()/update() skip mapper events; mark the affected days before they run"""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ not in ANALYTICS_SOURCES:
+        return
+
+    table = mapper.local_table
+    affected = select(table.c.date).distinct().where(table.c.date < _recent_window_start())
+    if orm_execute_state.statement.whereclause is not None:
+        affected = affected.where(orm_execute_state.statement.whereclause)
+
+    connection = orm_execute_state.session.connection()
+    _mark_dirty(connection, connection.execute(affected).scalars().all())
+
+for source_model in ANALYTICS_SOURCES:
+    event.listen(source_model, 'after_insert', _after_change)
+    event.listen(source_model, 'after_update', _after_change)
+    event.listen(source_model, 'after_delete', _after_change)
+
+event.listen(Session, 'after_flush', _mark_flushed_days)
+event.listen(Session, 'do_orm_execute', _mark_bulk_changes)
+
+@click.command('analytics-refresh')
+@click.option('--days', type=int, default=30, help='Number of trailing days to recompute')
+@with_appcontext
+def refresh_command(days):
+    """Recompute per-school daily analytics aggregates"""
+    today = date.today()
+    rows = refresh_school_daily_stats(today - timedelta(days=days - 1), today)
+    analytics_cache.clear()
+    click.echo(f"Refreshed {rows} school daily stat rows for the last {days} days")
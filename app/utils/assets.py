@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import current_app, url_for, send_from_directory
+from flask.cli import with_appcontext
+
+from app.utils.compression import brotli, negotiate_encoding
+
+logger = logging.getLogger(__name__)
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+FINGERPRINTED_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff', '.woff2'}
+PRECOMPRESSED_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json'}
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_manifest_cache = {}
+
+def _dist_path(static_folder):
+    return os.path.join(static_folder, DIST_DIR)
+
+def load_manifest(static_folder):
+    """Source path -> fingerprinted path, read once per process"""
+    if static_folder not in _manifest_cache:
+        path = os.path.join(_dist_path(static_folder), MANIFEST_NAME)
+        try:
+            with open(path, encoding='utf-8') as manifest_file:
+                _manifest_cache[static_folder] = json.load(manifest_file)
+        except (OSError, ValueError):
+            # بدون build، فایل‌های اصلی بدون fingerprint سرو می‌شوند
+            _manifest_cache[static_folder] = {}
+    return _manifest_cache[static_folder]
+
+def asset_url(filename):
+    """URL of the fingerprinted copy of a static file when one has been built"""
+    manifest = load_manifest(current_app.static_folder)
+    return url_for('static', filename=manifest.get(filename, filename))
+
+def build_assets(static_folder, gzip_level=9, brotli_level=11):
+    """Copy static files to dist/ under content-hashed names, with .gz/.br siblings and a manifest"""
+    dist = _dist_path(static_folder)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    os.makedirs(dist)
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != dist]
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() not in FINGERPRINTED_EXTENSIONS:
+                continue
+
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as source_file:
+                data = source_file.read()
+
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            target_relative = '/'.join(filter(None, [DIST_DIR, os.path.dirname(relative), f"{stem}.{digest}{extension}"]))
+            target = os.path.join(static_folder, target_relative)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            with open(target, 'wb') as target_file:
+                target_file.write(data)
+
+            if extension.lower() in PRECOMPRESSED_EXTENSIONS:
+                with open(target + '.gz', 'wb') as gz_file:
+                    gz_file.write(gzip.compress(data, compresslevel=gzip_level, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as br_file:
+                        br_file.write(brotli.compress(data, quality=brotli_level))
+
+            manifest[relative] = target_relative
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    _manifest_cache.pop(static_folder, None)
+    return manifest
+
+def init_static_assets(app):
+    """Serve built assets precompressed with far-future caching; other files use Flask's static view"""
+    default_static = app.view_functions['static']
+
+    def static(filename):
+        if not filename.startswith(DIST_DIR + '/'):
+            return default_static(filename=filename)
+
+        static_folder = app.static_folder
+        encodings = [encoding for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+                     if os.path.isfile(os.path.join(static_folder, filename + suffix))]
+        encoding = negotiate_encoding(encodings) if encodings else None
+
+        if encoding:
+            suffix = '.br' if encoding == 'br' else '.gz'
+            response = send_from_directory(static_folder, filename + suffix,
+                                           mimetype=_guess_mimetype(filename), conditional=True)
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = send_from_directory(static_folder, filename, conditional=True)
+
+        # نام فایل شامل هش محتوا است و هرگز تغییر نمی‌کند
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.view_functions['static'] = static
+
+def _guess_mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+@click.group('assets')
+def assets_cli():
+    """Static asset commands"""
+
+@assets_cli.command('build')
+@with_appcontext
+def build_command():
+    """Fingerprint and precompress static assets into static/dist"""
+    manifest = build_assets(
+        current_app.static_folder,
+        gzip_level=current_app.config.get('ASSETS_GZIP_LEVEL', 9),
+        brotli_level=current_app.config.get('ASSETS_BR_LEVEL', 11)
+    )
+    click.echo(f"Built {len(manifest)} assets into {_dist_path(current_app.static_folder)}"
+               f"{'' if brotli is not None else ' (gzip only, brotli not installed)'}")
@@ -0,0 +1,368 @@
+import bisect
+import fcntl
+import glob
+import gzip
+import heapq
+import json
+import logging
+import os
+import tempfile
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.orm import joinedload
+
+from app.models import db, AuditLog
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FILE_PREFIX = 'audit_logs-'
+ARCHIVE_FILE_SUFFIX = '.ndjson.gz'
+INDEX_FILE_SUFFIX = '.idx.json'
+LOCK_FILE_SUFFIX = '.lock'
+
+class ArchivedAuditLog:
+    """Read-only audit log row loaded from a cold archive file"""
+
+    archived = True
+
+    def __init__(self, record):
+        self.id = record['id']
+        self.timestamp = datetime.fromisoformat(record['timestamp'])
+        self.user_id = record.get('user_id')
+        self.action = record.get('action')
+        self.description = record.get('description')
+        self.school_id = record.get('school_id')
+        self.target_user_id = record.get('target_user_id')
+        self.ip_address = record.get('ip_address')
+        self.user_agent = record.get('user_agent')
+
+        # نام‌ها هنگام بایگانی ذخیره شده‌اند تا نیازی به join نباشد
+        self.user = SimpleNamespace(name=record.get('user_name'), username=record.get('username')) if record.get('username') else None
+        self.school = SimpleNamespace(name=record.get('school_name')) if record.get('school_name') else None
+
+    def __repr__(self):
+        return f'<ArchivedAuditLog {self.action} by {self.user_id}>'
+
+def get_archive_dir():
+    return current_app.config['AUDIT_ARCHIVE_DIR']
+
+def archive_path(month):
+    """Archive file for a (year, month) tuple"""
+    return os.path.join(get_archive_dir(), f"{ARCHIVE_FILE_PREFIX}{month[0]:04d}-{month[1]:02d}{ARCHIVE_FILE_SUFFIX}")
+
+def index_path(month):
+    """Block index kept next to a month's archive file"""
+    return archive_path(month)[:-len(ARCHIVE_FILE_SUFFIX)] + INDEX_FILE_SUFFIX
+
+def list_archive_months():
+    """Return archived (year, month) tuples, newest first"""
+    months = []
+    for path in glob.glob(os.path.join(get_archive_dir(), f"{ARCHIVE_FILE_PREFIX}*{ARCHIVE_FILE_SUFFIX}")):
+        name = os.path.basename(path)[len(ARCHIVE_FILE_PREFIX):-len(ARCHIVE_FILE_SUFFIX)]
+        try:
+            year, month = name.split('-')
+            months.append((int(year), int(month)))
+        except ValueError:
+            logger.warning(f"Ignoring unexpected audit archive file: {path}")
+    return sorted(months, reverse=True)
+
+def _serialize(log):
+    return {
+        'id': log.id,
+        'timestamp': log.timestamp.isoformat(),
+        'user_id': log.user_id,
+        'username': log.user.username if log.user else None,
+        'user_name': log.user.name if log.user else None,
+        'action': log.action,
+        'description': log.description,
+        'school_id': log.school_id,
+        'school_name': log.school.name if log.school else None,
+        'target_user_id': log.target_user_id,
+        'ip_address': log.ip_address,
+        'user_agent': log.user_agent
+    }
+
+def archive_audit_logs(retention_days=None, chunk_size=None):
+    """Move audit rows older than the retention period into monthly gzip NDJSON files"""
+    retention_days = retention_days or current_app.config['AUDIT_LOG_RETENTION_DAYS']
+    chunk_size = chunk_size or current_app.config['AUDIT_ARCHIVE_CHUNK_SIZE']
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    os.makedirs(get_archive_dir(), exist_ok=True)
+
+    archived = 0
+    while True:
+        logs = AuditLog.query.options(joinedload(AuditLog.user), joinedload(AuditLog.school))\
+            .filter(AuditLog.timestamp < cutoff)\
+            .order_by(AuditLog.timestamp, AuditLog.id)\
+            .limit(chunk_size)\
+            .all()
+
+        if not logs:
+            break
+
+        by_month = {}
+        for log in logs:
+            by_month.setdefault((log.timestamp.year, log.timestamp.month), []).append(_serialize(log))
+
+        # ابتدا فایل نوشته می‌شود و سپس ردیف‌ها حذف می‌شوند؛ در صورت قطع شدن،
+        # ردیف‌های تکراری هنگام خواندن بر اساس id حذف می‌شوند
+        for month, records in by_month.items():
+            with _month_lock(month, exclusive=True), \
+                    gzip.open(archive_path(month), 'at', encoding='utf-8') as archive:
+                for record in records:
+                    archive.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        ids = [log.id for log in logs]
+        db.session.expunge_all()
+        AuditLog.query.filter(AuditLog.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        archived += len(ids)
+        logger.info(f"Archived {len(ids)} audit log rows older than {cutoff:%Y-%m-%d}")
+
+    # ماه‌های تازه نوشته‌شده و بایگانی‌های قدیمی بدون فهرست یکجا فشرده می‌شوند
+    for month in list_archive_months():
+        if _stale(month, _read_index(month)):
+            compact_month(month)
+
+    return archived
+
+@contextmanager
+def _month_lock(month, exclusive=False):
+    """flock on a month's lock file: appends and compaction are exclusive, page reads shared"""
+    path = archive_path(month)[:-len(ARCHIVE_FILE_SUFFIX)] + LOCK_FILE_SUFFIX
+    handle = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(handle)
+
+def _read_records(path):
+    # عضو ناقص از یک append قطع‌شده کنار گذاشته می‌شود؛ ردیف‌هایش هنوز در جدول هستند
+    with open(path, 'rb') as archive:
+        text = _gzip_members(archive.read()).decode('utf-8')
+    records = {}
+    for line in text.splitlines():
+        if line.strip():
+            record = json.loads(line)
+            records[record['id']] = record
+    return records
+
+def _write_atomic(path, write):
+    """Write a file next to path and move it into place, so readers never see half of it"""
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            write(output)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def compact_month(month, block_size=None):
+    """Rewrite a month's archive deduplicated and ordered by (timestamp, id) in indexed blocks.
+
+    Each block of AUDIT_ARCHIVE_BLOCK_SIZE rows is its own gzip member, so the
+    file is still one valid gzip stream, and the sidecar index records each
+    block's byte range and first/last (timestamp, id). A page then decompresses
+    only the blocks around its cursor instead of the whole month.
+
+    Only the archiver calls this, under the month's exclusive lock; readers never
+    rewrite an archive.
+    """
+    path = archive_path(month)
+    block_size = block_size or current_app.config['AUDIT_ARCHIVE_BLOCK_SIZE']
+
+    with _month_lock(month, exclusive=True):
+        # isoformat میکروثانیه صفر را حذف می‌کند، پس مرتب‌سازی روی datetime است نه رشته
+        records = sorted(_read_records(path).values(),
+                         key=lambda record: (datetime.fromisoformat(record['timestamp']), record['id']))
+
+        blocks = []
+
+        def write_blocks(output):
+            for start in range(0, len(records), block_size):
+                chunk = records[start:start + block_size]
+                data = gzip.compress(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in chunk).encode('utf-8'))
+                blocks.append({
+                    'offset': output.tell(),
+                    'length': len(data),
+                    'first': [chunk[0]['timestamp'], chunk[0]['id']],
+                    'last': [chunk[-1]['timestamp'], chunk[-1]['id']]
+                })
+                output.write(data)
+
+        _write_atomic(path, write_blocks)
+        index = {'size': os.path.getsize(path), 'blocks': blocks}
+        _write_atomic(index_path(month), lambda output: output.write(json.dumps(index).encode('utf-8')))
+
+    logger.info(f"Indexed audit archive {month[0]:04d}-{month[1]:02d}: {len(records)} rows in {len(blocks)} blocks")
+    return index
+
+def _read_index(month):
+    """The month's block index as written by compact_month, or None"""
+    try:
+        with open(index_path(month), encoding='utf-8') as index_file:
+            index = json.load(index_file)
+        if index['size'] <= os.path.getsize(archive_path(month)):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def _stale(month, index):
+    """True when rows were appended after the index was written (or there is no index)"""
+    return index is None or index['size'] != os.path.getsize(archive_path(month))
+
+def _gzip_members(data):
+    """Decompress complete gzip members; a member still being appended is left out"""
+    output = []
+    while data:
+        member = zlib.decompressobj(wbits=31)
+        try:
+            text = member.decompress(data)
+        except zlib.error:
+            break
+        if not member.eof:
+            break
+        output.append(text)
+        data = member.unused_data
+    return b''.join(output)
+
+def _read_tail(month, index):
+    """Rows appended after the index was written, read-only and ordered by (timestamp, id)"""
+    with open(archive_path(month), 'rb') as archive:
+        archive.seek(index['size'] if index else 0)
+        data = archive.read()
+
+    records = {}
+    for line in _gzip_members(data).decode('utf-8').splitlines():
+        if line.strip():
+            record = json.loads(line)
+            records[record['id']] = record
+    logs = [ArchivedAuditLog(record) for record in records.values()]
+    logs.sort(key=lambda log: (log.timestamp, log.id))
+    return logs
+
+def _block_key(key):
+    return (datetime.fromisoformat(key[0]), key[1])
+
+def _read_block(path, block):
+    with open(path, 'rb') as archive:
+        archive.seek(block['offset'])
+        data = gzip.decompress(archive.read(block['length']))
+    return [ArchivedAuditLog(json.loads(line)) for line in data.decode('utf-8').splitlines() if line.strip()]
+
+def _month_blocks(blocks, position, newer, filters):
+    """Index blocks in reading order, starting at the one holding the cursor position"""
+    if not position:
+        selected = blocks if newer else blocks[::-1]
+    elif newer:
+        # اولین بلوکی که ردیفی بعد از cursor دارد
+        start = bisect.bisect_right([_block_key(block['last']) for block in blocks], position)
+        selected = blocks[start:]
+    else:
+        # آخرین بلوکی که ردیفی قبل از cursor دارد
+        end = bisect.bisect_left([_block_key(block['first']) for block in blocks], position)
+        selected = blocks[:end][::-1]
+
+    # بلوک‌های کاملاً خارج از بازه تاریخ فیلتر باز نمی‌شوند
+    return [
+        block for block in selected
+        if not (filters.get('start') and _block_key(block['last'])[0] < filters['start'])
+        and not (filters.get('end') and _block_key(block['first'])[0] >= filters['end'])
+    ]
+
+def _month_logs(month, position, newer, filters):
+    """A month's rows in reading order: indexed blocks from the cursor merged with the unindexed tail"""
+    path = archive_path(month)
+    index = _read_index(month)
+    blocks = _month_blocks(index['blocks'] if index else [], position, newer, filters)
+    tail = _read_tail(month, index) if _stale(month, index) else []
+    if not newer:
+        tail.reverse()
+
+    def block_logs():
+        for block in blocks:
+            logs = _read_block(path, block)
+            yield from (logs if newer else reversed(logs))
+
+    previous = None
+    for log in heapq.merge(block_logs(), tail, key=lambda log: (log.timestamp, log.id), reverse=not newer):
+        # ردیفی که هم در بلوک‌ها و هم در انتهای فایل آمده یک بار خوانده می‌شود
+        key = (log.timestamp, log.id)
+        if key != previous:
+            previous = key
+            yield log
+
+def _matches(log, filters):
+    if filters.get('action') and log.action != filters['action']:
+        return False
+    if filters.get('school_id') and log.school_id != filters['school_id']:
+        return False
+    if filters.get('user_id') is not None and log.user_id != filters['user_id']:
+        return False
+    if filters.get('target_user_id') is not None and log.target_user_id != filters['target_user_id']:
+        return False
+    if filters.get('start') and log.timestamp < filters['start']:
+        return False
+    if filters.get('end') and log.timestamp >= filters['end']:
+        return False
+    return True
+
+def query_archived_audit_logs(filters, position=None, newer=False, limit=20):
+    """Read archived rows around a (timestamp, id) position, newest first unless newer=True.
+
+    The month index locates the block holding the position, so a page reads only
+    the blocks from the cursor onwards until it has limit rows. Rows appended
+    since the archiver last indexed a month are read from the end of the file;
+    nothing here writes to the archive.
+    """
+    months = list_archive_months()
+    if newer:
+        months.reverse()
+
+    results = []
+    for month in months:
+        month_start = datetime(month[0], month[1], 1)
+        month_end = datetime(month[0] + month[1] // 12, month[1] % 12 + 1, 1)
+
+        # ماه‌های خارج از بازه فیلتر یا موقعیت cursor خوانده نمی‌شوند
+        if filters.get('start') and month_end <= filters['start']:
+            continue
+        if filters.get('end') and month_start >= filters['end']:
+            continue
+        if position and not newer and month_start > position[0]:
+            continue
+        if position and newer and month_end <= position[0]:
+            continue
+
+        # فایل و فهرستش در حین خواندن جایگزین یا به آن اضافه نمی‌شوند
+        with _month_lock(month):
+            for log in _month_logs(month, position, newer, filters):
+                if position:
+                    key = (log.timestamp, log.id)
+                    if (newer and key <= position) or (not newer and key >= position):
+                        continue
+                if _matches(log, filters):
+                    results.append(log)
+                    if len(results) >= limit:
+                        return results
+
+    return results
+
+@click.command('audit-archive')
+@click.option('--days', type=int, default=None, help='Archive rows older than this many days')
+@click.option('--chunk-size', type=int, default=None, help='Rows moved per transaction')
+@with_appcontext
+def archive_command(days, chunk_size):
+    """Move old audit log rows into monthly compressed archives"""
+    archived = archive_audit_logs(retention_days=days, chunk_size=chunk_size)
+    click.echo(f"Archived {archived} audit log rows to {get_archive_dir()}")
@@ -1,57 +1,50 @@
-from flask import request, current_app
+from flask import request, current_app, has_request_context
 from app.models import db, AuditLog, User
-from datetime import datetime
+from app.utils.audit_writer import audit_writer
+from sqlalchemy import text, func, or_, and_
+from sqlalchemy.orm import joinedload
+from datetime import datetime, timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
 def log_audit_action(user_id, action, description, school_id=None, target_user_id=None, ip_address=None, user_agent=None):
-    """Log an audit action with proper validation and error handling"""
+    """Queue an audit action for the buffered writer with proper validation"""
     
     # ✅ بررسی پارامترهای اجباری
     if not all([isinstance(user_id, (int, str)), action, description]):
         logger.warning(f"Invalid parameters for audit log: user_id={user_id}, action={action}")
         return False
     
+    # ✅ بررسی وجود کاربر واقعی
+    if not user_id or str(user_id).strip() == '0':
+        logger.warning(f"Skipping audit log for invalid user ID: {user_id}")
+        return False
+    
     # ✅ استفاده از مقادیر پیش‌فرض برای request
     if ip_address is None:
-        ip_address = request.remote_addr if request else 'unknown'
+        ip_address = request.remote_addr if has_request_context() else 'unknown'
     
     if user_agent is None:
-        user_agent = request.user_agent.string if request else 'unknown'
+        user_agent = request.user_agent.string if has_request_context() else 'unknown'
     
     try:
-        # ✅ بررسی وجود کاربر واقعی
-        if not user_id or (isinstance(user_id, (int, str)) and str(user_id).strip() == '0'):
-            logger.warning(f"Skipping audit log for invalid user ID: {user_id}")
-            return False
-        
-        # ✅ بررسی وجود کاربر در دیتابیس
-        if not User.query.get(user_id):
-            logger.warning(f"Skipping audit log for non-existent user ID: {user_id}")
-            return False
-        
-        # ✅ ایجاد رکورد لاگ
-        log = AuditLog(
-            user_id=user_id,
-            action=action,
-            description=description,
-            school_id=school_id,
-            target_user_id=target_user_id,
-            ip_address=ip_address,
-            user_agent=user_agent
-        )
-        
-        db.session.add(log)
-        db.session.commit()
+        # ✅ رکورد بدون دسترسی به session درخواست ساخته می‌شود؛
+        # کلید خارجی user_id وجود کاربر را هنگام درج بررسی می‌کند
+        record = {
+            'user_id': int(user_id),
+            'action': action,
+            'description': description,
+            'timestamp': datetime.utcnow(),
+            'school_id': school_id,
+            'target_user_id': target_user_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent
+        }
         
-        logger.debug(f"Audit log created successfully: {action} by user {user_id}")
-        return True
+        return audit_writer.write(record)
         
     except Exception as e:
-        # ✅ رول‌بک در صورت خطا
-        db.session.rollback()
-        
         # ✅ لاگ دقیق خطا
         logger.error(f"Error logging audit action: {str(e)}", exc_info=True)
         
@@ -59,3 +52,159 @@ def log_audit_action(user_id, action, description, school_id=None, target_user_i
         current_app.logger.error(f"Audit log failed details - user_id: {user_id}, action: {action}, description: {description}")
         
         return False
+
+# === مرور گزارش فعالیت‌ها با صفحه‌بندی keyset ===
+AUDIT_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+APPROXIMATE_COUNT_CAP = 10000
+
+class AuditLogPage:
+    """One keyset page of audit log rows"""
+    
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=0, total_is_exact=True):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_exact = total_is_exact
+    
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+    
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+def encode_audit_cursor(log):
+    """Encode the (timestamp, id) position of a log row as a URL-safe cursor"""
+    return f"{log.timestamp.strftime(AUDIT_CURSOR_FORMAT)}-{log.id}"
+
+def decode_audit_cursor(cursor):
+    """Decode a cursor created by encode_audit_cursor, or return None if it is invalid"""
+    try:
+        timestamp, log_id = cursor.split('-', 1)
+        return datetime.strptime(timestamp, AUDIT_CURSOR_FORMAT), int(log_id)
+    except (AttributeError, ValueError):
+        return None
+
+def _resolve_user_id(value):
+    """Resolve a user filter given as an ID or a username"""
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    user_id = db.session.query(User.id).filter_by(username=value).scalar()
+    # کاربر ناموجود هیچ ردیفی را نباید برگرداند
+    return user_id if user_id is not None else -1
+
+def resolve_audit_log_filters(action=None, school_id=None, user=None, target_user=None, start_date=None, end_date=None):
+    """Normalize viewer filters into IDs and datetime bounds shared by the hot table and the archive"""
+    return {
+        'action': action or None,
+        'school_id': school_id or None,
+        'user_id': _resolve_user_id(user) if user else None,
+        'target_user_id': _resolve_user_id(target_user) if target_user else None,
+        'start': datetime.combine(start_date, datetime.min.time()) if start_date else None,
+        'end': datetime.combine(end_date, datetime.min.time()) + timedelta(days=1) if end_date else None
+    }
+
+def build_audit_log_query(filters):
+    """Build a filtered AuditLog query; every filter is served by a (column, timestamp) index"""
+    query = AuditLog.query
+    
+    if filters.get('action'):
+        query = query.filter(AuditLog.action == filters['action'])
+    if filters.get('school_id'):
+        query = query.filter(AuditLog.school_id == filters['school_id'])
+    if filters.get('user_id') is not None:
+        query = query.filter(AuditLog.user_id == filters['user_id'])
+    if filters.get('target_user_id') is not None:
+        query = query.filter(AuditLog.target_user_id == filters['target_user_id'])
+    if filters.get('start'):
+        query = query.filter(AuditLog.timestamp >= filters['start'])
+    if filters.get('end'):
+        query = query.filter(AuditLog.timestamp < filters['end'])
+    
+    return query
+
+def approximate_audit_log_count(query, filtered=True, cap=APPROXIMATE_COUNT_CAP):
+    """Return (count, is_exact) without scanning the whole audit log table"""
+    try:
+        if not filtered and db.engine.dialect.name == 'postgresql':
+            # آمار planner برای کل جدول کافی است و هزینه‌ای ندارد
+            estimate = db.session.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'audit_logs'")
+            ).scalar()
+            if estimate is not None and estimate >= 0:
+                return int(estimate), False
+        
+        capped = query.order_by(None).with_entities(AuditLog.id).limit(cap + 1).subquery()
+        count = db.session.query(func.count()).select_from(capped).scalar() or 0
+        if count > cap:
+            return cap, False
+        return count, True
+    
+    except Exception as e:
+        logger.error(f"Error estimating audit log count: {str(e)}")
+        return 0, False
+
+def fetch_audit_log_page(filters, cursor=None, direction='next', per_page=20):
+    """Fetch one page of audit logs ordered by (timestamp, id) descending using keyset pagination.
+    
+    Rows moved to the cold archive are always older than the hot table, so a page
+    continues into the archive once the hot rows run out (and starts there when
+    paging back towards newer rows from an archived position).
+    """
+    from app.utils.audit_archive import query_archived_audit_logs
+    
+    position = decode_audit_cursor(cursor) if cursor else None
+    newer = bool(position) and direction == 'prev'
+    query = build_audit_log_query(filters)
+    page_query = query.options(joinedload(AuditLog.user), joinedload(AuditLog.school))
+    
+    if newer:
+        timestamp, log_id = position
+        page_query = page_query.filter(or_(
+            AuditLog.timestamp > timestamp,
+            and_(AuditLog.timestamp == timestamp, AuditLog.id > log_id)
+        )).order_by(AuditLog.timestamp.asc(), AuditLog.id.asc())
+    else:
+        if position:
+            timestamp, log_id = position
+            page_query = page_query.filter(or_(
+                AuditLog.timestamp < timestamp,
+                and_(AuditLog.timestamp == timestamp, AuditLog.id < log_id)
+            ))
+        page_query = page_query.order_by(AuditLog.timestamp.desc(), AuditLog.id.desc())
+    
+    # یک ردیف اضافه برای تشخیص وجود صفحه بعد
+    if newer:
+        rows = query_archived_audit_logs(filters, position=position, newer=True, limit=per_page + 1)
+        if len(rows) <= per_page:
+            rows += page_query.limit(per_page + 1 - len(rows)).all()
+    else:
+        rows = page_query.limit(per_page + 1).all()
+        if len(rows) <= per_page:
+            archive_position = (rows[-1].timestamp, rows[-1].id) if rows else position
+            rows += query_archived_audit_logs(filters, position=archive_position, limit=per_page + 1 - len(rows))
+    
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    
+    if newer:
+        rows.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = position is not None, has_more
+    
+    filtered = any(value is not None for value in filters.values())
+    total, total_is_exact = approximate_audit_log_count(query, filtered=filtered)
+    
+    return AuditLogPage(
+        items=rows,
+        per_page=per_page,
+        next_cursor=encode_audit_cursor(rows[-1]) if rows and has_older else None,
+        prev_cursor=encode_audit_cursor(rows[0]) if rows and has_newer else None,
+        total=total,
+        total_is_exact=total_is_exact
+    )
@@ -0,0 +1,256 @@
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class DimensionInterner:
+    """Map repeated strings (user agents, IPs) to small integer keys, cached per process"""
+
+    def __init__(self, model_name, hashed=False, max_size=1024):
+        self.model_name = model_name
+        self.hashed = hashed
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest() if self.hashed else value
+
+    def get_id(self, value):
+        """Return the dimension row ID for value, inserting it on first sight"""
+        if not value:
+            return None
+
+        key = self._key(value)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        dimension_id = self._lookup_or_insert(key, value)
+
+        with self._lock:
+            self._cache[key] = dimension_id
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return dimension_id
+
+    def _lookup_or_insert(self, key, value):
+        from app import models
+
+        table = getattr(models, self.model_name).__table__
+        key_column = table.c.value_hash if self.hashed else table.c.value
+        row = {'value_hash': key, 'value': value} if self.hashed else {'value': value}
+
+        with db.engine.connect() as connection:
+            dimension_id = connection.execute(select(table.c.id).where(key_column == key)).scalar()
+            if dimension_id is not None:
+                connection.rollback()
+                return dimension_id
+
+            try:
+                dimension_id = connection.execute(table.insert().values(**row)).inserted_primary_key[0]
+                connection.commit()
+                return dimension_id
+            except IntegrityError:
+                # worker دیگری همزمان همین مقدار را درج کرده است
+                connection.rollback()
+                return connection.execute(select(table.c.id).where(key_column == key)).scalar()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+user_agent_interner = DimensionInterner('AuditUserAgent', hashed=True)
+ip_address_interner = DimensionInterner('AuditIpAddress')
+
+class AuditLogWriter:
+    """Buffer audit records in-process and bulk insert them on a separate connection"""
+
+    def __init__(self):
+        self.app = None
+        self.async_enabled = False
+        self.batch_size = 100
+        self.flush_interval = 0.5
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._atexit_registered = False
+
+    def init_app(self, app):
+        """Read writer settings from the app config"""
+        self.app = app
+        self.async_enabled = app.config.get('AUDIT_LOG_ASYNC', True) and not app.testing
+        self.batch_size = max(1, app.config.get('AUDIT_LOG_BATCH_SIZE', 100))
+        self.flush_interval = max(1, app.config.get('AUDIT_LOG_FLUSH_INTERVAL_MS', 500)) / 1000.0
+        self._queue = queue.Queue(maxsize=app.config.get('AUDIT_LOG_QUEUE_SIZE', 10000))
+        app.extensions['audit_writer'] = self
+
+        # هر init_app یا راه‌اندازی دوباره thread نباید یک handler دیگر اضافه کند
+        if not self._atexit_registered:
+            atexit.register(self.shutdown)
+            self._atexit_registered = True
+
+    @property
+    def queue_depth(self):
+        """Number of records waiting to be flushed"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def write(self, record):
+        """Queue one audit record (a dict of audit_logs columns) for insertion"""
+        if not self.async_enabled:
+            return self._write_batch([record])
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            # صف پر است؛ برای از دست نرفتن رکورد به صورت همزمان می‌نویسیم
+            logger.warning("Audit log queue is full - writing record synchronously")
+            return self._write_batch([record])
+
+    def _ensure_started(self):
+        """Start the flush thread lazily so each forked worker gets its own"""
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Collect up to batch_size records or wait flush_interval, then flush"""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write_batch(batch)
+
+        # تخلیه رکوردهای باقی‌مانده هنگام خاموش شدن
+        remaining_records = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                remaining_records.append(item)
+
+        for start in range(0, len(remaining_records), self.batch_size):
+            self._write_batch(remaining_records[start:start + self.batch_size])
+
+    def _write_batch(self, records):
+        """Bulk insert records in their own transaction, falling back to one row at a time"""
+        from app.models import AuditLog
+
+        if not records:
+            return True
+
+        with self.app.app_context():
+            table = AuditLog.__table__
+            try:
+                rows = [self._intern(record) for record in records]
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert(), rows)
+                logger.debug(f"Flushed {len(records)} audit log records")
+                return True
+
+            except SQLAlchemyError as e:
+                if len(records) == 1:
+                    logger.error(f"Dropping audit log record {records[0].get('action')} by user {records[0].get('user_id')}: {str(e)}")
+                    return False
+
+                # یک رکورد نامعتبر نباید کل دسته را از بین ببرد
+                logger.warning(f"Bulk audit insert failed, retrying {len(records)} records individually: {str(e)}")
+                results = [self._write_batch([record]) for record in records]
+                return all(results)
+
+    def _intern(self, record):
+        """Replace user agent and IP text with dimension keys"""
+        row = dict(record)
+        row['user_agent_id'] = user_agent_interner.get_id(row.pop('user_agent', None))
+        row['ip_address_id'] = ip_address_interner.get_id(row.pop('ip_address', None))
+        return row
+
+    def shutdown(self, timeout=5.0):
+        """Flush queued records and stop the writer thread"""
+        thread = self._thread
+        if thread is None or not thread.is_alive() or self._pid != os.getpid():
+            return
+
+        self._queue.put(_STOP)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning(f"Audit log writer did not drain within {timeout}s ({self.queue_depth} records left)")
+
+# Create global instance
+audit_writer = AuditLogWriter()
+
+# === مهاجرت ===
+# ستون‌های کلید بُعد و جدولی که به آن اشاره می‌کنند
+AUDIT_DIMENSION_COLUMNS = {'user_agent_id': 'audit_user_agents', 'ip_address_id': 'audit_ip_addresses'}
+# ایندکس‌های تک‌ستونی اولیه؛ ایندکس‌های ترکیبی (timestamp, id) و (action, timestamp) جایگزینشان شده‌اند
+REPLACED_AUDIT_INDEXES = ('ix_audit_logs_timestamp', 'ix_audit_logs_action')
+
+def ensure_audit_log_columns():
+    """Bring audit_logs tables created before interning and keyset pagination up to the model"""
+    from app.models import AuditLog
+
+    table = AuditLog.__table__
+    inspector = inspect(db.engine)
+    columns = {column['name'] for column in inspector.get_columns(table.name)}
+    missing = [name for name in AUDIT_DIMENSION_COLUMNS if name not in columns]
+    if missing:
+        with db.engine.begin() as connection:
+            for name in missing:
+                connection.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {name} INTEGER REFERENCES {AUDIT_DIMENSION_COLUMNS[name]} (id)'
+                ))
+        # ردیف‌های قبلی متن خود را در ستون‌های legacy نگه می‌دارند
+        logger.info(f"Added audit_logs.{', audit_logs.'.join(missing)}")
+
+    indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        index.create(db.engine, checkfirst=True)
+    replaced = [name for name in REPLACED_AUDIT_INDEXES if name in indexes]
+    if replaced:
+        with db.engine.begin() as connection:
+            for name in replaced:
+                connection.execute(text(f'DROP INDEX {name}'))
+        logger.info(f"Dropped replaced audit log indexes: {', '.join(replaced)}")
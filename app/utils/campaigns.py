@@ -0,0 +1,232 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, update, insert, func, literal, bindparam, exists
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, SmsCampaign, SmsCampaignRecipient, SmsOutbox, Student
+from app.utils.outbox import _metric_labels
+from app.utils.sms_outbox import sms_outbox, SMS_QUEUED
+from app.utils.sms_service import sms_service
+
+logger = logging.getLogger(__name__)
+
+RECIPIENT_STATUSES = ('pending', 'queued', 'sent', 'failed', 'cancelled')
+
+# === ساخت و کنترل ===
+def create_campaign(school, title, text, grade=None, created_by=None):
+    """Create a running campaign and its recipient list in the current transaction.
+
+    Recipients come from one INSERT ... SELECT over the normalized parent phones,
+    grouped by phone so siblings get a single message.
+    """
+    campaign = SmsCampaign(
+        school_id=school.id,
+        created_by=created_by,
+        title=title,
+        message=sms_service.message_templates['announcement'].format(school_name=school.name, text=text.strip()),
+        grade=grade or None
+    )
+    db.session.add(campaign)
+    db.session.flush()
+
+    source = (
+        select(literal(campaign.id), Student.parent_phone_normalized, func.min(Student.id), func.count(Student.id),
+               literal('pending'))
+        .where(Student.school_id == school.id, Student.parent_phone_normalized.isnot(None))
+        .group_by(Student.parent_phone_normalized)
+    )
+    if grade:
+        source = source.where(Student.grade == grade)
+
+    campaign.total_recipients = db.session.execute(
+        insert(SmsCampaignRecipient.__table__).from_select(
+            ['campaign_id', 'phone', 'student_id', 'student_count', 'status'], source
+        )
+    ).rowcount
+    if not campaign.total_recipients:
+        campaign.status = 'completed'
+        campaign.completed_at = datetime.utcnow()
+
+    db.session.info[sms_outbox.pending_key] = True
+    return campaign
+
+def _outbox_column(column):
+    """Correlated lookup of an outbox column for each recipient row"""
+    outbox = SmsOutbox.__table__
+    return select(column).where(outbox.c.id == SmsCampaignRecipient.__table__.c.outbox_id).scalar_subquery()
+
+def _campaign_outbox_ids(campaign_id):
+    recipients = SmsCampaignRecipient.__table__
+    return select(recipients.c.outbox_id).where(
+        recipients.c.campaign_id == campaign_id, recipients.c.status == 'queued'
+    ).scalar_subquery()
+
+def pause_campaign(campaign):
+    """Stop feeding recipients; messages already handed to the outbox are held too"""
+    if campaign.status != 'running':
+        return False
+    campaign.status = 'paused'
+    outbox = SmsOutbox.__table__
+    db.session.execute(
+        update(outbox).where(outbox.c.id.in_(_campaign_outbox_ids(campaign.id)), outbox.c.status == 'pending')
+        .values(status='held')
+    )
+    return True
+
+def resume_campaign(campaign):
+    if campaign.status != 'paused':
+        return False
+    campaign.status = 'running'
+    outbox = SmsOutbox.__table__
+    db.session.execute(
+        update(outbox).where(outbox.c.id.in_(_campaign_outbox_ids(campaign.id)), outbox.c.status == 'held')
+        .values(status='pending', next_attempt_at=datetime.utcnow())
+    )
+    db.session.info[sms_outbox.pending_key] = True
+    return True
+
+def cancel_campaign(campaign):
+    """Drop every recipient that has not been handed to the provider yet"""
+    if campaign.status not in ('running', 'paused'):
+        return False
+    outbox = SmsOutbox.__table__
+    recipients = SmsCampaignRecipient.__table__
+
+    db.session.execute(
+        update(outbox).where(outbox.c.id.in_(_campaign_outbox_ids(campaign.id)), outbox.c.status.in_(('pending', 'held')))
+        .values(status='coalesced', last_error='Campaign cancelled')
+    )
+    db.session.execute(
+        update(recipients).where(
+            recipients.c.campaign_id == campaign.id,
+            (recipients.c.status == 'pending')
+            | ((recipients.c.status == 'queued') & (_outbox_column(outbox.c.status) == 'coalesced'))
+        ).values(status='cancelled')
+    )
+    campaign.status = 'cancelled'
+    campaign.completed_at = datetime.utcnow()
+    return True
+
+def campaign_progress(campaign_ids):
+    """{campaign_id: {status: count}} for the recipient statuses of each campaign"""
+    if not campaign_ids:
+        return {}
+    recipients = SmsCampaignRecipient.__table__
+    progress = {campaign_id: dict.fromkeys(RECIPIENT_STATUSES, 0) for campaign_id in campaign_ids}
+    rows = db.session.execute(
+        select(recipients.c.campaign_id, recipients.c.status, func.count())
+        .where(recipients.c.campaign_id.in_(campaign_ids))
+        .group_by(recipients.c.campaign_id, recipients.c.status)
+    ).all()
+    for campaign_id, status, count in rows:
+        progress[campaign_id][status] = count
+    return progress
+
+# === ارسال ===
+def feed_campaigns(outbox):
+    """Outbox feeder: top the due queue up to one batch from running campaigns"""
+    campaigns = SmsCampaign.__table__
+    with db.engine.connect() as connection:
+        running = connection.execute(
+            select(campaigns.c.id, campaigns.c.school_id, campaigns.c.message)
+            .where(campaigns.c.status == 'running').order_by(campaigns.c.id)
+        ).all()
+    if not running:
+        return 0
+
+    refresh_campaigns([campaign.id for campaign in running])
+
+    # سرعت را سطل توکن ارائه‌دهنده تعیین می‌کند؛ اینجا فقط صف کوتاه نگه داشته می‌شود
+    capacity = outbox.batch_size - outbox.due_count(outbox.batch_size)
+    fed = 0
+    for campaign in running:
+        if capacity <= 0:
+            break
+        queued = _feed_campaign(campaign, capacity)
+        capacity -= queued
+        fed += queued
+    return fed
+
+def _feed_campaign(campaign, limit):
+    recipients = SmsCampaignRecipient.__table__
+    outbox = SmsOutbox.__table__
+    now = datetime.utcnow()
+    try:
+        with db.engine.begin() as connection:
+            candidates = connection.execute(
+                select(recipients.c.id, recipients.c.phone, recipients.c.student_id)
+                .where(recipients.c.campaign_id == campaign.id, recipients.c.status == 'pending')
+                .order_by(recipients.c.id).limit(limit)
+            ).all()
+
+            claimed = [
+                recipient for recipient in candidates
+                # اگر worker دیگری زودتر برداشته باشد rowcount صفر است
+                if connection.execute(
+                    update(recipients).where(recipients.c.id == recipient.id, recipients.c.status == 'pending')
+                    .values(status='queued')
+                ).rowcount
+            ]
+            if not claimed:
+                return 0
+
+            keys = {f"campaign:{campaign.id}:{recipient.id}": recipient.id for recipient in claimed}
+            connection.execute(outbox.insert(), [{
+                'idempotency_key': key,
+                'category': 'announcement',
+                'phone': recipient.phone,
+                'message': campaign.message,
+                'student_id': recipient.student_id,
+                'school_id': campaign.school_id,
+                'status': 'pending',
+                'attempts': 0,
+                'next_attempt_at': now,
+                'created_at': now,
+            } for key, recipient in zip(keys, claimed)])
+
+            outbox_ids = connection.execute(
+                select(outbox.c.idempotency_key, outbox.c.id).where(outbox.c.idempotency_key.in_(list(keys)))
+            ).all()
+            connection.execute(
+                update(recipients).where(recipients.c.id == bindparam('recipient_id'))
+                .values(outbox_id=bindparam('message_id')),
+                [{'recipient_id': keys[key], 'message_id': message_id} for key, message_id in outbox_ids]
+            )
+    except SQLAlchemyError as e:
+        logger.error(f"Could not queue recipients of campaign {campaign.id}: {str(e)}")
+        return 0
+
+    SMS_QUEUED.inc(len(claimed), **_metric_labels(campaign.school_id, 'announcement'))
+    return len(claimed)
+
+def refresh_campaigns(campaign_ids):
+    """Copy final outbox results onto queued recipients and complete finished campaigns"""
+    recipients = SmsCampaignRecipient.__table__
+    outbox = SmsOutbox.__table__
+    campaigns = SmsCampaign.__table__
+
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(recipients).where(
+                    recipients.c.campaign_id.in_(campaign_ids), recipients.c.status == 'queued',
+                    _outbox_column(outbox.c.status).in_(('sent', 'failed'))
+                ).values(status=_outbox_column(outbox.c.status), last_error=_outbox_column(outbox.c.last_error))
+            )
+            unfinished = exists().where(
+                recipients.c.campaign_id == campaigns.c.id, recipients.c.status.in_(('pending', 'queued'))
+            )
+            completed = connection.execute(
+                update(campaigns).where(campaigns.c.id.in_(campaign_ids), campaigns.c.status == 'running', ~unfinished)
+                .values(status='completed', completed_at=datetime.utcnow())
+            ).rowcount
+    except SQLAlchemyError as e:
+        logger.error(f"Could not refresh campaign progress: {str(e)}")
+        return 0
+
+    if completed:
+        logger.info(f"{completed} SMS campaigns completed")
+    return completed
+
+sms_outbox.register_feeder(feed_campaigns)
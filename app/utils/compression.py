@@ -0,0 +1,82 @@
+import gzip
+import logging
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli اختیاری است؛ بدون آن فقط gzip استفاده می‌شود
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/csv',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+}
+
+def available_encodings():
+    """Encodings this process can produce, preferred first"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def negotiate_encoding(encodings=None):
+    """Best encoding the client accepts among encodings, or None"""
+    encodings = encodings or available_encodings()
+    accepted = [encoding for encoding in encodings if request.accept_encodings[encoding]]
+    if not accepted:
+        return None
+    return max(accepted, key=lambda encoding: (request.accept_encodings[encoding], -encodings.index(encoding)))
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level['br'])
+    return gzip.compress(data, compresslevel=level['gzip'], mtime=0)
+
+def init_compression(app):
+    """Compress dynamic responses above COMPRESS_MIN_SIZE according to Accept-Encoding"""
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return
+
+    levels = {
+        'gzip': app.config.get('COMPRESS_GZIP_LEVEL', 6),
+        'br': app.config.get('COMPRESS_BR_LEVEL', 4),
+    }
+    min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+
+    @app.after_request
+    def compress_response(response):
+        # فایل‌ها (send_file) و پاسخ‌های stream شده دست نمی‌خورند
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+
+        compressed = compress(data, encoding, levels)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(compressed))
+
+        # بدنه تغییر کرده است؛ ETag قوی دیگر با بایت‌ها مطابقت ندارد
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        return response
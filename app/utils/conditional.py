@@ -0,0 +1,86 @@
+import hashlib
+import logging
+from functools import wraps
+
+from flask import request, make_response
+from sqlalchemy import inspect, text, update
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+def _make_etag(parts):
+    """Hash the endpoint, its arguments and the version parts into an ETag"""
+    payload = repr((request.path, sorted(request.args.items(multi=True)), parts))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def _http_datetime(value):
+    """HTTP dates have one-second resolution"""
+    return value.replace(microsecond=0) if value else None
+
+def latest_timestamp(*values):
+    """Newest of several optional timestamps, for Last-Modified"""
+    values = [value for value in values if value]
+    return max(values) if values else None
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def conditional_response(version_func):
+    """Answer GET requests with 304 Not Modified when the resource version is unchanged.
+
+    ``version_func`` receives the view arguments and returns ``(parts, last_modified)``
+    from cheap aggregate queries, or ``None`` to let the view handle the request
+    (missing entity, access denied). The heavy query and serializer only run when
+    the client's ``If-None-Match``/``If-Modified-Since`` validators are stale.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return f(*args, **kwargs)
+
+            version = version_func(*args, **kwargs)
+            if version is None:
+                return f(*args, **kwargs)
+
+            parts, last_modified = version
+            etag = _make_etag(parts)
+            last_modified = _http_datetime(last_modified)
+
+            if _not_modified(etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # پاسخ به کاربر وابسته است؛ فقط مرورگر می‌تواند آن را نگه دارد و باید اعتبارسنجی کند
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return decorated_function
+    return decorator
+
+# === مهاجرت ===
+def ensure_updated_at_columns():
+    """Add attendance/grades.updated_at to databases created before they existed, filled from created_at"""
+    from app.models import Attendance, Grade
+
+    for model in (Attendance, Grade):
+        table = model.__table__
+        columns = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+        if 'updated_at' in columns:
+            continue
+        with db.engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN updated_at TIMESTAMP'))
+            # ردیف‌های قدیمی از زمان ثبت خود نسخه می‌گیرند، نه از زمان مهاجرت
+            connection.execute(update(table).values(updated_at=table.c.created_at))
+        logger.info(f"Added {table.name}.updated_at")
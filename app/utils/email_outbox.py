@@ -0,0 +1,151 @@
+import logging
+import smtplib
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from flask_mail import Message, BadHeaderError
+
+from app.extensions import mail
+from app.models import db, EmailOutbox
+from app.utils.metrics import metrics
+from app.utils.outbox import OutboxSender, outbox_cli
+
+logger = logging.getLogger(__name__)
+
+# محتوای این دسته‌ها (لینک بازیابی رمز عبور) هرگز در لاگ نوشته نمی‌شود
+SECRET_CATEGORIES = frozenset({'password_reset'})
+
+EMAIL_QUEUED = metrics.counter('email_messages_queued_total', 'Emails added to the outbox', ('school', 'category'))
+EMAIL_SENT = metrics.counter('email_messages_sent_total', 'Emails accepted by the SMTP server', ('school', 'category'))
+EMAIL_FAILED = metrics.counter('email_messages_failed_total', 'Emails given up after EMAIL_MAX_ATTEMPTS',
+                               ('school', 'category'))
+EMAIL_RETRIED = metrics.counter('email_messages_retried_total', 'Failed attempts scheduled for another try',
+                                ('school', 'category'))
+EMAIL_COALESCED = metrics.counter('email_messages_coalesced_total', 'Emails replaced, withdrawn or merged into a digest',
+                                  ('school', 'category'))
+EMAIL_SMTP_SESSION = metrics.histogram('email_smtp_session_seconds', 'One SMTP connection sending a whole batch',
+                                       buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+class EmailOutboxSender(OutboxSender):
+    """Drain email_outbox; claiming, retries, coalescing and digests live in ``OutboxSender``.
+
+    Each batch goes out over a single SMTP connection (one handshake, STARTTLS and
+    login for up to EMAIL_OUTBOX_BATCH_SIZE messages). A message the server refuses
+    fails on its own; a connection that cannot be opened or drops mid-batch fails
+    the messages it did not deliver, which are retried later.
+    """
+
+    model = EmailOutbox
+    name = 'email'
+    label = 'Email'
+    noun = 'emails'
+    address_column = 'recipient'
+    payload_columns = ('recipient', 'subject', 'body')
+    defaults = {
+        'threads': 1,
+        'batch_size': 50,
+        'poll_seconds': 15,
+        'lease_seconds': 300,
+        'max_attempts': 5,
+        'retry_base_seconds': 60,
+        'retry_max_seconds': 3600,
+        'digest_batch_size': 500
+    }
+
+    queued_metric = EMAIL_QUEUED
+    sent_metric = EMAIL_SENT
+    failed_metric = EMAIL_FAILED
+    retried_metric = EMAIL_RETRIED
+    coalesced_metric = EMAIL_COALESCED
+
+    def __init__(self):
+        super().__init__()
+        self.active = False
+
+    def init_app(self, app):
+        self.active = app.config.get('EMAIL_ACTIVE', False)
+        if not self.active:
+            logger.info("Email delivery is disabled (mock mode)")
+        super().init_app(app)
+
+    def enqueue(self, recipient, subject, body, idempotency_key, category, student_id=None, school_id=None,
+                coalesce_key=None, digest_key=None, send_after=None):
+        """Add an email to the current transaction; False if the key was already queued.
+
+        A pending email with the same coalesce_key is replaced by this one.
+        """
+        return self._enqueue(
+            {'recipient': recipient, 'subject': subject[:200], 'body': body}, idempotency_key, category,
+            student_id=student_id, school_id=school_id, coalesce_key=coalesce_key, digest_key=digest_key,
+            send_after=send_after
+        )
+
+    # === ارسال ===
+    def _send(self, limit):
+        """Send one batch of due emails over one SMTP connection"""
+        rows = self.claim(limit)
+        if not rows:
+            return 0, 0
+        self._record_results(rows, self._deliver(rows), 'Not sent')
+        return len(rows), 0
+
+    def _deliver(self, rows):
+        """Send rows over one SMTP connection; returns {id: (sent, error)}"""
+        results = {}
+        if not self.active:
+            for row in rows:
+                # لینک بازیابی رمز عبور یک اعتبارنامه است و نباید در لاگ بماند
+                body = '[body not logged]' if row.category in SECRET_CATEGORIES else row.body
+                logger.info(f"[MOCK EMAIL] To: {row.recipient} - Subject: {row.subject}\n{body}")
+                results[row.id] = (True, None)
+            return results
+
+        started = time.monotonic()
+        try:
+            with mail.connect() as connection:
+                for row in rows:
+                    try:
+                        connection.send(Message(subject=row.subject, recipients=[row.recipient], body=row.body))
+                    except smtplib.SMTPServerDisconnected:
+                        raise
+                    except (smtplib.SMTPException, BadHeaderError) as e:
+                        # فقط همین گیرنده رد شده است؛ اتصال برای بقیه دسته باز می‌ماند
+                        results[row.id] = (False, str(e))
+                    else:
+                        results[row.id] = (True, None)
+        except (smtplib.SMTPException, OSError) as e:
+            logger.error(f"SMTP connection failed after {len(results)}/{len(rows)} emails: {str(e)}")
+            for row in rows:
+                results.setdefault(row.id, (False, f"SMTP connection failed: {str(e)}"))
+        EMAIL_SMTP_SESSION.observe(time.monotonic() - started)
+
+        sent = sum(1 for ok, _ in results.values() if ok)
+        logger.info(f"SMTP batch delivered {sent}/{len(rows)} emails")
+        return results
+
+    def _digest_values(self, digest_date, entries):
+        from app.utils.email_service import email_service
+        subject, body = email_service.build_digest(digest_date, entries)
+        return {'subject': subject, 'body': body}
+
+# Create global instance
+email_outbox = EmailOutboxSender()
+
+metrics.register_gauge('email_outbox_messages', 'Email outbox rows by status',
+                       lambda: [({'status': status}, count) for status, count in email_outbox.counts().items()])
+
+email_cli = outbox_cli(email_outbox)
+
+@email_cli.command('test')
+@click.argument('recipient')
+@with_appcontext
+def test_command(recipient):
+    """Queue a test email to recipient and send it now"""
+    email_outbox.enqueue(recipient, 'ایمیل آزمایشی', 'این یک ایمیل آزمایشی از سیستم مدیریت مدرسه است.',
+                         idempotency_key=f"test:{recipient}:{datetime.utcnow().isoformat()}", category='test')
+    # همین پروسه ارسال می‌کند؛ thread ارسال‌کننده راه‌اندازی نمی‌شود
+    db.session.info.pop(email_outbox.pending_key, None)
+    db.session.commit()
+    click.echo(f"Processed {email_outbox.process_due()} emails")
@@ -0,0 +1,119 @@
+import logging
+from datetime import date
+
+from email_validator import validate_email, EmailNotValidError
+
+from config import Config
+from app.utils.sms_service import sms_service, attendance_send_after
+
+logger = logging.getLogger(__name__)
+
+class EmailService:
+    """Builds parent and user emails and adds them to the email outbox.
+
+    Sending happens in ``email_outbox`` after commit, over one SMTP connection per
+    batch. With EMAIL_ACTIVE off the outbox only logs what it would send.
+    """
+
+    def __init__(self):
+        self.attendance_active = Config.EMAIL_ATTENDANCE_NOTIFICATIONS
+
+        # Subject and body templates
+        self.subject_templates = {
+            'absent': 'غیبت {student_name} - {date}',
+            'late': 'تأخیر {student_name} - {date}',
+            'digest': 'گزارش حضور و غیاب {date}',
+            'password_reset': 'بازیابی رمز عبور'
+        }
+        self.body_templates = {
+            'absent': 'ولی گرامی،\n\nدانش‌آموز {student_name} در تاریخ {date} غایب بوده است.',
+            'late': 'ولی گرامی،\n\nدانش‌آموز {student_name} در تاریخ {date} با تأخیر حضور پیدا کرده است.',
+            'digest': 'ولی گرامی،\n\n{text}',
+            'password_reset': (
+                'سلام {name}،\n\nبرای تعیین رمز عبور جدید روی لینک زیر کلیک کنید:\n{link}\n\n'
+                'این لینک تا {minutes} دقیقه معتبر است و فقط یک بار قابل استفاده است. '
+                'اگر شما درخواست بازیابی نداده‌اید، این ایمیل را نادیده بگیرید.'
+            )
+        }
+
+    def _validate_email(self, address):
+        """Normalized address, or None if it is not a valid email"""
+        if not address:
+            return None
+        try:
+            return validate_email(address.strip(), check_deliverability=False).normalized
+        except EmailNotValidError:
+            return None
+
+    def send_attendance_notification(self, parent_email, student_name, status, student_id=None, attendance_date=None):
+        """Queue an attendance email in the current transaction, like the SMS of the same name.
+
+        It goes out with the same delay, replaces a pending email for the same student
+        and day, is withdrawn when the student is marked present and is merged into a
+        daily digest with SMS_DIGEST_MODE.
+        """
+        if not self.attendance_active or not parent_email or not student_name:
+            return False
+
+        address = self._validate_email(parent_email)
+        if not address:
+            logger.warning(f"Invalid parent email for student {student_id} - attendance email not queued")
+            return False
+
+        attendance_date = attendance_date or date.today()
+        coalesce_key = f"{address}:{student_id or student_name}:{attendance_date.isoformat()}"
+
+        from app.utils.email_outbox import email_outbox
+        if status not in ['absent', 'late']:
+            email_outbox.withdraw(coalesce_key)
+            return False
+
+        values = {'student_name': student_name, 'date': attendance_date.strftime("%Y/%m/%d")}
+        return email_outbox.enqueue(
+            address,
+            self.subject_templates[status].format(**values),
+            self.body_templates[status].format(**values),
+            idempotency_key=f"attendance:{student_id or address}:{attendance_date.isoformat()}:{status}",
+            category=f"attendance_{status}",
+            student_id=student_id,
+            coalesce_key=coalesce_key[:150],
+            digest_key=f"{address}:{attendance_date.isoformat()}"[:120] if Config.SMS_DIGEST_MODE else None,
+            send_after=attendance_send_after()
+        )
+
+    def build_digest(self, digest_date, entries):
+        """(subject, body) for all (student_name, status) notifications of a parent on digest_date"""
+        return (
+            self.subject_templates['digest'].format(date=digest_date.strftime("%Y/%m/%d")),
+            self.body_templates['digest'].format(text=sms_service.build_digest_message(digest_date, entries))
+        )
+
+    def send_password_reset(self, user, link, idempotency_key):
+        """Queue a password reset link for user in the current transaction.
+
+        Nothing is queued while the outbox is in mock mode: the link would never reach
+        the user and only end up in the logs.
+        """
+        from app.utils.email_outbox import email_outbox
+        if not email_outbox.active:
+            logger.error(f"Email delivery is disabled - password reset for user {user.id} not queued")
+            return False
+
+        address = self._validate_email(user.email)
+        if not address:
+            logger.error(f"User {user.id} has no valid email - password reset not queued")
+            return False
+
+        return email_outbox.enqueue(
+            address,
+            self.subject_templates['password_reset'],
+            self.body_templates['password_reset'].format(
+                name=user.name, link=link, minutes=Config.PASSWORD_RESET_TOKEN_SECONDS // 60
+            ),
+            idempotency_key=idempotency_key,
+            category='password_reset',
+            school_id=user.school_id
+        )
+
+# Create global instance
+email_service = EmailService()
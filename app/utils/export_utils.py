@@ -1,52 +1,99 @@
+import tempfile
+from itertools import chain, islice
+
 import pandas as pd
-import io
-from flask import send_file
+from flask import send_file, current_app
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
 import logging
 
 logger = logging.getLogger(__name__)
 
-def export_to_excel(data, filename, sheet_name='Data'):
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def _dataframe_rows(df):
+    # NaN و NaT در اکسل سلول خالی می‌شوند
+    for row in df.itertuples(index=False, name=None):
+        yield [None if value is pd.NaT or (isinstance(value, float) and value != value) else value for value in row]
+
+def _rows_and_columns(data, columns):
+    """(header, iterator of row lists) for a DataFrame or an iterable of dicts or sequences"""
+    if isinstance(data, pd.DataFrame):
+        return [str(column) for column in data.columns], _dataframe_rows(data)
+
+    rows = iter(data)
+    first = next(rows, None)
+    if first is None:
+        return list(columns or []), iter(())
+
+    if isinstance(first, dict):
+        columns = list(columns or first.keys())
+        return columns, ([row.get(column) for column in columns] for row in chain([first], rows))
+    return list(columns or []), (list(row) for row in chain([first], rows))
+
+def _column_widths(header, sample, max_width):
+    """Width per column from the header and a sample of rows, not from every cell"""
+    widths = [len(str(title)) for title in header]
+    for row in sample:
+        for index, value in enumerate(row):
+            length = len(str(value)) if value is not None else 0
+            if index >= len(widths):
+                widths.append(length)
+            elif length > widths[index]:
+                widths[index] = length
+    return [min(width + 2, max_width) for width in widths]
+
+def export_to_excel(data, filename, sheet_name='Data', columns=None):
     """
     Export data to Excel file
-    
+
     Args:
-         List of dictionaries or DataFrame
+        data: DataFrame, list of dicts, or any iterable (e.g. a generator over a
+              query) of dicts or of row sequences
         filename: Output filename
         sheet_name: Excel sheet name
+        columns: Header row; required for sequences, selects and orders dict keys
+
+    Rows are written one at a time with openpyxl's write-only mode, so a generator
+    is never held in memory. Column widths come from the first EXPORT_WIDTH_SAMPLE_ROWS
+    rows. The workbook is saved to a temporary file that is streamed to the client
+    in chunks and removed when the response is closed.
     """
     try:
-        if not isinstance(data, pd.DataFrame):
-            df = pd.DataFrame(data)
-        else:
-            df = data.copy()
-        
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
-            
-            # Adjust column widths
-            worksheet = writer.sheets[sheet_name]
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-        
-        output.seek(0)
-        
-        return send_file(
+        header, rows = _rows_and_columns(data, columns)
+        sample = list(islice(rows, current_app.config.get('EXPORT_WIDTH_SAMPLE_ROWS', 200)))
+
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(title=sheet_name)
+
+        # در حالت write-only عرض ستون‌ها باید قبل از اولین ردیف تنظیم شود
+        widths = _column_widths(header, sample, current_app.config.get('EXPORT_MAX_COLUMN_WIDTH', 60))
+        for index, width in enumerate(widths):
+            worksheet.column_dimensions[get_column_letter(index + 1)].width = width
+
+        if header:
+            worksheet.append(header)
+        for row in chain(sample, rows):
+            worksheet.append(row)
+
+        output = tempfile.TemporaryFile()
+        try:
+            workbook.save(output)
+            size = output.tell()
+            output.seek(0)
+        except Exception:
+            output.close()
+            raise
+
+        response = send_file(
             output,
             download_name=filename,
             as_attachment=True,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype=XLSX_MIMETYPE
         )
-    
+        response.content_length = size
+        return response
+
     except Exception as e:
         logger.error(f"Error exporting to Excel: {str(e)}")
         raise
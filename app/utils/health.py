@@ -0,0 +1,109 @@
+import logging
+import os
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import text
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+# زمان شروع همین worker؛ هر worker گانیکورن ماژول را جداگانه بارگذاری می‌کند
+WORKER_STARTED_AT = datetime.utcnow()
+_WORKER_STARTED = time.monotonic()
+
+_queue_probes = {}
+
+def register_queue_probe(name, depth_func, limit_key=None):
+    """Report a backlog in readiness; limit_key names the config value that marks it unready"""
+    _queue_probes[name] = (depth_func, limit_key)
+
+def get_uptime():
+    return round(time.monotonic() - _WORKER_STARTED, 1)
+
+def get_pool_stats():
+    """Connection pool usage; pools without a fixed size (SQLite memory) report what they can"""
+    pool = db.engine.pool
+    stats = {'class': type(pool).__name__}
+
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+
+    max_overflow = getattr(pool, '_max_overflow', None)
+    if 'size' in stats and max_overflow is not None:
+        stats['max_overflow'] = max_overflow
+        capacity = stats['size'] + max(max_overflow, 0)
+        stats['capacity'] = capacity
+        stats['usage'] = round(stats.get('checkedout', 0) / capacity, 3) if capacity else None
+
+    return stats
+
+def check_database(timeout_ms):
+    """Run SELECT 1 on a raw connection, bounded by a statement timeout where supported"""
+    started = time.monotonic()
+    try:
+        with db.engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+            connection.execute(text('SELECT 1'))
+        return {'ok': True, 'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+    except Exception as e:
+        logger.error(f"Readiness database check failed: {str(e)}")
+        return {'ok': False, 'error': str(e), 'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+
+def get_liveness():
+    """Process-only status; no database or network I/O"""
+    return {
+        'status': 'alive',
+        'service': 'school-management-system',
+        'pid': os.getpid(),
+        'uptime_seconds': get_uptime(),
+        'timestamp': datetime.now().isoformat(),
+        'environment': current_app.config.get('FLASK_ENV', 'development')
+    }
+
+def get_readiness():
+    """Database, pool and backlog checks; returns (ready, report)"""
+    config = current_app.config
+    reasons = []
+
+    pool = get_pool_stats()
+    # وقتی همه اتصال‌ها در حال استفاده‌اند، checkout تا pool_timeout منتظر می‌ماند؛ بدون انتظار گزارش می‌شود
+    if pool.get('usage') is not None and pool['usage'] >= config['HEALTH_POOL_BUSY_RATIO']:
+        reasons.append(f"connection pool {pool['usage']:.0%} busy")
+        database = {'ok': None, 'skipped': 'pool busy'}
+    else:
+        database = check_database(config['HEALTH_DB_TIMEOUT_MS'])
+        if not database['ok']:
+            reasons.append('database unreachable')
+
+    queues = {}
+    for name, (depth_func, limit_key) in _queue_probes.items():
+        try:
+            depth = depth_func()
+        except Exception as e:
+            logger.error(f"Readiness probe {name} failed: {str(e)}")
+            queues[name] = {'depth': None, 'error': str(e)}
+            continue
+
+        limit = config.get(limit_key) if limit_key else None
+        queues[name] = {'depth': depth, 'limit': limit}
+        if limit is not None and depth is not None and depth >= limit:
+            reasons.append(f"{name} backlog {depth} >= {limit}")
+
+    ready = not reasons
+    return ready, {
+        'status': 'ready' if ready else 'unavailable',
+        'reasons': reasons,
+        'pid': os.getpid(),
+        'uptime_seconds': get_uptime(),
+        'started_at': WORKER_STARTED_AT.isoformat(),
+        'database': database,
+        'pool': pool,
+        'queues': queues,
+        'timestamp': datetime.now().isoformat()
+    }
@@ -0,0 +1,178 @@
+import logging
+import threading
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app.models import db, User, School, Teacher
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class UserIdentity:
+    """Read-only snapshot of the logged-in user, used as Flask-Login's current_user.
+
+    Holds what views check on every request (role, school, teacher profile) so no
+    query is needed for it. ``user``, ``school`` and ``teacher_profile`` load the
+    ORM rows on first access for views that need the full objects or edit them.
+    """
+
+    __slots__ = ('id', 'username', 'name', 'role', 'phone', 'email', 'is_active', 'created_at',
+                 'school_id', 'school_name', 'school_type', 'teacher_id')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"UserIdentity is read-only; change current_user.user.{name} instead")
+
+    # snapshot بین درخواست‌ها مشترک است؛ رکوردهای ORM از identity map نشست همین درخواست خوانده می‌شوند
+    @property
+    def user(self):
+        return db.session.get(User, self.id)
+
+    @property
+    def school(self):
+        return db.session.get(School, self.school_id) if self.school_id else None
+
+    @property
+    def teacher_profile(self):
+        return db.session.get(Teacher, self.teacher_id) if self.teacher_id else None
+
+    def set_password(self, password):
+        self.user.set_password(password)
+
+    @property
+    def is_super_admin(self):
+        return self.role == 'super_admin'
+
+    @property
+    def is_school_admin(self):
+        return self.role == 'school_admin'
+
+    @property
+    def is_teacher(self):
+        return self.role == 'teacher'
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, UserIdentity) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<UserIdentity {self.username} ({self.role})>'
+
+class IdentityCache:
+    """Per-worker LRU of UserIdentity snapshots keyed by user ID and version.
+
+    Writes to a user, their teacher profile or any school bump a version in this
+    worker, so edits made here are visible on the next request. Other workers pick
+    them up when their entry's TTL runs out.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._cache = TTLCache(max_size=2048, ttl=30)
+        self._versions = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('IDENTITY_CACHE_ENABLED', True)
+        self._cache = TTLCache(
+            max_size=app.config.get('IDENTITY_CACHE_SIZE', 2048),
+            ttl=app.config.get('IDENTITY_CACHE_TTL', 30)
+        )
+        app.extensions['identity_cache'] = self
+
+    def _key(self, user_id):
+        return (user_id, self._versions.get(user_id, 0), self._generation)
+
+    def get(self, user_id):
+        """Snapshot for user_id, loading it with a single query on a miss"""
+        if not self.enabled:
+            return load_identity(user_id)
+        key = self._key(user_id)
+        identity = self._cache.get(key)
+        if identity is None:
+            identity = load_identity(user_id)
+            if identity is not None:
+                self._cache.set(key, identity)
+        return identity
+
+    def bump_user(self, user_id):
+        if user_id is None:
+            return
+        with self._lock:
+            previous_key = self._key(user_id)
+            self._versions[user_id] = previous_key[1] + 1
+        self._cache.delete(previous_key)
+
+    def bump_all(self):
+        with self._lock:
+            self._generation += 1
+        self._cache.clear()
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+def load_identity(user_id):
+    """Build a UserIdentity from one query joining user, school and teacher profile"""
+    row = db.session.execute(
+        select(User.id, User.username, User.name, User.role, User.phone, User.email, User.is_active,
+               User.created_at, User.school_id, School.name, School.type, Teacher.id)
+        .outerjoin(School, User.school_id == School.id)
+        .outerjoin(Teacher, Teacher.user_id == User.id)
+        .where(User.id == user_id)
+    ).first()
+    if row is None:
+        return None
+    return UserIdentity(
+        id=row[0], username=row[1], name=row[2], role=row[3], phone=row[4], email=row[5],
+        is_active=row[6], created_at=row[7], school_id=row[8], school_name=row[9],
+        school_type=row[10], teacher_id=row[11]
+    )
+
+# Create global instance
+identity_cache = IdentityCache()
+
+def _user_changed(mapper, connection, target):
+    identity_cache.bump_user(target.id)
+
+def _teacher_changed(mapper, connection, target):
+    identity_cache.bump_user(target.user_id)
+
+def _school_changed(mapper, connection, target):
+    identity_cache.bump_all()
+
+def _bulk_identity_change(orm_execute_state):
+    """Query.update()/delete() skip mapper events; drop every cached identity instead"""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ in (User, School, Teacher):
+        identity_cache.bump_all()
+
+for operation in ('after_update', 'after_delete'):
+    event.listen(User, operation, _user_changed)
+    event.listen(School, operation, _school_changed)
+for operation in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Teacher, operation, _teacher_changed)
+
+event.listen(Session, 'do_orm_execute', _bulk_identity_change)
@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+
+from flask import request, has_request_context
+from sqlalchemy import update, delete, case, select, and_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app.extensions import db
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class MemoryThrottleStore:
+    """Single-process store, for tests and one-worker development servers"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, window):
+        """Count one failure in window; return (current_count, previous_count, locked_until)"""
+        with self._lock:
+            row_window, current, previous, locked_until = self._rows.pop(key, (window, 0, 0, 0.0))
+            current, previous = _roll(row_window, window, current, previous)
+            self._rows[key] = (window, current + 1, previous, locked_until)
+            # قدیمی‌ترین کلیدها حذف می‌شوند تا حافظه محدود بماند
+            while len(self._rows) > self.max_size:
+                self._rows.pop(next(iter(self._rows)))
+            return current + 1, previous, locked_until
+
+    def lock(self, key, locked_until):
+        with self._lock:
+            if key in self._rows:
+                window, current, previous, _ = self._rows[key]
+                self._rows[key] = (window, current, previous, locked_until)
+
+    def locked_until(self, key):
+        with self._lock:
+            row = self._rows.get(key)
+            return row[3] if row else 0.0
+
+    def clear(self, key):
+        with self._lock:
+            self._rows.pop(key, None)
+
+    def prune(self, oldest_window, now):
+        with self._lock:
+            stale = [key for key, row in self._rows.items() if row[0] < oldest_window and row[3] < now]
+            for key in stale:
+                del self._rows[key]
+            return len(stale)
+
+class DatabaseThrottleStore:
+    """Rows in login_throttles, updated atomically so every worker sees the same counts"""
+
+    @property
+    def table(self):
+        from app.models import LoginThrottle
+        return LoginThrottle.__table__
+
+    def hit(self, key, window):
+        table = self.table
+        # پنجره در همان UPDATE جابه‌جا می‌شود تا دو worker شمارش یکدیگر را بازنویسی نکنند
+        statement = update(table).where(table.c.key == key).values(
+            previous_count=case(
+                (table.c.window == window, table.c.previous_count),
+                (table.c.window == window - 1, table.c.current_count),
+                else_=0
+            ),
+            current_count=case((table.c.window == window, table.c.current_count + 1), else_=1),
+            window=window
+        )
+
+        with db.engine.begin() as connection:
+            if connection.execute(statement).rowcount == 0:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(table.insert().values(
+                            key=key, window=window, current_count=1, previous_count=0, locked_until=0
+                        ))
+                except IntegrityError:
+                    connection.execute(statement)
+
+            row = connection.execute(
+                select(table.c.current_count, table.c.previous_count, table.c.locked_until).where(table.c.key == key)
+            ).first()
+        return tuple(row)
+
+    def lock(self, key, locked_until):
+        table = self.table
+        with db.engine.begin() as connection:
+            connection.execute(update(table).where(table.c.key == key).values(locked_until=locked_until))
+
+    def locked_until(self, key):
+        table = self.table
+        with db.engine.connect() as connection:
+            value = connection.execute(select(table.c.locked_until).where(table.c.key == key)).scalar()
+        return value or 0.0
+
+    def clear(self, key):
+        table = self.table
+        with db.engine.begin() as connection:
+            connection.execute(delete(table).where(table.c.key == key))
+
+    def prune(self, oldest_window, now):
+        table = self.table
+        with db.engine.begin() as connection:
+            return connection.execute(
+                delete(table).where(and_(table.c.window < oldest_window, table.c.locked_until < now))
+            ).rowcount
+
+def _roll(row_window, window, current, previous):
+    """Shift the two fixed-window counters to the current window"""
+    if row_window == window:
+        return current, previous
+    if row_window == window - 1:
+        return 0, current
+    return 0, 0
+
+class LoginThrottle:
+    """Sliding-window failed-login limiter with an in-process LRU of active lockouts.
+
+    Counts are kept as two fixed windows (current and previous); the previous one is
+    weighted by how much of it still overlaps the sliding window, so each check and
+    each failure is O(1) and old counts expire without a sweep.
+    """
+
+    def __init__(self):
+        self.store = None
+        self.max_attempts = 5
+        self.max_attempts_per_ip = 0
+        self.window_seconds = 300
+        self.lockout_seconds = 300
+        self.negative_ttl = 5
+        self._locks = None
+        self._hits = 0
+
+    def init_app(self, app):
+        backend = app.config.get('LOGIN_THROTTLE_BACKEND', 'database')
+        self.store = MemoryThrottleStore() if backend == 'memory' else DatabaseThrottleStore()
+        self.max_attempts = app.config.get('LOGIN_MAX_ATTEMPTS', 5)
+        self.max_attempts_per_ip = app.config.get('LOGIN_MAX_ATTEMPTS_PER_IP', 0)
+        if self.max_attempts_per_ip > 0 and not app.config.get('PROXY_FIX_X_FOR', 0) \
+                and app.config.get('FLASK_ENV') == 'production':
+            # پشت proxy همه درخواست‌ها یک IP دارند و یک مهاجم همه را قفل می‌کند
+            logger.warning("LOGIN_MAX_ATTEMPTS_PER_IP is set without PROXY_FIX_X_FOR; "
+                           "every client shares the proxy address")
+        self.window_seconds = app.config.get('LOGIN_ATTEMPT_WINDOW_SECONDS', 300)
+        self.lockout_seconds = app.config.get('LOGIN_LOCKOUT_SECONDS', 300)
+        self.negative_ttl = app.config.get('LOGIN_THROTTLE_CACHE_SECONDS', 5)
+        self._locks = TTLCache(max_size=app.config.get('LOGIN_THROTTLE_CACHE_SIZE', 10000), ttl=self.lockout_seconds)
+        app.extensions['login_throttle'] = self
+
+    def _keys(self, username):
+        keys = [(f"user:{username.strip().lower()[:140]}", self.max_attempts)]
+        # remote_addr پشت proxy با ProxyFix (PROXY_FIX_X_FOR) آدرس واقعی کاربر است
+        if self.max_attempts_per_ip > 0 and has_request_context() and request.remote_addr:
+            keys.append((f"ip:{request.remote_addr}", self.max_attempts_per_ip))
+        return keys
+
+    def is_locked(self, username):
+        """True while the username or client IP is locked out; answered from memory when possible"""
+        now = time.time()
+        for key, _ in self._keys(username):
+            locked_until = self._locks.get(key)
+            if locked_until is None:
+                try:
+                    locked_until = self.store.locked_until(key)
+                except SQLAlchemyError as e:
+                    logger.error(f"Login throttle lookup failed for {key}: {str(e)}")
+                    locked_until = 0.0
+                # وضعیت «قفل نیست» هم چند ثانیه نگه داشته می‌شود تا هر درخواست به دیتابیس نرود
+                ttl = locked_until - now if locked_until > now else self.negative_ttl
+                self._locks.set(key, locked_until, ttl=ttl)
+            if locked_until > now:
+                return True
+        return False
+
+    def record_failure(self, username):
+        """Count a failed login; lock the key once the sliding-window estimate reaches its limit"""
+        now = time.time()
+        window = int(now // self.window_seconds)
+        elapsed = (now % self.window_seconds) / self.window_seconds
+
+        for key, limit in self._keys(username):
+            try:
+                current, previous, locked_until = self.store.hit(key, window)
+                if previous * (1 - elapsed) + current >= limit and locked_until <= now:
+                    locked_until = now + self.lockout_seconds
+                    self.store.lock(key, locked_until)
+                    logger.warning(f"Login locked for {key} until {time.strftime('%H:%M:%S', time.localtime(locked_until))}")
+                self._locks.set(key, locked_until, ttl=max(locked_until - now, self.negative_ttl))
+            except SQLAlchemyError as e:
+                logger.error(f"Login throttle update failed for {key}: {str(e)}")
+
+        self._hits += 1
+        if self._hits % 100 == 0:
+            self.prune()
+
+    def clear(self, username):
+        """Reset the username's counters after a successful login (the IP keeps its count)"""
+        key = self._keys(username)[0][0]
+        try:
+            self.store.clear(key)
+        except SQLAlchemyError as e:
+            logger.error(f"Login throttle reset failed for {key}: {str(e)}")
+        self._locks.delete(key)
+
+    def prune(self):
+        """Drop rows whose windows and lockouts have both expired"""
+        now = time.time()
+        oldest_window = int(now // self.window_seconds) - 1
+        try:
+            return self.store.prune(oldest_window, now)
+        except SQLAlchemyError as e:
+            logger.error(f"Login throttle prune failed: {str(e)}")
+            return 0
+
+# Create global instance
+login_throttle = LoginThrottle()
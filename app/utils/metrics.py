@@ -0,0 +1,200 @@
+import atexit
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, labels):
+    return ','.join(f'{name}="{_escape(labels.get(name, ""))}"' for name in labelnames)
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, amount=1, **labels):
+        if amount:
+            self.registry._add(self.name, _format_labels(self.labelnames, labels), amount)
+
+class Histogram:
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        label_text = _format_labels(self.labelnames, labels)
+        prefix = f'{label_text},' if label_text else ''
+        # شمارش تجمعی؛ هر سطل همه مقادیر کوچک‌تر از حد خود را دارد
+        for bound in self.buckets:
+            if value <= bound:
+                self.registry._add(f'{self.name}_bucket', f'{prefix}le="{_format_value(bound)}"', 1)
+        self.registry._add(f'{self.name}_sum', label_text, value)
+        self.registry._add(f'{self.name}_count', label_text, 1)
+
+class MetricsRegistry:
+    """Counters and histograms summed across every worker.
+
+    Increments only touch a dict in this process. ``flush`` adds the pending deltas to
+    metric_series rows every METRICS_FLUSH_SECONDS (and before each scrape), so the
+    metrics endpoint reports the same totals whichever worker serves it. Gauges are
+    read at scrape time from callables registered with ``register_gauge``.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.flush_seconds = 15
+        self._families = {}
+        self._gauges = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.flush_seconds = app.config.get('METRICS_FLUSH_SECONDS', 15)
+        app.extensions['metrics'] = self
+
+        if self.enabled:
+            def flush_at_exit():
+                with app.app_context():
+                    self.flush()
+
+            atexit.register(flush_at_exit)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames), 'counter')
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets), 'histogram')
+
+    def register_gauge(self, name, documentation, collect):
+        """collect() returns [(labels dict, value)] when the endpoint is scraped"""
+        self._gauges[name] = (documentation, collect)
+
+    def _register(self, metric, kind):
+        self._families[metric.name] = (metric, kind)
+        return metric
+
+    def _add(self, series, labels, amount):
+        if not self.enabled:
+            return
+        key = (series, labels)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    # === ثبت در دیتابیس ===
+    def maybe_flush(self):
+        """Flush when METRICS_FLUSH_SECONDS have passed since the last flush"""
+        if not self.enabled or time.monotonic() - self._last_flush < self.flush_seconds:
+            return 0
+        return self.flush()
+
+    def flush(self):
+        """Add this worker's pending deltas to the shared totals; returns series written"""
+        from app.models import MetricSeries
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        table = MetricSeries.__table__
+        try:
+            with db.engine.begin() as connection:
+                for (series, labels), delta in pending.items():
+                    condition = (table.c.name == series) & (table.c.labels == labels)
+                    if connection.execute(update(table).where(condition).values(value=table.c.value + delta)).rowcount:
+                        continue
+                    try:
+                        with connection.begin_nested():
+                            connection.execute(table.insert().values(name=series, labels=labels, value=delta))
+                    except IntegrityError:
+                        # worker دیگری همزمان ردیف را ساخت
+                        connection.execute(update(table).where(condition).values(value=table.c.value + delta))
+        except SQLAlchemyError as e:
+            logger.error(f"Metrics flush failed: {str(e)}")
+            with self._lock:
+                for key, delta in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+            return 0
+        return len(pending)
+
+    # === خروجی ===
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        from app.models import MetricSeries
+
+        self.flush()
+        table = MetricSeries.__table__
+        with db.engine.connect() as connection:
+            rows = connection.execute(select(table.c.name, table.c.labels, table.c.value)).all()
+
+        samples = {}
+        for series, labels, value in rows:
+            samples.setdefault(series, []).append((labels, value))
+
+        lines = []
+        for name in sorted(self._families):
+            metric, kind = self._families[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                lines.extend(self._sample_lines(name, sorted(samples.get(name, []))))
+            else:
+                lines.extend(self._sample_lines(f'{name}_bucket', sorted(samples.get(f'{name}_bucket', []), key=_bucket_order)))
+                lines.extend(self._sample_lines(f'{name}_sum', sorted(samples.get(f'{name}_sum', []))))
+                lines.extend(self._sample_lines(f'{name}_count', sorted(samples.get(f'{name}_count', []))))
+
+        for name in sorted(self._gauges):
+            documentation, collect = self._gauges[name]
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error(f"Gauge {name} failed: {str(e)}")
+                continue
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(self._sample_lines(name, [
+                (_format_labels(sorted(labels), labels), value) for labels, value in values
+            ]))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _sample_lines(series, samples):
+        return [
+            f'{series}{{{labels}}} {_format_value(value)}' if labels else f'{series} {_format_value(value)}'
+            for labels, value in samples
+        ]
+
+def _bucket_order(sample):
+    labels, _ = sample
+    rest, _, bound = labels.rpartition('le="')
+    bound = bound.rstrip('"')
+    return rest, math.inf if bound == '+Inf' else float(bound)
+
+# Create global instance
+metrics = MetricsRegistry()
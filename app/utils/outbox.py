@@ -0,0 +1,530 @@
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, update, delete, func, or_, and_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.models import db, Student
+from app.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_STATUSES = ('pending', 'sending', 'sent', 'failed', 'coalesced')
+
+# attribute -> config key after the channel prefix, e.g. threads -> SMS_OUTBOX_THREADS
+OUTBOX_SETTINGS = {
+    'threads': 'OUTBOX_THREADS',
+    'batch_size': 'OUTBOX_BATCH_SIZE',
+    'poll_seconds': 'OUTBOX_POLL_SECONDS',
+    'lease_seconds': 'OUTBOX_LEASE_SECONDS',
+    'max_attempts': 'MAX_ATTEMPTS',
+    'retry_base_seconds': 'RETRY_BASE_SECONDS',
+    'retry_max_seconds': 'RETRY_MAX_SECONDS',
+    'digest_batch_size': 'DIGEST_BATCH_SIZE'
+}
+
+_senders = []
+
+def _metric_labels(school_id, category):
+    return {'school': school_id or '', 'category': category}
+
+class OutboxSender:
+    """Drain one outbox table with a fixed number of sender threads per worker.
+
+    Rows are claimed with a conditional UPDATE, so several workers (or a separate
+    ``flask <channel> drain --forever`` process) can share the table without sending
+    a message twice. A row whose sender died is reclaimed after the lease expires.
+    Failures are retried with exponential backoff until MAX_ATTEMPTS.
+
+    Messages that share a coalesce key replace each other while still pending, and
+    due messages that share a digest key are merged into one message per parent and
+    day before each batch. Replaced and merged rows are kept as ``coalesced``.
+
+    Subclasses set the model, the channel name (config prefix and session keys), the
+    columns carrying the address and content, and the metrics, and implement
+    ``_send`` (the transport) and ``_digest_values`` (the merged message).
+    """
+
+    model = None
+    name = None
+    label = None
+    noun = 'messages'
+    statuses = OUTBOX_STATUSES
+    address_column = None
+    payload_columns = ()
+    defaults = {}
+
+    queued_metric = None
+    sent_metric = None
+    failed_metric = None
+    retried_metric = None
+    coalesced_metric = None
+    queue_delay_metric = None
+
+    def __init__(self):
+        self.app = None
+        for attribute, value in self.defaults.items():
+            setattr(self, attribute, value)
+        self.feeders = []
+        self._wake = threading.Event()
+        self._workers = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        _senders.append(self)
+
+    def init_app(self, app):
+        self.app = app
+        prefix = self.name.upper()
+        for attribute, key in OUTBOX_SETTINGS.items():
+            setattr(self, attribute, app.config.get(f'{prefix}_{key}', self.defaults[attribute]))
+        app.extensions[f'{self.name}_outbox'] = self
+
+        if self.threads > 0:
+            # ردیف‌های باقی‌مانده از اجرای قبلی هم با اولین درخواست ارسال می‌شوند
+            app.before_request(self.ensure_started)
+
+    @property
+    def pending_key(self):
+        """session.info flag that wakes the senders after commit"""
+        return f'{self.name}_outbox_pending'
+
+    @property
+    def metrics_key(self):
+        return f'{self.name}_metrics'
+
+    # === صف ===
+    def _enqueue(self, payload, idempotency_key, category, student_id=None, school_id=None,
+                 coalesce_key=None, digest_key=None, send_after=None):
+        """Add a row with payload columns to the current transaction; False if the key was already queued.
+
+        A pending row with the same coalesce_key is replaced by this one.
+        """
+        idempotency_key = idempotency_key[:150]
+        if school_id is None:
+            school_id = self._school_of(student_id)
+        labels = _metric_labels(school_id, category)
+        savepoint = db.session.begin_nested()
+        try:
+            superseded = self._supersede(coalesce_key, idempotency_key) if coalesce_key else 0
+            db.session.add(self.model(
+                idempotency_key=idempotency_key,
+                category=category,
+                student_id=student_id,
+                school_id=school_id,
+                coalesce_key=coalesce_key,
+                digest_key=digest_key,
+                next_attempt_at=send_after or datetime.utcnow(),
+                **payload
+            ))
+            savepoint.commit()
+        except IntegrityError:
+            # همان پیام قبلاً ثبت شده است؛ تراکنش اصلی دست نمی‌خورد
+            savepoint.rollback()
+            superseded = self._revive(idempotency_key, coalesce_key, digest_key, send_after) if coalesce_key else 0
+            if not superseded:
+                return False
+            # پیام برگشته دوباره شمرده نمی‌شود؛ فقط پیامی که جایش را گرفت
+            self._record_after_commit(self.coalesced_metric, superseded - 1, labels)
+        else:
+            self._record_after_commit(self.queued_metric, 1, labels)
+            self._record_after_commit(self.coalesced_metric, superseded, labels)
+
+        db.session.info[self.pending_key] = True
+        return True
+
+    def withdraw(self, coalesce_key):
+        """Drop the pending message for coalesce_key in the current transaction.
+
+        Each withdrawn row is counted under its own school and category (e.g.
+        attendance_absent), not under the status that withdrew it.
+        """
+        table = self.model.__table__
+        pending = db.session.execute(
+            select(table.c.id, table.c.category, table.c.school_id)
+            .where(table.c.coalesce_key == coalesce_key, table.c.status == 'pending')
+        ).all()
+
+        withdrawn = 0
+        for row in pending:
+            # ردیفی که در این فاصله برای ارسال برداشته شده، پس گرفته نمی‌شود
+            if db.session.execute(
+                update(table).where(table.c.id == row.id, table.c.status == 'pending')
+                .values(status='coalesced', last_error='Superseded by withdrawal')
+            ).rowcount:
+                withdrawn += 1
+                self._record_after_commit(self.coalesced_metric, 1, _metric_labels(row.school_id, row.category))
+        return withdrawn
+
+    def _school_of(self, student_id):
+        # دانش‌آموز معمولاً همین حالا در identity map نشست است و کوئری نمی‌زند
+        student = db.session.get(Student, student_id) if student_id else None
+        return student.school_id if student else None
+
+    def _record_after_commit(self, metric, amount, labels):
+        """Count amount once the current transaction commits"""
+        if amount:
+            db.session.info.setdefault(self.metrics_key, []).append((metric, amount, labels))
+
+    def _supersede(self, coalesce_key, idempotency_key):
+        table = self.model.__table__
+        conditions = [table.c.coalesce_key == coalesce_key, table.c.status == 'pending']
+        if idempotency_key:
+            conditions.append(table.c.idempotency_key != idempotency_key)
+        return db.session.execute(
+            update(table).where(*conditions)
+            .values(status='coalesced', last_error=f"Superseded by {idempotency_key or 'withdrawal'}"[:255])
+        ).rowcount
+
+    def _revive(self, idempotency_key, coalesce_key, digest_key, send_after):
+        """Bring back a replaced message when its status comes back (absent, late, absent).
+
+        Returns 1 + the number of messages it replaced, or 0 if there was nothing to revive.
+        """
+        table = self.model.__table__
+        savepoint = db.session.begin_nested()
+        superseded = self._supersede(coalesce_key, idempotency_key)
+        revived = db.session.execute(
+            update(table).where(table.c.idempotency_key == idempotency_key, table.c.status == 'coalesced')
+            .values(status='pending', last_error=None, digest_key=digest_key,
+                    next_attempt_at=send_after or datetime.utcnow())
+        ).rowcount
+        if revived:
+            savepoint.commit()
+            return 1 + superseded
+        savepoint.rollback()
+        return 0
+
+    def register_feeder(self, feeder):
+        """feeder(outbox) is called before each batch and returns how many rows it queued"""
+        if feeder not in self.feeders:
+            self.feeders.append(feeder)
+
+    def _feed(self):
+        for feeder in self.feeders:
+            try:
+                feeder(self)
+            except Exception as e:
+                logger.error(f"{self.label} outbox feeder {getattr(feeder, '__name__', feeder)} failed: {str(e)}")
+
+    def wake(self):
+        if self.threads > 0:
+            self.ensure_started()
+            self._wake.set()
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or self.threads <= 0:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # بعد از fork، threadهای پروسه والد وجود ندارند
+            self._pid = os.getpid()
+            self._workers = [
+                threading.Thread(target=self._run, name=f'{self.name}-sender-{index}', daemon=True)
+                for index in range(self.threads)
+            ]
+            for worker in self._workers:
+                worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    processed, retry_after = self._process(self.batch_size)
+                    metrics.maybe_flush()
+            except Exception as e:
+                logger.error(f"{self.label} outbox sender error: {str(e)}")
+                processed, retry_after = 0, 0
+            if retry_after:
+                # تا توکن بعدی صبر می‌شود؛ Event.wait در gevent فقط همین greenlet را نگه می‌دارد
+                self._wake.clear()
+                self._wake.wait(min(retry_after, self.poll_seconds))
+            elif not processed:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    # === ارسال ===
+    def _due_condition(self, now):
+        table = self.model.__table__
+        return or_(
+            and_(table.c.status == 'pending', table.c.next_attempt_at <= now),
+            and_(table.c.status == 'sending', table.c.claimed_at < now - timedelta(seconds=self.lease_seconds))
+        )
+
+    def due_count(self, limit):
+        """How many messages are due now, counting at most limit"""
+        table = self.model.__table__
+        with db.engine.connect() as connection:
+            return len(connection.execute(
+                select(table.c.id).where(self._due_condition(datetime.utcnow())).limit(limit)
+            ).all())
+
+    def claim(self, limit):
+        """Mark up to limit due messages as sending.
+
+        Returns rows with id, attempts, category, school_id, created_at and the payload columns.
+        """
+        table = self.model.__table__
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            candidates = connection.execute(
+                select(table.c.id).where(self._due_condition(now)).order_by(table.c.next_attempt_at).limit(limit)
+            ).scalars().all()
+
+            claimed = [
+                message_id for message_id in candidates
+                # اگر worker دیگری زودتر برداشته باشد rowcount صفر است
+                if connection.execute(
+                    update(table).where(table.c.id == message_id, self._due_condition(now))
+                    .values(status='sending', claimed_at=now, attempts=table.c.attempts + 1)
+                ).rowcount
+            ]
+            if not claimed:
+                return []
+            return connection.execute(
+                select(table.c.id, table.c.attempts, table.c.category, table.c.school_id, table.c.created_at,
+                       *(table.c[column] for column in self.payload_columns))
+                .where(table.c.id.in_(claimed)).order_by(table.c.id)
+            ).all()
+
+    def process_due(self, limit=None):
+        """Send one batch of due messages; returns how many were attempted"""
+        return self._process(limit or self.batch_size)[0]
+
+    def _process(self, limit):
+        """Send up to limit due messages; return (attempted, seconds to wait)"""
+        self._feed()
+        self.build_digests()
+        return self._send(limit)
+
+    def _send(self, limit):
+        """Claim and send up to limit due messages; return (attempted, seconds to wait)"""
+        raise NotImplementedError
+
+    def _record_results(self, rows, results, missing_error):
+        """Store {id: (sent, error)} for claimed rows in one transaction and count them"""
+        now = datetime.utcnow()
+        updates = []
+        for row in rows:
+            values = self._result_values(row.id, row.attempts, *results.get(row.id, (False, missing_error)))
+            labels = _metric_labels(row.school_id, row.category)
+            if values['status'] == 'sent':
+                self.sent_metric.inc(**labels)
+                if self.queue_delay_metric:
+                    self.queue_delay_metric.observe((now - row.created_at).total_seconds(), category=row.category)
+            elif values['status'] == 'failed':
+                self.failed_metric.inc(**labels)
+            else:
+                self.retried_metric.inc(**labels)
+            updates.append((row.id, values))
+        self._update_many(updates)
+
+    def build_digests(self):
+        """Merge due messages sharing a digest key into one message per parent and day"""
+        table = self.model.__table__
+        now = datetime.utcnow()
+        with db.engine.connect() as connection:
+            rows = connection.execute(
+                select(table.c.id, table.c.digest_key, table.c[self.address_column].label('address'),
+                       table.c.category, table.c.student_id, table.c.school_id)
+                .where(table.c.status == 'pending', table.c.attempts == 0,
+                       table.c.digest_key.isnot(None), table.c.next_attempt_at <= now)
+                .order_by(table.c.digest_key, table.c.id).limit(self.digest_batch_size)
+            ).all()
+
+        groups = {}
+        for row in rows:
+            groups.setdefault(row.digest_key, []).append(row)
+        # یک پیام تنها همان‌طور که هست ارسال می‌شود
+        groups = {key: members for key, members in groups.items() if len(members) > 1}
+        if not groups:
+            return 0
+
+        student_ids = {row.student_id for members in groups.values() for row in members if row.student_id}
+        names = dict(db.session.execute(
+            select(Student.id, Student.first_name + ' ' + Student.last_name).where(Student.id.in_(student_ids))
+        ).all()) if student_ids else {}
+
+        built = 0
+        for digest_key, members in groups.items():
+            digest_date = datetime.strptime(digest_key.rsplit(':', 1)[1], '%Y-%m-%d').date()
+            payload = self._digest_values(digest_date, [
+                (names.get(row.student_id, ''), row.category.rsplit('_', 1)[-1]) for row in members
+            ])
+            member_ids = [row.id for row in members]
+            try:
+                with db.engine.connect() as connection, connection.begin() as transaction:
+                    merged = connection.execute(
+                        update(table).where(table.c.id.in_(member_ids), table.c.status == 'pending', table.c.attempts == 0)
+                        .values(status='coalesced', last_error='Merged into daily digest')
+                    ).rowcount
+                    if merged != len(member_ids):
+                        # worker دیگری بخشی از گروه را برداشته است
+                        transaction.rollback()
+                        continue
+                    connection.execute(table.insert().values(
+                        idempotency_key=f"digest:{digest_key}:{member_ids[0]}"[:150],
+                        category='attendance_digest',
+                        school_id=members[0].school_id,
+                        next_attempt_at=now,
+                        **{self.address_column: members[0].address},
+                        **payload
+                    ))
+                built += 1
+                self.queued_metric.inc(**_metric_labels(members[0].school_id, 'attendance_digest'))
+                for row in members:
+                    self.coalesced_metric.inc(**_metric_labels(row.school_id, row.category))
+            except IntegrityError:
+                continue
+            except SQLAlchemyError as e:
+                logger.error(f"Could not build {self.label} digest {digest_key}: {str(e)}")
+        if built:
+            logger.info(f"Merged {sum(len(m) for m in groups.values())} {self.label} {self.noun} into {built} digests")
+        return built
+
+    def _digest_values(self, digest_date, entries):
+        """Payload columns of the digest for (student_name, status) entries"""
+        raise NotImplementedError
+
+    def _backoff(self, attempts):
+        delay = min(self.retry_base_seconds * (2 ** (attempts - 1)), self.retry_max_seconds)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _result_values(self, message_id, attempts, sent, error):
+        now = datetime.utcnow()
+        if sent:
+            return {'status': 'sent', 'sent_at': now, 'last_error': None}
+        if attempts >= self.max_attempts:
+            logger.error(f"{self.label} {message_id} failed permanently after {attempts} attempts: {error}")
+            return {'status': 'failed', 'last_error': (error or '')[:255]}
+        return {
+            'status': 'pending',
+            'last_error': (error or '')[:255],
+            'next_attempt_at': now + timedelta(seconds=self._backoff(attempts))
+        }
+
+    def _update_many(self, updates):
+        """Write (message_id, values) pairs for a whole batch in one transaction"""
+        table = self.model.__table__
+        try:
+            with db.engine.begin() as connection:
+                for message_id, values in updates:
+                    connection.execute(update(table).where(table.c.id == message_id).values(**values))
+        except SQLAlchemyError as e:
+            # ردیف‌ها بعد از پایان lease دوباره برداشته می‌شوند
+            logger.error(f"Could not record results for {len(updates)} {self.label} {self.noun}: {str(e)}")
+
+    # === وضعیت ===
+    def counts(self):
+        """Number of outbox rows per status"""
+        table = self.model.__table__
+        with db.engine.connect() as connection:
+            rows = connection.execute(select(table.c.status, func.count()).group_by(table.c.status)).all()
+        counts = dict.fromkeys(self.statuses, 0)
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def oldest_due_age(self):
+        """Seconds the oldest due, unsent message has been waiting; 0 when none is due"""
+        table = self.model.__table__
+        now = datetime.utcnow()
+        with db.engine.connect() as connection:
+            oldest = connection.execute(select(func.min(table.c.created_at)).where(self._due_condition(now))).scalar()
+        return (now - oldest).total_seconds() if oldest else 0
+
+    @property
+    def backlog(self):
+        """Messages waiting to be sent across all workers"""
+        table = self.model.__table__
+        with db.engine.connect() as connection:
+            return connection.execute(
+                select(func.count()).select_from(table).where(table.c.status.in_(('pending', 'sending')))
+            ).scalar()
+
+    def prune(self, retention_days):
+        """Delete finished messages older than the retention period"""
+        table = self.model.__table__
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        with db.engine.begin() as connection:
+            return connection.execute(
+                delete(table).where(table.c.status.in_(('sent', 'failed', 'coalesced')), table.c.created_at < cutoff)
+            ).rowcount
+
+    # === رویدادهای نشست ===
+    def _after_commit(self, session):
+        """Count what the committed transaction queued and wake the senders; True if metrics changed"""
+        recorded = session.info.pop(self.metrics_key, None)
+        for metric, amount, labels in recorded or ():
+            metric.inc(amount, **labels)
+        if session.info.pop(self.pending_key, False):
+            self.wake()
+        return bool(recorded)
+
+    def _forget(self, session):
+        session.info.pop(self.pending_key, None)
+        session.info.pop(self.metrics_key, None)
+
+def _wake_after_commit(session):
+    # RELEASE SAVEPOINT هم after_commit را اجرا می‌کند؛ تا commit تراکنش اصلی صبر می‌شود
+    if session.in_nested_transaction():
+        return
+    recorded = [sender._after_commit(session) for sender in _senders]
+    if any(recorded):
+        metrics.maybe_flush()
+
+def _forget_after_rollback(session, previous_transaction):
+    # ROLLBACK TO SAVEPOINT و flush ناموفق داخل آن هم اینجا می‌رسند؛ فقط لغو تراکنش اصلی صف را بی‌اثر می‌کند
+    if previous_transaction.parent is not None:
+        return
+    for sender in _senders:
+        sender._forget(session)
+
+event.listen(Session, 'after_commit', _wake_after_commit)
+event.listen(Session, 'after_soft_rollback', _forget_after_rollback)
+
+def outbox_cli(sender):
+    """Click group with drain, status and prune commands for sender"""
+
+    @click.group(sender.name, help=f"{sender.label} outbox commands")
+    def cli():
+        pass
+
+    @cli.command('drain', help=f"Send due outbox {sender.noun} from this process")
+    @click.option('--forever', is_flag=True, help='Keep polling, for a dedicated sender process')
+    @with_appcontext
+    def drain_command(forever):
+        sent = 0
+        while True:
+            processed, retry_after = sender._process(sender.batch_size)
+            metrics.maybe_flush()
+            sent += processed
+            if retry_after:
+                time.sleep(retry_after)
+            elif not processed:
+                if not forever:
+                    break
+                time.sleep(sender.poll_seconds)
+        click.echo(f"Processed {sent} {sender.noun}")
+
+    @cli.command('status', help="Show outbox row counts by status")
+    @with_appcontext
+    def status_command():
+        for status, count in sender.counts().items():
+            click.echo(f"{status}: {count}")
+
+    @cli.command('prune', help='Delete old sent and failed messages')
+    @click.option('--days', type=int, default=None, help=f'Keep {sender.noun} newer than this many days')
+    @with_appcontext
+    def prune_command(days):
+        days = days or current_app.config.get(f'{sender.name.upper()}_OUTBOX_RETENTION_DAYS', 30)
+        click.echo(f"Deleted {sender.prune(days)} {sender.noun}")
+
+    return cli
@@ -0,0 +1,171 @@
+import logging
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash, check_password_hash
+
+logger = logging.getLogger(__name__)
+
+class PasswordHasherBusy(RuntimeError):
+    """Too many password hashes are already queued in this worker"""
+
+def _gevent_active():
+    """True inside gunicorn gevent workers, where threading is monkey-patched"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+class PasswordHasher:
+    """Run scrypt/pbkdf2 on native threads so a gevent worker's event loop keeps serving.
+
+    Under gevent a gevent ThreadPool is used (the waiting greenlet yields to the
+    hub); otherwise a ThreadPoolExecutor. Pools are created lazily per process.
+
+    hashlib releases the GIL while hashing, so other greenlets run while a login
+    is being verified. At most ``queue_size`` hashes may wait per worker; beyond
+    that callers get PasswordHasherBusy instead of piling up.
+    """
+
+    def __init__(self):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.queue_size = 64
+        self.timeout = 10
+        self._executor = None
+        self._pool = None
+        self._pid = None
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._method_prefix = None
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+        self.workers = max(1, app.config.get('PASSWORD_HASH_WORKERS', 2))
+        self.queue_size = max(self.workers, app.config.get('PASSWORD_HASH_QUEUE_SIZE', 64))
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 10)
+        self._method_prefix = None
+        app.extensions['password_hasher'] = self
+
+    @property
+    def pending(self):
+        """Hashes queued or running in this worker"""
+        return self._pending
+
+    def _run(self, func, *args):
+        with self._pending_lock:
+            if self._pending >= self.queue_size:
+                raise PasswordHasherBusy(f"{self._pending} password hashes already pending")
+            self._pending += 1
+
+        try:
+            if self._pid != os.getpid():
+                # بعد از fork، pool پروسه والد قابل استفاده نیست
+                self._pid = os.getpid()
+                self._pool = None
+                self._executor = None
+
+            if _gevent_active():
+                if self._pool is None:
+                    from gevent.threadpool import ThreadPool
+                    self._pool = ThreadPool(self.workers)
+                from gevent import Timeout
+                try:
+                    return self._pool.spawn(func, *args).get(timeout=self.timeout)
+                except Timeout:
+                    # gevent.Timeout یک BaseException است و از except Exception ها رد می‌شود
+                    raise PasswordHasherBusy(f"Password hash did not finish within {self.timeout}s")
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+            try:
+                return self._executor.submit(func, *args).result(timeout=self.timeout)
+            except FutureTimeoutError:
+                raise PasswordHasherBusy(f"Password hash did not finish within {self.timeout}s")
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        if not password_hash:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    @property
+    def method_prefix(self):
+        """Method and cost segment produced by the configured method, e.g. scrypt:32768:8:1"""
+        if self._method_prefix is None:
+            # پارامترهای پیش‌فرض werkzeug فقط در خود هش مشخص می‌شوند
+            self._method_prefix = generate_password_hash('probe', self.method).split('$', 1)[0]
+        return self._method_prefix
+
+    def needs_rehash(self, password_hash):
+        """True when a stored hash was made with different method or cost parameters"""
+        return bool(password_hash) and password_hash.split('$', 1)[0] != self.method_prefix
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._pool is not None:
+            self._pool.kill()
+            self._pool = None
+
+# Create global instance
+password_hasher = PasswordHasher()
+
+@click.group('passwords')
+def passwords_cli():
+    """Password hashing commands"""
+
+@passwords_cli.command('bench')
+@click.option('--seconds', type=float, default=5.0, help='How long to run')
+@click.option('--concurrency', type=int, default=8, help='Simultaneous simulated logins')
+@click.option('--method', default=None, help='Hash method to measure instead of PASSWORD_HASH_METHOD')
+@with_appcontext
+def bench_command(seconds, concurrency, method):
+    """Measure password verifications per second for one worker with the current settings"""
+    hasher = PasswordHasher()
+    hasher.init_app(current_app)
+    if method:
+        hasher.method = method
+    hasher.queue_size = max(hasher.queue_size, concurrency)
+
+    stored = generate_password_hash('benchmark-password', hasher.method)
+    latencies = []
+    latencies_lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def login_loop():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            hasher.verify(stored, 'benchmark-password')
+            with latencies_lock:
+                latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=login_loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    hasher.shutdown()
+
+    ordered = sorted(latencies)
+    click.echo(f"method={stored.split('$', 1)[0]} hash_workers={hasher.workers} concurrency={concurrency}")
+    click.echo(f"logins/sec per worker: {len(latencies) / elapsed:.1f} ({len(latencies)} in {elapsed:.1f}s)")
+    if ordered:
+        click.echo(f"latency ms: median={statistics.median(ordered) * 1000:.1f} "
+                   f"p95={ordered[max(0, int(len(ordered) * 0.95) - 1)] * 1000:.1f} "
+                   f"max={ordered[-1] * 1000:.1f}")
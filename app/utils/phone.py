@@ -0,0 +1,131 @@
+import logging
+import re
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, inspect, select, text, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+# ارقام فارسی و عربی که در فایل‌های اکسل و فرم‌ها دیده می‌شوند
+_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '0123456789' * 2)
+_NON_DIGITS = re.compile(r'\D')
+
+def is_canonical_phone(phone):
+    """True for an already normalized mobile number (9xxxxxxxxx), checked without regex"""
+    return bool(phone) and len(phone) == 10 and phone[0] == '9' and phone.isdigit()
+
+def normalize_phone(phone):
+    """Canonical 10-digit Iranian mobile number (9xxxxxxxxx), or None if it is not one"""
+    if phone is None:
+        return None
+    phone = str(phone).strip()
+    if is_canonical_phone(phone):
+        return phone
+
+    # سلول عددی اکسل به صورت 9123456789.0 خوانده می‌شود
+    if phone.endswith('.0'):
+        phone = phone[:-2]
+    phone = _NON_DIGITS.sub('', phone.translate(_DIGITS))
+    if not phone:
+        return None
+
+    if phone.startswith('0098'):
+        phone = phone[4:]
+    elif phone.startswith('98') and len(phone) == 12:
+        phone = phone[2:]
+    if phone.startswith('0'):
+        phone = phone[1:]
+    if not phone.startswith('9'):
+        phone = '9' + phone
+
+    return phone if is_canonical_phone(phone) else None
+
+def format_phone_for_display(phone):
+    """Format phone number for display"""
+    if not phone:
+        return ''
+    canonical = normalize_phone(phone)
+    if canonical:
+        return f"۰{canonical}"
+    return _NON_DIGITS.sub('', str(phone))
+
+def students_for_parent(phone, school_id=None):
+    """Students whose parent phone matches phone in any format, via the indexed column"""
+    from app.models import Student
+
+    canonical = normalize_phone(phone)
+    if not canonical:
+        return []
+    query = Student.query.filter(Student.parent_phone_normalized == canonical)
+    if school_id is not None:
+        query = query.filter(Student.school_id == school_id)
+    return query.order_by(Student.id).all()
+
+# === مهاجرت ===
+def ensure_parent_phone_column():
+    """Add students.parent_phone_normalized and its index to databases created before it existed"""
+    from app.models import Student
+
+    table = Student.__table__
+    columns = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    if 'parent_phone_normalized' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN parent_phone_normalized VARCHAR(10)'))
+        logger.info("Added students.parent_phone_normalized")
+
+    for index in table.indexes:
+        if 'parent_phone_normalized' in index.columns:
+            index.create(db.engine, checkfirst=True)
+
+def backfill_parent_phones(batch_size=1000):
+    """Fill parent_phone_normalized for rows written before it was maintained; returns rows updated"""
+    from app.models import Student
+
+    table = Student.__table__
+    last_id = 0
+    total = 0
+    while True:
+        try:
+            with db.engine.begin() as connection:
+                rows = connection.execute(
+                    select(table.c.id, table.c.parent_phone)
+                    .where(table.c.id > last_id, table.c.parent_phone.isnot(None),
+                           table.c.parent_phone_normalized.is_(None))
+                    .order_by(table.c.id).limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+
+                values = [{'student_id': student_id, 'phone': normalize_phone(phone)} for student_id, phone in rows]
+                values = [value for value in values if value['phone']]
+                if values:
+                    # updated_at دست نمی‌خورد؛ این تغییر داده کاربر نیست
+                    connection.execute(
+                        update(table).where(table.c.id == bindparam('student_id'))
+                        .values(parent_phone_normalized=bindparam('phone'), updated_at=table.c.updated_at),
+                        values
+                    )
+        except SQLAlchemyError as e:
+            logger.error(f"Parent phone backfill failed: {str(e)}")
+            break
+        last_id = rows[-1].id
+        total += len(values)
+
+    if total:
+        logger.info(f"Normalized {total} parent phone numbers")
+    return total
+
+def migrate_parent_phones():
+    ensure_parent_phone_column()
+    return backfill_parent_phones(current_app.config.get('PHONE_BACKFILL_BATCH_SIZE', 1000))
+
+@click.command('phones-backfill')
+@with_appcontext
+def backfill_command():
+    """Add and fill the normalized parent phone column"""
+    click.echo(f"Normalized {migrate_parent_phones()} parent phone numbers")
@@ -0,0 +1,93 @@
+import logging
+import math
+import time
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from app.extensions import db
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Token bucket kept in a rate_limit_buckets row so every worker draws from one budget.
+
+    ``acquire`` never sleeps: it takes what is available now and says how long until
+    the next token, so callers can schedule the rest. Updates are compare-and-swap on
+    the previous refill time and retried when another worker got there first.
+    """
+
+    max_retries = 5
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+
+    @property
+    def table(self):
+        from app.models import RateLimitBucket
+        return RateLimitBucket.__table__
+
+    def _refilled(self, tokens, updated_at, now):
+        return min(self.burst, tokens + max(0.0, now - updated_at) * self.rate)
+
+    def acquire(self, count=1):
+        """Take up to count tokens; return (granted, seconds until the next token)"""
+        table = self.table
+        for _ in range(self.max_retries):
+            now = time.time()
+            try:
+                with db.engine.begin() as connection:
+                    row = connection.execute(
+                        select(table.c.tokens, table.c.updated_at).where(table.c.name == self.name)
+                    ).first()
+                    if row is None:
+                        try:
+                            with connection.begin_nested():
+                                connection.execute(table.insert().values(name=self.name, tokens=self.burst, updated_at=now))
+                        except IntegrityError:
+                            pass
+                        continue
+
+                    tokens = self._refilled(row.tokens, row.updated_at, now)
+                    granted = int(min(count, max(0, math.floor(tokens))))
+                    swapped = connection.execute(
+                        update(table)
+                        .where(table.c.name == self.name, table.c.updated_at == row.updated_at)
+                        .values(tokens=tokens - granted, updated_at=now)
+                    ).rowcount
+            except SQLAlchemyError as e:
+                logger.error(f"Rate limiter {self.name} unavailable: {str(e)}")
+                return 0, 1.0 / self.rate
+
+            if swapped:
+                remaining = tokens - granted
+                return granted, 0.0 if remaining >= 1 else (1 - remaining) / self.rate
+
+        # رقابت زیاد بین workerها؛ کمی بعد دوباره تلاش می‌شود
+        return 0, 1.0 / self.rate
+
+    def refund(self, count):
+        """Return tokens that were acquired but not used"""
+        if count <= 0:
+            return
+        table = self.table
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(update(table).where(table.c.name == self.name).values(tokens=table.c.tokens + count))
+        except SQLAlchemyError as e:
+            logger.error(f"Rate limiter {self.name} refund failed: {str(e)}")
+
+    def penalize(self, seconds):
+        """Grant nothing for the next seconds, e.g. after the provider answered 429"""
+        table = self.table
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    update(table).where(table.c.name == self.name)
+                    .values(tokens=-seconds * self.rate, updated_at=time.time())
+                )
+        except SQLAlchemyError as e:
+            logger.error(f"Rate limiter {self.name} penalty failed: {str(e)}")
+        logger.warning(f"Rate limiter {self.name} paused for {seconds:.0f}s")
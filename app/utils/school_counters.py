@@ -0,0 +1,149 @@
+import logging
+
+from sqlalchemy import event, inspect, select, update, delete, func
+
+from app.models import db, School, SchoolCounter, User, Teacher, Student, Class, SCHOOL_TYPES_FA
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+school_summary_cache = TTLCache(max_size=1, ttl=60)
+
+# مدل‌هایی که شمارش می‌شوند: (ستون شمارنده، شرط شمارش)
+COUNTED_MODELS = {
+    User: ('admins', lambda role: role == 'school_admin'),
+    Teacher: ('teachers', None),
+    Student: ('students', None),
+    Class: ('classes', None),
+}
+
+def _count_rows(connection, school_id):
+    """Compute a school's counters from scratch on the current connection"""
+    return {
+        'school_id': school_id,
+        'admins': connection.execute(select(func.count(User.id)).where(User.school_id == school_id, User.role == 'school_admin')).scalar(),
+        'teachers': connection.execute(select(func.count(Teacher.id)).where(Teacher.school_id == school_id)).scalar(),
+        'students': connection.execute(select(func.count(Student.id)).where(Student.school_id == school_id)).scalar(),
+        'classes': connection.execute(select(func.count(Class.id)).where(Class.school_id == school_id)).scalar(),
+    }
+
+def _bump(connection, school_id, column, delta):
+    """Apply a delta to one counter, creating the school's row if it is missing"""
+    if not school_id or not delta:
+        return
+
+    table = SchoolCounter.__table__
+    result = connection.execute(
+        update(table).where(table.c.school_id == school_id).values({column: table.c[column] + delta})
+    )
+    if result.rowcount == 0:
+        # ردیف شمارنده وجود ندارد؛ شمارش کامل شامل تغییر فعلی هم هست
+        connection.execute(table.insert().values(**_count_rows(connection, school_id)))
+
+    school_summary_cache.clear()
+
+def _is_counted(model, role):
+    predicate = COUNTED_MODELS[model][1]
+    return predicate is None or predicate(role)
+
+def _after_insert(mapper, connection, target):
+    model = mapper.class_
+    if _is_counted(model, getattr(target, 'role', None)):
+        _bump(connection, target.school_id, COUNTED_MODELS[model][0], 1)
+
+def _after_delete(mapper, connection, target):
+    model = mapper.class_
+    if _is_counted(model, getattr(target, 'role', None)):
+        _bump(connection, target.school_id, COUNTED_MODELS[model][0], -1)
+
+def _previous_value(state, attribute):
+    history = state.attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.object, attribute)
+
+def _after_update(mapper, connection, target):
+    model = mapper.class_
+    column = COUNTED_MODELS[model][0]
+    state = inspect(target)
+
+    old_school_id = _previous_value(state, 'school_id')
+    old_counted = _is_counted(model, _previous_value(state, 'role') if model is User else None)
+    new_counted = _is_counted(model, getattr(target, 'role', None))
+
+    if (old_school_id, old_counted) == (target.school_id, new_counted):
+        return
+
+    if old_counted:
+        _bump(connection, old_school_id, column, -1)
+    if new_counted:
+        _bump(connection, target.school_id, column, 1)
+
+def _after_school_insert(mapper, connection, target):
+    connection.execute(SchoolCounter.__table__.insert().values(school_id=target.id))
+    school_summary_cache.clear()
+
+def _before_school_delete(mapper, connection, target):
+    connection.execute(delete(SchoolCounter.__table__).where(SchoolCounter.__table__.c.school_id == target.id))
+    school_summary_cache.clear()
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    return value
+
+for counted_model in COUNTED_MODELS:
+    # بدون active_history مقدار قبلی ستون منقضی‌شده در history در دسترس نیست
+    event.listen(counted_model.school_id, 'set', _load_previous_value, active_history=True, retval=True)
+    event.listen(counted_model, 'after_insert', _after_insert)
+    event.listen(counted_model, 'after_delete', _after_delete)
+    event.listen(counted_model, 'after_update', _after_update)
+
+event.listen(User.role, 'set', _load_previous_value, active_history=True, retval=True)
+event.listen(School, 'after_insert', _after_school_insert)
+event.listen(School, 'before_delete', _before_school_delete)
+
+def create_missing_school_counters():
+    """Insert counter rows for schools that do not have one yet"""
+    missing = db.session.query(School.id)\
+        .outerjoin(SchoolCounter, SchoolCounter.school_id == School.id)\
+        .filter(SchoolCounter.school_id.is_(None))\
+        .all()
+
+    if not missing:
+        return 0
+
+    connection = db.session.connection()
+    for (school_id,) in missing:
+        connection.execute(SchoolCounter.__table__.insert().values(**_count_rows(connection, school_id)))
+    db.session.commit()
+    school_summary_cache.clear()
+
+    logger.info(f"Created counters for {len(missing)} schools")
+    return len(missing)
+
+def get_school_summaries():
+    """Schools with their maintained counters, ordered by name and cached per worker"""
+    def load():
+        rows = db.session.query(
+            School.id,
+            School.name,
+            School.type,
+            SchoolCounter.admins,
+            SchoolCounter.teachers,
+            SchoolCounter.students,
+            SchoolCounter.classes
+        ).outerjoin(SchoolCounter, SchoolCounter.school_id == School.id)\
+         .order_by(School.name)\
+         .all()
+
+        return [{
+            'id': row.id,
+            'name': row.name,
+            'type': row.type,
+            'type_fa': SCHOOL_TYPES_FA.get(row.type, row.type),
+            'admin_count': row.admins or 0,
+            'teacher_count': row.teachers or 0,
+            'student_count': row.students or 0,
+            'class_count': row.classes or 0
+        } for row in rows]
+
+    return school_summary_cache.get_or_set('schools', load)
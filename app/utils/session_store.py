@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import secrets
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, session
+from flask.cli import with_appcontext
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from flask_login import user_logged_in, user_logged_out
+from itsdangerous import Signer, BadSignature
+from sqlalchemy import update, delete, select
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.datastructures import CallbackDict
+
+from app.extensions import db
+from app.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session dict backed by a server_sessions row"""
+
+    def __init__(self, initial=None, sid=None, version=0, expires_at=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.expires_at = expires_at
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.rotate = False
+
+    def regenerate(self):
+        """Move the data to a fresh session ID when the response is saved"""
+        self.rotate = True
+        self.modified = True
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+def _hash_sid(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+class DatabaseSessionInterface(SessionInterface):
+    """Keep session data in the database so every worker and instance shares it.
+
+    The cookie holds ``<sid>.<version>`` signed with SECRET_KEY. Each write bumps
+    the version, so a worker's read cache keyed by (sid, version) can never serve
+    data another worker has since replaced. Unchanged sessions only touch the row
+    when its expiry is older than SESSION_REFRESH_SECONDS.
+    """
+
+    salt = 'server-session'
+
+    def __init__(self, app):
+        self.refresh_seconds = app.config.get('SESSION_REFRESH_SECONDS', 3600)
+        self.sweep_every = app.config.get('SESSION_SWEEP_EVERY', 500)
+        self.sweep_batch_size = app.config.get('SESSION_SWEEP_BATCH_SIZE', 1000)
+        self._cache = TTLCache(
+            max_size=app.config.get('SESSION_CACHE_SIZE', 10000),
+            ttl=app.config.get('SESSION_CACHE_TTL', 60)
+        )
+        self.permanent = app.config.get('SESSION_PERMANENT', True)
+        self._writes = 0
+
+    @property
+    def table(self):
+        from app.models import ServerSession as ServerSessionModel
+        return ServerSessionModel.__table__
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt, key_derivation='hmac')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie or not app.secret_key:
+            return ServerSession()
+
+        try:
+            sid, _, version = self._signer(app).unsign(cookie).decode().rpartition('.')
+            version = int(version)
+        except (BadSignature, ValueError, UnicodeDecodeError):
+            return ServerSession()
+
+        key = _hash_sid(sid)
+        row = self._cache.get((key, version))
+        if row is None:
+            table = self.table
+            try:
+                with db.engine.connect() as connection:
+                    row = connection.execute(
+                        select(table.c.data, table.c.version, table.c.expires_at).where(table.c.id == key)
+                    ).first()
+            except SQLAlchemyError as e:
+                logger.error(f"Session lookup failed: {str(e)}")
+                return ServerSession()
+            if row is None:
+                return ServerSession()
+            row = tuple(row)
+            self._cache.set((key, row[1]), row)
+
+        data, version, expires_at = row
+        if expires_at <= datetime.utcnow():
+            return ServerSession()
+
+        try:
+            initial = session_json_serializer.loads(data)
+        except ValueError:
+            logger.warning("Discarding unreadable session data")
+            return ServerSession()
+        return ServerSession(initial, sid=sid, version=version, expires_at=expires_at)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.rotate and not session.new:
+            self._delete(session.sid)
+            session.sid = None
+
+        if not session:
+            if session.modified and not session.new:
+                if session.sid:
+                    self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       httponly=self.get_cookie_httponly(app),
+                                       samesite=self.get_cookie_samesite(app))
+            return
+
+        now = datetime.utcnow()
+        expires_at = now + app.permanent_session_lifetime
+        if session.modified or session.new:
+            sid = session.sid or secrets.token_urlsafe(32)
+            version = session.version + 1
+            if not self._write(sid, session, version, expires_at):
+                return
+        elif session.expires_at < expires_at - timedelta(seconds=self.refresh_seconds):
+            # فقط زمان انقضا تمدید می‌شود؛ داده و نسخه همان است
+            sid, version = session.sid, session.version
+            self._touch(sid, version, expires_at)
+        else:
+            return
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(f"{sid}.{version}").decode(),
+            # بدون SESSION_PERMANENT کوکی با بستن مرورگر حذف می‌شود؛ ردیف تا expires_at می‌ماند
+            expires=expires_at if self.permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            partitioned=self.get_cookie_partitioned(app)
+        )
+
+    def _write(self, sid, session, version, expires_at):
+        table = self.table
+        key = _hash_sid(sid)
+        data = session_json_serializer.dumps(dict(session))
+        try:
+            with db.engine.begin() as connection:
+                updated = connection.execute(
+                    update(table).where(table.c.id == key).values(data=data, version=version, expires_at=expires_at)
+                ).rowcount
+                if not updated:
+                    connection.execute(table.insert().values(id=key, data=data, version=version, expires_at=expires_at))
+        except SQLAlchemyError as e:
+            logger.error(f"Session save failed: {str(e)}")
+            return False
+
+        self._cache.delete((key, session.version))
+        self._cache.set((key, version), (data, version, expires_at))
+        self._after_write()
+        return True
+
+    def _touch(self, sid, version, expires_at):
+        table = self.table
+        key = _hash_sid(sid)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(update(table).where(table.c.id == key).values(expires_at=expires_at))
+        except SQLAlchemyError as e:
+            logger.error(f"Session refresh failed: {str(e)}")
+            return
+        self._cache.delete((key, version))
+
+    def _delete(self, sid):
+        table = self.table
+        key = _hash_sid(sid)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(delete(table).where(table.c.id == key))
+        except SQLAlchemyError as e:
+            logger.error(f"Session delete failed: {str(e)}")
+
+    def _after_write(self):
+        self._writes += 1
+        if self.sweep_every and self._writes % self.sweep_every == 0:
+            sweep_expired_sessions(self.sweep_batch_size)
+
+def sweep_expired_sessions(batch_size=1000, max_batches=None):
+    """Delete expired sessions in batches so the table lock is never held for long"""
+    from app.models import ServerSession as ServerSessionModel
+    table = ServerSessionModel.__table__
+    now = datetime.utcnow()
+    total = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        expired = select(table.c.id).where(table.c.expires_at < now).limit(batch_size)
+        try:
+            with db.engine.begin() as connection:
+                deleted = connection.execute(delete(table).where(table.c.id.in_(expired))).rowcount
+        except SQLAlchemyError as e:
+            logger.error(f"Session sweep failed: {str(e)}")
+            break
+        total += deleted
+        batches += 1
+        if deleted < batch_size:
+            break
+
+    if total:
+        logger.info(f"Swept {total} expired sessions")
+    return total
+
+def init_session_store(app):
+    """Use the database session store unless SESSION_TYPE asks for plain signed cookies"""
+    session_type = app.config.get('SESSION_TYPE', 'sqlalchemy')
+    if session_type == 'cookie':
+        return
+    if session_type != 'sqlalchemy':
+        raise ValueError(f"Unsupported SESSION_TYPE: {session_type}")
+    app.session_interface = DatabaseSessionInterface(app)
+
+    # شناسه نشست هنگام ورود و خروج عوض می‌شود (جلوگیری از session fixation)
+    def rotate_session_id(sender, user, **extra):
+        if isinstance(session, ServerSession):
+            session.regenerate()
+
+    user_logged_in.connect(rotate_session_id, app, weak=False)
+    user_logged_out.connect(rotate_session_id, app, weak=False)
+
+@click.command('sessions-sweep')
+@click.option('--batch-size', type=int, default=None, help='Rows deleted per transaction')
+@with_appcontext
+def sweep_command(batch_size):
+    """Delete expired server-side sessions"""
+    batch_size = batch_size or current_app.config.get('SESSION_SWEEP_BATCH_SIZE', 1000)
+    deleted = sweep_expired_sessions(batch_size)
+    click.echo(f"Deleted {deleted} expired sessions")
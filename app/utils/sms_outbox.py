@@ -0,0 +1,141 @@
+import logging
+from datetime import datetime, timedelta
+
+from app.models import SmsOutbox
+from app.utils.metrics import metrics
+from app.utils.outbox import OutboxSender, OUTBOX_STATUSES, _metric_labels, outbox_cli
+from app.utils.rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+SMS_QUEUED = metrics.counter('sms_messages_queued_total', 'Messages added to the outbox', ('school', 'category'))
+SMS_SENT = metrics.counter('sms_messages_sent_total', 'Messages accepted by the provider', ('school', 'category'))
+SMS_FAILED = metrics.counter('sms_messages_failed_total', 'Messages given up after SMS_MAX_ATTEMPTS', ('school', 'category'))
+SMS_RETRIED = metrics.counter('sms_messages_retried_total', 'Failed attempts scheduled for another try', ('school', 'category'))
+SMS_COALESCED = metrics.counter('sms_messages_coalesced_total', 'Messages replaced, withdrawn or merged into a digest',
+                                ('school', 'category'))
+SMS_RATE_LIMIT_WAIT = metrics.histogram('sms_rate_limit_wait_seconds', 'Waits imposed by the provider token bucket or a 429',
+                                        ('provider',), buckets=(0.1, 0.25, 0.5, 1, 2, 5, 15, 30, 60, 300))
+SMS_QUEUE_DELAY = metrics.histogram('sms_queue_delay_seconds', 'Time from queueing to acceptance by the provider',
+                                    ('category',), buckets=(1, 5, 15, 60, 120, 300, 900, 3600, 14400, 86400))
+
+class SmsOutboxSender(OutboxSender):
+    """Drain sms_outbox; claiming, retries, coalescing and digests live in ``OutboxSender``.
+
+    Each batch takes one token from the provider's shared bucket per API call and
+    goes out through ``sms_service.send_batch`` (one sendarray request for up to
+    SMS_BATCH_SIZE recipients); when no token is left the threads wait for the next
+    one instead of sleeping inside a send.
+
+    Feeders registered with ``register_feeder`` run before each batch and may add
+    rows of their own, e.g. announcement campaigns topping up one batch at a time so
+    attendance messages never wait behind a whole school's recipients. Rows a feeder
+    parks as ``held`` are not sent until it sets them back to pending.
+    """
+
+    model = SmsOutbox
+    name = 'sms'
+    label = 'SMS'
+    statuses = OUTBOX_STATUSES + ('held',)
+    address_column = 'phone'
+    payload_columns = ('phone', 'message')
+    defaults = {
+        'threads': 2,
+        'batch_size': 100,
+        'poll_seconds': 15,
+        'lease_seconds': 300,
+        'max_attempts': 6,
+        'retry_base_seconds': 30,
+        'retry_max_seconds': 3600,
+        'digest_batch_size': 500
+    }
+
+    queued_metric = SMS_QUEUED
+    sent_metric = SMS_SENT
+    failed_metric = SMS_FAILED
+    retried_metric = SMS_RETRIED
+    coalesced_metric = SMS_COALESCED
+    queue_delay_metric = SMS_QUEUE_DELAY
+
+    def __init__(self):
+        super().__init__()
+        self.limiter = None
+
+    def init_app(self, app):
+        from app.utils.sms_service import sms_service
+        provider = sms_service.rate_limit_name.split(':', 1)[1]
+        limits = app.config.get('SMS_PROVIDER_RATE_LIMITS', {}).get(provider) or app.config.get(
+            'SMS_DEFAULT_RATE_LIMIT', {'rate': 5, 'burst': 10})
+        self.limiter = TokenBucket(sms_service.rate_limit_name, limits['rate'], limits['burst'])
+        super().init_app(app)
+
+    def enqueue(self, phone, message, idempotency_key, category, student_id=None, school_id=None,
+                coalesce_key=None, digest_key=None, send_after=None):
+        """Add a message to the current transaction; False if the key was already queued.
+
+        A pending message with the same coalesce_key is replaced by this one.
+        """
+        return self._enqueue(
+            {'phone': phone, 'message': message}, idempotency_key, category, student_id=student_id,
+            school_id=school_id, coalesce_key=coalesce_key, digest_key=digest_key, send_after=send_after
+        )
+
+    # === ارسال ===
+    def _send(self, limit):
+        """Send up to limit due messages within the rate limit; return (attempted, seconds to wait)"""
+        from app.utils.sms_service import sms_service, SMSRateLimited
+
+        # صف خالی توکنی مصرف نمی‌کند
+        if not self.due_count(1):
+            return 0, 0
+
+        # هر توکن یک فراخوانی API است که تا SMS_BATCH_SIZE گیرنده را می‌برد
+        calls = -(-limit // sms_service.batch_size)
+        granted, retry_after = self.limiter.acquire(calls)
+        if not granted:
+            SMS_RATE_LIMIT_WAIT.observe(retry_after, provider=self.provider)
+            return 0, retry_after
+
+        rows = self.claim(min(limit, granted * sms_service.batch_size))
+        self.limiter.refund(granted - -(-len(rows) // sms_service.batch_size))
+        if not rows:
+            return 0, 0
+
+        try:
+            results = sms_service.send_batch([(row.id, row.phone, row.message) for row in rows])
+        except SMSRateLimited as e:
+            # کل دسته بدون شمردن تلاش، بعد از مهلت ارائه‌دهنده دوباره ارسال می‌شود
+            SMS_RATE_LIMIT_WAIT.observe(e.retry_after, provider=self.provider)
+            self.limiter.penalize(e.retry_after)
+            self._update_many([
+                (row.id, {
+                    'status': 'pending',
+                    'attempts': row.attempts - 1,
+                    'next_attempt_at': datetime.utcnow() + timedelta(seconds=e.retry_after)
+                })
+                for row in rows
+            ])
+            return 0, e.retry_after
+        except Exception as e:
+            results = {row.id: (False, str(e)) for row in rows}
+
+        self._record_results(rows, results, 'Provider rejected the message or was unreachable')
+        return len(rows), 0
+
+    @property
+    def provider(self):
+        return self.limiter.name.split(':', 1)[-1] if self.limiter else ''
+
+    def _digest_values(self, digest_date, entries):
+        from app.utils.sms_service import sms_service
+        return {'message': sms_service.build_digest_message(digest_date, entries)}
+
+# Create global instance
+sms_outbox = SmsOutboxSender()
+
+metrics.register_gauge('sms_outbox_messages', 'Outbox rows by status',
+                       lambda: [({'status': status}, count) for status, count in sms_outbox.counts().items()])
+metrics.register_gauge('sms_outbox_oldest_due_age_seconds', 'How long the oldest due message has waited',
+                       lambda: [({}, sms_outbox.oldest_due_age())])
+
+sms_cli = outbox_cli(sms_outbox)
@@ -1,33 +1,55 @@
+import json
+import os
+import time as clock
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-from datetime import datetime
+from datetime import datetime, date, time, timedelta
 from config import Config
-from functools import lru_cache
-import re
-from threading import Thread
-import time
+from app.utils.phone import normalize_phone, is_canonical_phone, format_phone_for_display
+from app.utils.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# وضعیت‌های کاوه‌نگار که یعنی پیام پذیرفته شده است (در صف، زمان‌بندی، ارسال به مخابرات، رسیده)
+KAVENEGAR_ACCEPTED_STATUSES = {1, 2, 4, 5, 10}
+
+SMS_PROVIDER_LATENCY = metrics.histogram('sms_provider_latency_seconds', 'Provider API round trip',
+                                         ('provider', 'endpoint'))
+
+class SMSProviderError(Exception):
+    """The provider answered with an error for the whole request"""
+
+class SMSRateLimited(Exception):
+    """The provider refused the request because we are sending too fast"""
+
+    def __init__(self, retry_after=60):
+        super().__init__(f"SMS provider rate limit, retry after {retry_after}s")
+        self.retry_after = retry_after
+
 class SMSService:
     def __init__(self):
         self.api_key = Config.SMS_API_KEY
         self.active = Config.SMS_ACTIVE
         self.provider = Config.SMS_PROVIDER.lower()
         self.sender = Config.SMS_SENDER or '10008663'
+        self.base_url = Config.SMS_API_BASE_URL.rstrip('/')
+        self.batch_size = Config.SMS_BATCH_SIZE
+        self.timeout = Config.SMS_HTTP_TIMEOUT
+        self._http = None
+        self._http_pid = None
         
         # Message templates
         self.message_templates = {
             'absent': 'دانش‌آموز {student_name} در تاریخ {date} غایب بوده است.',
             'late': 'دانش‌آموز {student_name} در تاریخ {date} با تأخیر حضور پیدا کرده است.',
             'welcome': 'سلام {name}، به سیستم مدیریت مدرسه {school_name} خوش‌آمدید. نام کاربری: {username}',
-            'password_reset': 'کد بازیابی رمز عبور شما: {code}'
+            'password_reset': 'کد بازیابی رمز عبور شما: {code}',
+            'announcement': 'اطلاعیه {school_name}:\n{text}',
+            'digest': 'گزارش حضور و غیاب {date}:\n{lines}',
+            'digest_line': '{student_name}: {status_text}'
         }
         
-        # Rate limiting
-        self.last_request_time = 0
-        self.min_interval = 1.0
-        
         if not self.active:
             logger.info("SMS service is disabled (mock mode)")
         elif not self.api_key:
@@ -39,62 +61,78 @@ class SMSService:
         if not phone:
             return None
         
-        # Remove non-digit characters
-        phone = re.sub(r'[^\d]', '', phone)
-        
-        # Format for Iran
-        if phone.startswith('0'):
-            phone = phone[1:]
-        if not phone.startswith('9'):
-            phone = '9' + phone
+        # شماره‌های ذخیره‌شده از قبل نرمال هستند
+        if is_canonical_phone(phone):
+            return phone
         
-        if len(phone) != 10 or not phone.startswith('9'):
+        normalized = normalize_phone(phone)
+        if not normalized:
             logger.warning(f"Invalid phone number format: {phone}")
-            return None
-        
-        return phone
+        return normalized
     
     def _get_current_date(self):
         """Get current date in Persian or Gregorian format"""
         today = datetime.now()
         return today.strftime("%Y/%m/%d")
     
-    def _apply_rate_limit(self):
-        """Apply rate limiting to prevent API blocking"""
-        current_time = time.time()
-        elapsed = current_time - self.last_request_time
+    @property
+    def rate_limit_name(self):
+        """Token bucket shared by everything sending through the active provider"""
+        return f"sms:{self.provider if self.active else 'mock'}"
+    
+    @property
+    def http(self):
+        """Keep-alive HTTP session shared by all sends of this process"""
+        if self._http is None or self._http_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=Config.SMS_HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._http, self._http_pid = session, os.getpid()
+        return self._http
+    
+    def _kavenegar_post(self, method, data):
+        """POST to a Kavenegar endpoint and return the parsed body"""
+        started = clock.monotonic()
+        try:
+            response = self.http.post(f"{self.base_url}/{self.api_key}/sms/{method}.json", data=data, timeout=self.timeout)
+        finally:
+            SMS_PROVIDER_LATENCY.observe(clock.monotonic() - started, provider='kavenegar', endpoint=method)
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After', '')
+            raise SMSRateLimited(int(retry_after) if retry_after.isdigit() else 60)
         
-        if elapsed < self.min_interval:
-            sleep_time = self.min_interval - elapsed
-            time.sleep(sleep_time)
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
         
-        self.last_request_time = time.time()
+        status = result.get('return', {}).get('status')
+        if status != 200:
+            raise SMSProviderError(result.get('return', {}).get('message') or f"HTTP {response.status_code}")
+        return result
     
-    def _send_kavenegar(self, phone, message):
+    def _send_kavenegar(self, phone, message, local_id=None):
         """Send SMS via Kavenegar API"""
         try:
-            self._apply_rate_limit()
-            
-            url = f"https://api.kavenegar.com/v1/{self.api_key}/sms/send.json"
             data = {
                 'receptor': phone,
                 'message': message[:300],
                 'sender': self.sender
             }
+            if local_id is not None:
+                # کاوه‌نگار پیام تکراری با همان localid را دوباره ارسال نمی‌کند
+                data['localid'] = local_id
             
-            response = requests.post(url, data=data, timeout=15)
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            if result.get('return', {}).get('status') == 200:
-                logger.info(f"SMS sent successfully to {phone}")
-                return True
-            else:
-                error_msg = result.get('return', {}).get('message', 'Unknown error')
-                logger.error(f"Kavenegar API error: {error_msg}")
-                return False
+            self._kavenegar_post('send', data)
+            logger.info(f"SMS sent successfully to {phone}")
+            return True
                 
+        except SMSRateLimited:
+            raise
+        except SMSProviderError as e:
+            logger.error(f"Kavenegar API error: {str(e)}")
+            return False
         except requests.exceptions.RequestException as e:
             logger.error(f"Network error in Kavenegar API: {str(e)}")
             return False
@@ -102,16 +140,50 @@ class SMSService:
             logger.error(f"Unexpected error in Kavenegar API: {str(e)}")
             return False
     
+    def _send_kavenegar_array(self, messages):
+        """Send up to batch_size (local_id, phone, message) in one sendarray call; returns {local_id: (ok, error)}"""
+        data = {
+            'receptor': json.dumps([phone for _, phone, _ in messages]),
+            'sender': json.dumps([self.sender] * len(messages)),
+            'message': json.dumps([message for _, _, message in messages], ensure_ascii=False),
+            'localmessageids': json.dumps([str(local_id) for local_id, _, _ in messages]),
+        }
+        
+        try:
+            result = self._kavenegar_post('sendarray', data)
+        except SMSRateLimited:
+            raise
+        except (SMSProviderError, requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Kavenegar batch of {len(messages)} failed: {str(e)}")
+            return {local_id: (False, str(e)[:255]) for local_id, _, _ in messages}
+        
+        # نتیجه هر گیرنده به همان ترتیب ارسال برگردانده می‌شود
+        entries = result.get('entries') or []
+        results = {}
+        for index, (local_id, phone, _) in enumerate(messages):
+            entry = entries[index] if index < len(entries) else None
+            if entry is None:
+                results[local_id] = (False, 'No result returned for recipient')
+            elif entry.get('status') in KAVENEGAR_ACCEPTED_STATUSES:
+                results[local_id] = (True, None)
+            else:
+                results[local_id] = (False, str(entry.get('statustext') or f"status {entry.get('status')}")[:255])
+        
+        accepted = sum(1 for ok, _ in results.values() if ok)
+        logger.info(f"Kavenegar batch accepted {accepted}/{len(messages)} messages")
+        return results
+    
     def _send_mock(self, phone, message):
         """Mock SMS sending for development"""
-        logger.info(f"[MOCK SMS] To: {phone} - Message: {message}")
-        print(f"📱 [MOCK SMS] To: {phone}")
-        print(f"   Message: {message}")
-        print(f"   Length: {len(message)} characters")
+        logger.info(f"[MOCK SMS] To: {phone} - Message: {message} ({len(message)} characters)")
         return True
     
-    def send(self, phone, message, template_type=None, **kwargs):
-        """Send SMS with template support"""
+    def send(self, phone, message, template_type=None, local_id=None, **kwargs):
+        """Send one SMS now, with template support.
+
+        Not rate limited by itself; application messages go through sms_outbox,
+        which draws from the provider's shared token bucket first.
+        """
         phone = self._validate_phone(phone)
         if not phone:
             logger.error("Invalid phone number - SMS not sent")
@@ -122,55 +194,125 @@ class SMSService:
             template = self.message_templates[template_type]
             message = template.format(**kwargs, date=self._get_current_date())
         
-        # Truncate long messages
-        if len(message) > 300:
-            message = message[:297] + "..."
-            logger.warning("Message truncated to 300 characters")
+        message = self._truncate(message)
         
         if not self.active:
             return self._send_mock(phone, message)
         
         if self.provider == 'kavenegar':
-            return self._send_kavenegar(phone, message)
+            return self._send_kavenegar(phone, message, local_id=local_id)
         else:
             logger.warning(f"Unsupported SMS provider: {self.provider}")
             return self._send_mock(phone, message)
     
-    def send_attendance_notification(self, parent_phone, student_name, status):
-        """Send attendance notification (only for absent/late)"""
+    def send_batch(self, messages):
+        """Send many (local_id, phone, message) tuples with as few API calls as possible.
+
+        Returns {local_id: (ok, error)}. Raises SMSRateLimited when the provider
+        throttles us, so the caller can reschedule the whole batch.
+        """
+        results = {}
+        valid = []
+        for local_id, phone, message in messages:
+            phone = self._validate_phone(phone)
+            if phone:
+                valid.append((local_id, phone, self._truncate(message)))
+            else:
+                results[local_id] = (False, 'Invalid phone number')
+        
+        if not self.active or self.provider != 'kavenegar':
+            for local_id, phone, message in valid:
+                results[local_id] = (self._send_mock(phone, message), None)
+            return results
+        
+        for start in range(0, len(valid), self.batch_size):
+            results.update(self._send_kavenegar_array(valid[start:start + self.batch_size]))
+        return results
+    
+    def _truncate(self, message):
+        """Truncate long messages"""
+        if len(message) > 300:
+            logger.warning("Message truncated to 300 characters")
+            return message[:297] + "..."
+        return message
+    
+    def send_attendance_notification(self, parent_phone, student_name, status, student_id=None, attendance_date=None):
+        """Queue an attendance notification (only for absent/late) in the current transaction.
+
+        The message is sent by the outbox senders after commit and SMS_COALESCE_SECONDS
+        later, so a newer status for the same student and day replaces it and the
+        same status is only ever queued once. Marking the student present withdraws
+        a notification that has not gone out yet. With SMS_DIGEST_MODE the parent's
+        notifications are held until SMS_DIGEST_HOUR and sent as one message.
+        """
         if not parent_phone or not student_name:
             logger.warning("Missing required parameters for attendance notification")
             return False
         
+        phone = self._validate_phone(parent_phone)
+        if not phone:
+            logger.error("Invalid phone number - attendance SMS not queued")
+            return False
+        
+        attendance_date = attendance_date or date.today()
+        coalesce_key = f"{phone}:{student_id or student_name}:{attendance_date.isoformat()}"
+        
         if status not in ['absent', 'late']:
             logger.debug(f"No SMS needed for status: {status}")
+            from app.utils.sms_outbox import sms_outbox
+            sms_outbox.withdraw(coalesce_key)
             return False
         
-        template_type = 'absent' if status == 'absent' else 'late'
+        message = self.message_templates[status].format(
+            student_name=student_name,
+            date=attendance_date.strftime("%Y/%m/%d")
+        )
         
-        # Send asynchronously
-        Thread(target=self._async_send_attendance, args=(parent_phone, student_name, template_type)).start()
-        return True
+        return self.queue(
+            phone,
+            message,
+            idempotency_key=f"attendance:{student_id or parent_phone}:{attendance_date.isoformat()}:{status}",
+            category=f"attendance_{status}",
+            student_id=student_id,
+            coalesce_key=coalesce_key,
+            digest_key=f"{phone}:{attendance_date.isoformat()}" if Config.SMS_DIGEST_MODE else None,
+            send_after=attendance_send_after()
+        )
     
-    def _async_send_attendance(self, parent_phone, student_name, template_type):
-        """Send attendance notification asynchronously"""
-        try:
-            success = self.send(
-                phone=parent_phone,
-                template_type=template_type,
-                student_name=student_name
-            )
-            
-            if success:
-                logger.info(f"Attendance notification sent successfully for {student_name}")
-            else:
-                logger.error(f"Failed to send attendance notification for {student_name}")
-        except Exception as e:
-            logger.error(f"Error in async attendance notification: {str(e)}")
+    def build_digest_message(self, digest_date, entries):
+        """One message for all (student_name, status) notifications of a parent on digest_date"""
+        lines = '\n'.join(
+            self.message_templates['digest_line'].format(student_name=student_name, status_text=get_status_text(status))
+            for student_name, status in entries
+        )
+        return self.message_templates['digest'].format(date=digest_date.strftime("%Y/%m/%d"), lines=lines)
+    
+    def queue(self, phone, message, idempotency_key, category, student_id=None, school_id=None,
+              coalesce_key=None, digest_key=None, send_after=None):
+        """Add an SMS to the outbox in the current transaction; sent after commit"""
+        phone = self._validate_phone(phone)
+        if not phone:
+            logger.error(f"Invalid phone number - {category} SMS not queued")
+            return False
+        
+        from app.utils.sms_outbox import sms_outbox
+        return sms_outbox.enqueue(phone, message, idempotency_key=idempotency_key, category=category,
+                                  student_id=student_id, school_id=school_id,
+                                  coalesce_key=coalesce_key, digest_key=digest_key,
+                                  send_after=send_after)
 
 # Create global instance
 sms_service = SMSService()
 
+def attendance_send_after():
+    """When a new attendance notification may go out (UTC, like the outbox columns)"""
+    send_after = datetime.utcnow() + timedelta(seconds=Config.SMS_COALESCE_SECONDS)
+    if Config.SMS_DIGEST_MODE:
+        # ساعت خلاصه به وقت محلی سرور است
+        digest_at = datetime.combine(date.today(), time(Config.SMS_DIGEST_HOUR)) - (datetime.now() - datetime.utcnow())
+        send_after = max(send_after, digest_at)
+    return send_after
+
 def get_status_text(status):
     """Convert status to Persian text"""
     status_map = {
@@ -188,14 +330,3 @@ def get_status_badge(status):
         'present': 'badge bg-success'
     }
     return badge_classes.get(status, 'badge bg-secondary')
-
-@lru_cache(maxsize=100)
-def format_phone_for_display(phone):
-    """Format phone number for display"""
-    if not phone:
-        return ''
-    
-    phone = re.sub(r'[^\d]', '', phone)
-    if len(phone) == 10 and phone.startswith('9'):
-        return f"۰{phone}"
-    return phone
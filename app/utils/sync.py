@@ -0,0 +1,376 @@
+import logging
+from datetime import datetime, date, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, or_, and_, func
+from sqlalchemy.orm import Session
+
+from app.models import (db, School, Class, Student, Attendance, Grade, Discipline, SkillAssessment,
+                        SyncChange, SyncOperation, class_students)
+
+logger = logging.getLogger(__name__)
+
+ATTENDANCE_STATUSES = ('present', 'absent', 'late')
+DISCIPLINE_TYPES = ('positive', 'negative')
+LEVELS = ('excellent', 'very_good', 'good', 'needs_effort')
+
+# جداولی که برای کلاینت آفلاین همگام می‌شوند: فیلدهای قابل ارسال و فیلدهای لازم برای ایجاد
+SYNCED_ENTITIES = {
+    'attendance': {
+        'model': Attendance,
+        'fields': ('class_id', 'student_id', 'date', 'status'),
+        'required': ('class_id', 'student_id', 'date', 'status'),
+        'natural_key': ('class_id', 'student_id', 'date'),
+    },
+    'grades': {
+        'model': Grade,
+        'fields': ('class_id', 'student_id', 'subject_id', 'date', 'score', 'max_score', 'level', 'description'),
+        'required': ('class_id', 'student_id', 'subject_id', 'date'),
+        'natural_key': None,
+    },
+    'discipline': {
+        'model': Discipline,
+        'fields': ('class_id', 'student_id', 'date', 'type', 'points', 'description'),
+        'required': ('class_id', 'student_id', 'date', 'type', 'description'),
+        'natural_key': None,
+    },
+    'skill_assessments': {
+        'model': SkillAssessment,
+        'fields': ('class_id', 'student_id', 'skill_id', 'date', 'level', 'notes'),
+        'required': ('class_id', 'student_id', 'skill_id', 'date', 'level'),
+        'natural_key': None,
+    },
+}
+
+ENTITY_BY_MODEL = {config['model']: name for name, config in SYNCED_ENTITIES.items()}
+
+class SyncError(ValueError):
+    """A client operation that cannot be applied"""
+
+# === ثبت تغییرات ===
+def _record(connection, entity, rows, operation):
+    """Append change log rows for (entity_id, class_id, student_id) tuples"""
+    if not rows:
+        return
+    changed_at = datetime.utcnow()
+    connection.execute(SyncChange.__table__.insert(), [{
+        'entity': entity,
+        'entity_id': entity_id,
+        'operation': operation,
+        'class_id': class_id,
+        'student_id': student_id,
+        'changed_at': changed_at
+    } for entity_id, class_id, student_id in rows])
+
+def _after_upsert(mapper, connection, target):
+    _record(connection, ENTITY_BY_MODEL[mapper.class_], [(target.id, target.class_id, target.student_id)], 'upsert')
+
+def _after_delete(mapper, connection, target):
+    _record(connection, ENTITY_BY_MODEL[mapper.class_], [(target.id, target.class_id, target.student_id)], 'delete')
+
+def _record_bulk_changes(orm_execute_state):
+    """Query.delete()/update() skip mapper events; log the affected rows before they run"""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ not in ENTITY_BY_MODEL:
+        return
+
+    table = mapper.local_table
+    affected = select(table.c.id, table.c.class_id, table.c.student_id)
+    if orm_execute_state.statement.whereclause is not None:
+        affected = affected.where(orm_execute_state.statement.whereclause)
+
+    connection = orm_execute_state.session.connection()
+    rows = [tuple(row) for row in connection.execute(affected)]
+    _record(connection, ENTITY_BY_MODEL[mapper.class_], rows, 'delete' if orm_execute_state.is_delete else 'upsert')
+
+for synced_model in ENTITY_BY_MODEL:
+    event.listen(synced_model, 'after_insert', _after_upsert)
+    event.listen(synced_model, 'after_update', _after_upsert)
+    event.listen(synced_model, 'after_delete', _after_delete)
+
+event.listen(Session, 'do_orm_execute', _record_bulk_changes)
+
+# === خواندن تغییرات ===
+def get_teacher_class_ids(user):
+    """IDs of the classes taught by a teacher user"""
+    if user.teacher_id is None:
+        return []
+    return [class_id for (class_id,) in db.session.query(Class.id).filter(Class.teacher_id == user.teacher_id)]
+
+def _horizon():
+    return datetime.utcnow() - timedelta(seconds=current_app.config['SYNC_SETTLE_SECONDS'])
+
+def _scope(column_class_id, column_student_id, class_ids):
+    """Rows of the given classes, plus class-less rows of students on their rosters"""
+    roster = select(class_students.c.student_id).where(class_students.c.class_id.in_(class_ids))
+    return or_(
+        column_class_id.in_(class_ids),
+        and_(column_class_id.is_(None), column_student_id.in_(roster))
+    )
+
+def _serialize(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _columns(model):
+    columns = ['id'] + list(SYNCED_ENTITIES[ENTITY_BY_MODEL[model]]['fields'])
+    if 'updated_at' in model.__table__.c:
+        columns.append('updated_at')
+    return columns
+
+def _load_rows(model, criteria):
+    columns = _columns(model)
+    rows = db.session.query(*[getattr(model, column) for column in columns]).filter(*criteria).order_by(model.id)
+    return [{column: _serialize(value) for column, value in zip(columns, row)} for row in rows]
+
+def is_cursor_expired(cursor):
+    """True when changes after cursor have already been pruned from the log"""
+    oldest = db.session.query(func.min(SyncChange.id)).scalar()
+    return bool(cursor and oldest and cursor < oldest - 1)
+
+def build_snapshot(class_ids):
+    """Current rows of recent days for a fresh client, with the cursor to continue from"""
+    # cursor قبل از خواندن داده‌ها گرفته می‌شود تا تغییرات همزمان در pull بعدی تکرار شوند، نه گم
+    cursor = db.session.query(func.max(SyncChange.id)).filter(SyncChange.changed_at <= _horizon()).scalar() or 0
+    since = date.today() - timedelta(days=current_app.config['SYNC_SNAPSHOT_DAYS'])
+
+    changes = {}
+    for name, config in SYNCED_ENTITIES.items():
+        model = config['model']
+        changes[name] = _load_rows(model, [_scope(model.class_id, model.student_id, class_ids), model.date >= since]) if class_ids else []
+
+    return {
+        'cursor': cursor,
+        'has_more': False,
+        'snapshot': True,
+        'changes': changes,
+        'deleted': {name: [] for name in SYNCED_ENTITIES}
+    }
+
+def pull_changes(class_ids, cursor, limit):
+    """Rows changed after cursor in the given classes; only the latest state of each row is sent"""
+    entries = []
+    if class_ids:
+        entries = db.session.query(SyncChange.id, SyncChange.entity, SyncChange.entity_id, SyncChange.operation)\
+            .filter(SyncChange.id > cursor,
+                    SyncChange.changed_at <= _horizon(),
+                    _scope(SyncChange.class_id, SyncChange.student_id, class_ids))\
+            .order_by(SyncChange.id)\
+            .limit(limit + 1)\
+            .all()
+
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    latest = {}
+    for _, entity, entity_id, operation in entries:
+        latest[(entity, entity_id)] = operation
+
+    upserted = {name: [] for name in SYNCED_ENTITIES}
+    deleted = {name: [] for name in SYNCED_ENTITIES}
+    for (entity, entity_id), operation in latest.items():
+        if entity in SYNCED_ENTITIES:
+            (upserted if operation == 'upsert' else deleted)[entity].append(entity_id)
+
+    changes = {}
+    for name, ids in upserted.items():
+        model = SYNCED_ENTITIES[name]['model']
+        changes[name] = _load_rows(model, [model.id.in_(ids)]) if ids else []
+        # ردیفی که بعد از ثبت تغییر حذف شده، به عنوان حذف‌شده ارسال می‌شود
+        found = {row['id'] for row in changes[name]}
+        deleted[name].extend(entity_id for entity_id in ids if entity_id not in found)
+
+    return {
+        'cursor': entries[-1].id if entries else cursor,
+        'has_more': has_more,
+        'snapshot': False,
+        'changes': changes,
+        'deleted': deleted
+    }
+
+# === اعمال تغییرات آفلاین ===
+def _coerce(field, value):
+    if value is None:
+        return None
+    if field == 'date':
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    if field in ('class_id', 'student_id', 'subject_id', 'skill_id', 'points'):
+        return int(value)
+    if field in ('score', 'max_score'):
+        return float(value)
+    if field == 'status' and value not in ATTENDANCE_STATUSES:
+        raise SyncError(f'Invalid attendance status: {value}')
+    if field == 'type' and value not in DISCIPLINE_TYPES:
+        raise SyncError(f'Invalid discipline type: {value}')
+    if field == 'level' and value not in LEVELS:
+        raise SyncError(f'Invalid level: {value}')
+    return str(value)
+
+class _PushContext:
+    """Teacher scope loaded once per pushed batch"""
+
+    def __init__(self, user):
+        self.user = user
+        self.teacher_id = user.teacher_id
+        rows = db.session.query(Class.id, School.type)\
+            .join(School, Class.school_id == School.id)\
+            .filter(Class.teacher_id == self.teacher_id)\
+            .all()
+        self.school_types = dict(rows)
+        self.roster = set(db.session.query(class_students.c.class_id, class_students.c.student_id)
+                          .filter(class_students.c.class_id.in_(list(self.school_types))).all())
+        self.notifications = []
+
+    def check(self, class_id, student_id):
+        if class_id not in self.school_types:
+            raise SyncError(f'Class {class_id} is not taught by this teacher')
+        if (class_id, student_id) not in self.roster:
+            raise SyncError(f'Student {student_id} is not in class {class_id}')
+
+def _find_existing(config, data):
+    model = config['model']
+    if data.get('id'):
+        return db.session.get(model, int(data['id']))
+    if config['natural_key'] and all(data.get(field) for field in config['natural_key']):
+        key = {field: _coerce(field, data[field]) for field in config['natural_key']}
+        return model.query.filter_by(**key).first()
+    return None
+
+def _apply_operation(context, operation):
+    entity = operation.get('entity')
+    config = SYNCED_ENTITIES.get(entity)
+    if config is None:
+        raise SyncError(f'Unknown entity: {entity}')
+
+    action = operation.get('action', 'upsert')
+    data = operation.get('data') or {}
+    existing = _find_existing(config, data)
+
+    if existing is not None:
+        context.check(existing.class_id, existing.student_id)
+
+    if action == 'delete':
+        if existing is None:
+            # قبلاً حذف شده است؛ تکرار حذف خطا نیست
+            return data.get('id')
+        db.session.delete(existing)
+        return existing.id
+
+    if action != 'upsert':
+        raise SyncError(f'Unknown action: {action}')
+
+    values = {field: _coerce(field, data[field]) for field in config['fields'] if field in data}
+
+    if existing is None:
+        missing = [field for field in config['required'] if values.get(field) is None]
+        if missing:
+            raise SyncError(f"Missing fields: {', '.join(missing)}")
+        context.check(values['class_id'], values['student_id'])
+
+        if config['model'] is Grade:
+            values['school_type'] = context.school_types[values['class_id']]
+        existing = config['model'](teacher_id=context.teacher_id, **values)
+        db.session.add(existing)
+        previous_status = None
+    else:
+        context.check(values.get('class_id', existing.class_id), values.get('student_id', existing.student_id))
+        previous_status = getattr(existing, 'status', None)
+        for field, value in values.items():
+            setattr(existing, field, value)
+
+    db.session.flush()
+
+    if entity == 'attendance' and existing.status in ('absent', 'late') and existing.status != previous_status:
+        context.notifications.append((existing.student_id, existing.status, existing.date))
+
+    return existing.id
+
+def apply_operations(user, operations):
+    """Apply a batch of offline writes; each one succeeds or fails on its own and replays are no-ops"""
+    context = _PushContext(user)
+
+    op_ids = [str(operation.get('op_id')) for operation in operations if operation.get('op_id')]
+    applied = dict(db.session.query(SyncOperation.op_id, SyncOperation.entity_id)
+                   .filter(SyncOperation.user_id == user.id, SyncOperation.op_id.in_(op_ids)).all()) if op_ids else {}
+
+    results = []
+    for operation in operations:
+        op_id = str(operation.get('op_id') or '')
+        if not op_id:
+            results.append({'op_id': None, 'status': 'error', 'error': 'op_id is required'})
+            continue
+
+        if op_id in applied:
+            results.append({'op_id': op_id, 'status': 'duplicate', 'id': applied[op_id]})
+            continue
+
+        savepoint = db.session.begin_nested()
+        try:
+            entity_id = _apply_operation(context, operation)
+            db.session.add(SyncOperation(op_id=op_id, user_id=user.id, entity=operation.get('entity'), entity_id=entity_id))
+            savepoint.commit()
+            applied[op_id] = entity_id
+            results.append({'op_id': op_id, 'status': 'applied', 'id': entity_id})
+        except (SyncError, ValueError, TypeError) as e:
+            savepoint.rollback()
+            results.append({'op_id': op_id, 'status': 'error', 'error': str(e)})
+
+    _queue_notifications(context.notifications)
+    db.session.commit()
+    return results
+
+def _queue_notifications(notifications):
+    """Queue parent SMS and emails for absences and lates pushed from offline clients"""
+    if not notifications:
+        return
+
+    from app.utils.sms_service import sms_service
+    from app.utils.email_service import email_service
+
+    students = {student.id: student for student in
+                Student.query.filter(Student.id.in_([student_id for student_id, _, _ in notifications])).all()}
+    for student_id, status, attendance_date in notifications:
+        student = students.get(student_id)
+        if student and student.parent_phone_normalized:
+            sms_service.send_attendance_notification(
+                parent_phone=student.parent_phone_normalized,
+                student_name=student.full_name,
+                status=status,
+                student_id=student.id,
+                attendance_date=attendance_date
+            )
+        if student and student.parent_email:
+            email_service.send_attendance_notification(
+                parent_email=student.parent_email,
+                student_name=student.full_name,
+                status=status,
+                student_id=student.id,
+                attendance_date=attendance_date
+            )
+
+# === نگهداری ===
+def prune_sync_log(retention_days=None):
+    """Delete change log and applied operation rows older than the retention period"""
+    retention_days = retention_days or current_app.config['SYNC_CHANGE_RETENTION_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    changes = SyncChange.query.filter(SyncChange.changed_at < cutoff).delete(synchronize_session=False)
+    operations = SyncOperation.query.filter(SyncOperation.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+    logger.info(f"Pruned {changes} sync changes and {operations} sync operations older than {cutoff:%Y-%m-%d}")
+    return changes, operations
+
+@click.command('sync-prune')
+@click.option('--days', type=int, default=None, help='Keep this many days of sync history')
+@with_appcontext
+def prune_command(days):
+    """Delete old offline sync history"""
+    changes, operations = prune_sync_log(days)
+    click.echo(f"Pruned {changes} sync changes and {operations} sync operations")
@@ -41,9 +41,9 @@ echo " Dependencies installed securely"
 
 # ایجاد دایرکتوری‌های ضروری
 echo " Creating necessary directories with secure permissions..."
-mkdir -p /opt/render/project/src/{app/static/css,app/static/js,app/static/images,sessions,logs,uploads/{avatars,documents},databases}
+mkdir -p /opt/render/project/src/{app/static/css,app/static/js,app/static/images,logs,uploads/{avatars,documents},databases,archives/audit_logs}
 chmod 755 /opt/render/project/src
-chmod 750 /opt/render/project/src/{sessions,logs,uploads,databases}
+chmod 750 /opt/render/project/src/{logs,uploads,databases}
 chmod 755 /opt/render/project/src/app/static
 chmod 755 /opt/render/project/src/app/static/{css,js,images}
 echo " Directories created with secure permissions"
@@ -58,6 +58,10 @@ EOF
 echo "iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAMAAAAoLQ9TAAAAFVBMVEX///8AAAD///8AAAD///8AAAD///9t52NFAAAAB3RSTlMAERAZmZn7VQO2PAAAAHhJREFUGNNjYGBgZGJmYWFhZWVj5+Dk4uHlFxQSFhYRlVJQUlZRVVPX0NTS1tHTNzA0MjYxtbK2sbWzd3B0cnZxdXP38PTy9vH18w8IDAoOCQ0Lj4iMio5hYIwBADuZJgFzJg7/AAAAAElFTkSuQmCC" | base64 -d > /opt/render/project/src/app/static/favicon.ico
 echo " Static files created"
 
+# نسخه‌های fingerprint شده و فشرده فایل‌های استاتیک
+echo " Building fingerprinted, precompressed static assets..."
+flask assets build
+
 # مهاجرت دیتابیس
 echo " Running database migrations securely..."
 flask db upgrade
@@ -23,13 +23,16 @@ class Config:
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
-    SESSION_TYPE = 'filesystem'
+    SESSION_TYPE = os.environ.get('SESSION_TYPE', 'sqlalchemy')  # sqlalchemy (server-side) or cookie
     SESSION_PERMANENT = True
-    SESSION_USE_SIGNER = True
     SESSION_COOKIE_NAME = '__session'
     
-    # Session file directory - تنظیمات ویژه برای Render.com
-    SESSION_FILE_DIR = os.environ.get('SESSION_FILE_DIR', '/opt/render/project/src/sessions')
+    # Server-side session store - بین همه workerها و instanceها مشترک است
+    SESSION_REFRESH_SECONDS = int(os.environ.get('SESSION_REFRESH_SECONDS', '3600'))  # تمدید انقضا حداکثر یک بار در این بازه
+    SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+    SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', '60'))
+    SESSION_SWEEP_EVERY = int(os.environ.get('SESSION_SWEEP_EVERY', '500'))  # پاکسازی بعد از هر N نوشتن
+    SESSION_SWEEP_BATCH_SIZE = int(os.environ.get('SESSION_SWEEP_BATCH_SIZE', '1000'))
     
     # Database configuration
     DATABASE_DIR = os.environ.get('DATABASE_DIR') or '/opt/render/project/src/databases'
@@ -65,6 +68,40 @@ class Config:
     SMS_ACTIVE = os.environ.get('SMS_ACTIVE', 'False').lower() == 'true'
     SMS_PROVIDER = os.environ.get('SMS_PROVIDER', 'kavenegar')
     SMS_SENDER = os.environ.get('SMS_SENDER', '10008663')
+    SMS_API_BASE_URL = os.environ.get('SMS_API_BASE_URL', 'https://api.kavenegar.com/v1')
+    SMS_BATCH_SIZE = int(os.environ.get('SMS_BATCH_SIZE', '100'))  # حداکثر گیرنده در هر درخواست sendarray
+    SMS_HTTP_TIMEOUT = int(os.environ.get('SMS_HTTP_TIMEOUT', '15'))
+    SMS_HTTP_POOL_SIZE = int(os.environ.get('SMS_HTTP_POOL_SIZE', '4'))
+    
+    # SMS outbox - پیام‌ها در دیتابیس ذخیره و توسط threadهای ثابت ارسال می‌شوند
+    SMS_OUTBOX_THREADS = int(os.environ.get('SMS_OUTBOX_THREADS', '2'))  # 0 = فقط با flask sms drain --forever
+    SMS_OUTBOX_BATCH_SIZE = int(os.environ.get('SMS_OUTBOX_BATCH_SIZE', '100'))
+    SMS_OUTBOX_POLL_SECONDS = int(os.environ.get('SMS_OUTBOX_POLL_SECONDS', '15'))
+    SMS_OUTBOX_LEASE_SECONDS = int(os.environ.get('SMS_OUTBOX_LEASE_SECONDS', '300'))
+    SMS_OUTBOX_RETENTION_DAYS = int(os.environ.get('SMS_OUTBOX_RETENTION_DAYS', '30'))
+    SMS_MAX_ATTEMPTS = int(os.environ.get('SMS_MAX_ATTEMPTS', '6'))
+    SMS_RETRY_BASE_SECONDS = int(os.environ.get('SMS_RETRY_BASE_SECONDS', '30'))
+    SMS_RETRY_MAX_SECONDS = int(os.environ.get('SMS_RETRY_MAX_SECONDS', '3600'))
+    
+    # SMS coalescing - پیام حضور و غیاب کمی صبر می‌کند تا تغییر وضعیت‌ها و ارسال مجدد فرم یکی شوند
+    SMS_COALESCE_SECONDS = int(os.environ.get('SMS_COALESCE_SECONDS', '120'))
+    SMS_DIGEST_MODE = os.environ.get('SMS_DIGEST_MODE', 'False').lower() == 'true'  # یک پیام خلاصه برای هر والد در روز
+    SMS_DIGEST_HOUR = int(os.environ.get('SMS_DIGEST_HOUR', '10'))  # ساعت محلی ارسال خلاصه
+    
+    # SMS rate limits - سقف ارسال هر ارائه‌دهنده بین همه workerها مشترک است (درخواست API در ثانیه و حداکثر انفجار)
+    SMS_PROVIDER_RATE_LIMITS = {
+        'kavenegar': {
+            'rate': float(os.environ.get('KAVENEGAR_RATE_PER_SECOND', '5')),
+            'burst': int(os.environ.get('KAVENEGAR_RATE_BURST', '10')),
+        },
+        'mock': {'rate': 50.0, 'burst': 50},
+    }
+    SMS_DEFAULT_RATE_LIMIT = {'rate': 5.0, 'burst': 10}
+    
+    # Metrics - هر worker افزایش‌ها را در حافظه جمع و هر چند ثانیه در جدول مشترک metric_series ثبت می‌کند
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_FLUSH_SECONDS = int(os.environ.get('METRICS_FLUSH_SECONDS', '15'))
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # خالی = فقط مدیر کل وارد شده
     
     # Email configuration
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
@@ -73,6 +110,84 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'noreply@school.com')
+    MAIL_MAX_EMAILS = int(os.environ['MAIL_MAX_EMAILS']) if os.environ.get('MAIL_MAX_EMAILS') else None  # اتصال SMTP بعد از این تعداد دوباره باز می‌شود
+    EMAIL_ACTIVE = os.environ.get('EMAIL_ACTIVE', 'False').lower() == 'true'  # False = فقط در لاگ ثبت می‌شود
+    EMAIL_ATTENDANCE_NOTIFICATIONS = os.environ.get('EMAIL_ATTENDANCE_NOTIFICATIONS', 'true').lower() == 'true'
+    PASSWORD_RESET_TOKEN_SECONDS = int(os.environ.get('PASSWORD_RESET_TOKEN_SECONDS', '3600'))
+
+    # Email outbox - مثل SMS؛ هر دسته با یک اتصال SMTP ارسال می‌شود
+    EMAIL_OUTBOX_THREADS = int(os.environ.get('EMAIL_OUTBOX_THREADS', '1'))  # 0 = فقط با flask email drain --forever
+    EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', '50'))
+    EMAIL_OUTBOX_POLL_SECONDS = int(os.environ.get('EMAIL_OUTBOX_POLL_SECONDS', '15'))
+    EMAIL_OUTBOX_LEASE_SECONDS = int(os.environ.get('EMAIL_OUTBOX_LEASE_SECONDS', '300'))
+    EMAIL_OUTBOX_RETENTION_DAYS = int(os.environ.get('EMAIL_OUTBOX_RETENTION_DAYS', '30'))
+    EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '5'))
+    EMAIL_RETRY_BASE_SECONDS = int(os.environ.get('EMAIL_RETRY_BASE_SECONDS', '60'))
+    EMAIL_RETRY_MAX_SECONDS = int(os.environ.get('EMAIL_RETRY_MAX_SECONDS', '3600'))
+
+    # Audit log writer configuration
+    AUDIT_LOG_ASYNC = os.environ.get('AUDIT_LOG_ASYNC', 'true').lower() == 'true'
+    AUDIT_LOG_BATCH_SIZE = int(os.environ.get('AUDIT_LOG_BATCH_SIZE', '100'))
+    AUDIT_LOG_FLUSH_INTERVAL_MS = int(os.environ.get('AUDIT_LOG_FLUSH_INTERVAL_MS', '500'))
+    AUDIT_LOG_QUEUE_SIZE = int(os.environ.get('AUDIT_LOG_QUEUE_SIZE', '10000'))
+    
+    # Audit log retention - ردیف‌های قدیمی‌تر به فایل‌های ماهانه فشرده منتقل می‌شوند
+    AUDIT_LOG_RETENTION_DAYS = int(os.environ.get('AUDIT_LOG_RETENTION_DAYS', '180'))
+    AUDIT_ARCHIVE_DIR = os.environ.get('AUDIT_ARCHIVE_DIR') or '/opt/render/project/src/archives/audit_logs'
+    AUDIT_ARCHIVE_CHUNK_SIZE = int(os.environ.get('AUDIT_ARCHIVE_CHUNK_SIZE', '1000'))
+    AUDIT_ARCHIVE_BLOCK_SIZE = int(os.environ.get('AUDIT_ARCHIVE_BLOCK_SIZE', '500'))  # ردیف در هر بلوک gzip؛ هر صفحه فقط بلوک‌های لازم را باز می‌کند
+    
+    # Analytics configuration - روزهای اخیر که قبل از هر محاسبه دوباره تجمیع می‌شوند
+    ANALYTICS_REFRESH_DAYS = int(os.environ.get('ANALYTICS_REFRESH_DAYS', '2'))
+    ANALYTICS_BACKFILL_DAYS = int(os.environ.get('ANALYTICS_BACKFILL_DAYS', '365'))  # تجمیع خودکار حداکثر تا این تعداد روز قبل از شروع سال تحصیلی
+    
+    # Offline sync configuration
+    SYNC_PULL_LIMIT = int(os.environ.get('SYNC_PULL_LIMIT', '500'))
+    SYNC_SNAPSHOT_DAYS = int(os.environ.get('SYNC_SNAPSHOT_DAYS', '30'))
+    SYNC_MAX_PUSH_OPERATIONS = int(os.environ.get('SYNC_MAX_PUSH_OPERATIONS', '200'))
+    SYNC_CHANGE_RETENTION_DAYS = int(os.environ.get('SYNC_CHANGE_RETENTION_DAYS', '30'))
+    # تغییرات جدیدتر از این مقدار در pull بعدی ارسال می‌شوند تا تراکنش‌های در حال commit جا نمانند
+    SYNC_SETTLE_SECONDS = int(os.environ.get('SYNC_SETTLE_SECONDS', '2'))
+    
+    # Reverse proxy - تعداد proxyهای مورد اعتماد جلوی برنامه (Render: 1)؛ 0 = بدون ProxyFix
+    # بدون آن، IP همه درخواست‌ها آدرس proxy است
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', '0'))
+    PROXY_FIX_X_PROTO = int(os.environ.get('PROXY_FIX_X_PROTO', '0'))
+    
+    # Health check configuration - readiness بالاتر از این حدود ترافیک را رد می‌کند
+    HEALTH_DB_TIMEOUT_MS = int(os.environ.get('HEALTH_DB_TIMEOUT_MS', '1000'))
+    HEALTH_POOL_BUSY_RATIO = float(os.environ.get('HEALTH_POOL_BUSY_RATIO', '0.9'))
+    HEALTH_MAX_AUDIT_QUEUE = int(os.environ.get('HEALTH_MAX_AUDIT_QUEUE', '5000'))
+    
+    # Login throttling - database بین workerها مشترک است؛ memory فقط برای یک پروسه
+    LOGIN_THROTTLE_BACKEND = os.environ.get('LOGIN_THROTTLE_BACKEND', 'database')
+    LOGIN_MAX_ATTEMPTS = int(os.environ.get('LOGIN_MAX_ATTEMPTS', '5'))
+    LOGIN_MAX_ATTEMPTS_PER_IP = int(os.environ.get('LOGIN_MAX_ATTEMPTS_PER_IP', '0'))  # 0 = خاموش؛ فقط همراه با PROXY_FIX_X_FOR روشن شود
+    LOGIN_ATTEMPT_WINDOW_SECONDS = int(os.environ.get('LOGIN_ATTEMPT_WINDOW_SECONDS', '300'))
+    LOGIN_LOCKOUT_SECONDS = int(os.environ.get('LOGIN_LOCKOUT_SECONDS', '300'))
+    LOGIN_THROTTLE_CACHE_SIZE = int(os.environ.get('LOGIN_THROTTLE_CACHE_SIZE', '10000'))
+    LOGIN_THROTTLE_CACHE_SECONDS = int(os.environ.get('LOGIN_THROTTLE_CACHE_SECONDS', '5'))
+    
+    # Password hashing - هش در thread pool جدا اجرا می‌شود تا event loop گیونت مسدود نشود
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')  # e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+    PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', '64'))
+    PASSWORD_HASH_TIMEOUT = int(os.environ.get('PASSWORD_HASH_TIMEOUT', '10'))
+    
+    # Identity cache - snapshot کاربر جاری در هر worker نگه داشته می‌شود
+    IDENTITY_CACHE_ENABLED = os.environ.get('IDENTITY_CACHE_ENABLED', 'true').lower() == 'true'
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE', '2048'))
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', '30'))  # حداکثر تأخیر دیدن تغییرات در workerهای دیگر
+    
+    # Compression configuration
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', 'true').lower() == 'true'
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '500'))
+    COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+    COMPRESS_BR_LEVEL = int(os.environ.get('COMPRESS_BR_LEVEL', '4'))
+    
+    # Excel export - عرض ستون‌ها فقط از چند ردیف اول تخمین زده می‌شود
+    EXPORT_WIDTH_SAMPLE_ROWS = int(os.environ.get('EXPORT_WIDTH_SAMPLE_ROWS', '200'))
+    EXPORT_MAX_COLUMN_WIDTH = int(os.environ.get('EXPORT_MAX_COLUMN_WIDTH', '60'))
     
     # File upload configuration
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
@@ -80,14 +195,6 @@ class Config:
     @classmethod
     def init_app(cls, app):
         """Initialize app with configuration"""
-        # ایجاد پوشه session - فقط در صورتی که قابل نوشتن باشد
-        if cls.FLASK_ENV == 'production':
-            # برای Render.com، فقط اگر دایرکتوری وجود داشته باشد یا قابل ایجاد باشد
-            if os.access(os.path.dirname(cls.SESSION_FILE_DIR), os.W_OK):
-                os.makedirs(cls.SESSION_FILE_DIR, exist_ok=True)
-        else:
-            os.makedirs(cls.SESSION_FILE_DIR, exist_ok=True)
-        
         # ایجاد دایرکتوری‌های لازم - فقط در حالت توسعه
         if cls.FLASK_ENV != 'production':
             os.makedirs(cls.DATABASE_DIR, exist_ok=True)
@@ -100,5 +207,5 @@ class Config:
             app.logger.debug(f"Database URI: {cls.SQLALCHEMY_DATABASE_URI}")
             app.logger.debug(f"SMS Active: {cls.SMS_ACTIVE}")
             app.logger.debug(f"Environment: {cls.FLASK_ENV}")
-            app.logger.debug(f"Session File Dir: {cls.SESSION_FILE_DIR}")
+            app.logger.debug(f"Session Type: {cls.SESSION_TYPE}")
             app.logger.debug(f"Upload Folder: {cls.UPLOAD_FOLDER}")
@@ -46,7 +46,6 @@ if __name__ == '__main__':
     
     # ✅ تنظیمات ویژه برای Render.com
     if os.environ.get('FLASK_ENV') == 'production':
-        app.config['SESSION_FILE_DIR'] = '/opt/render/project/src/sessions'
         app.config['STATIC_FOLDER'] = '/opt/render/project/src/app/static'
     
     # ✅ پیام راه‌اندازی
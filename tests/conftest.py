@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+from flask import g
+
+from config import Config
+from app import create_app
+from app.models import db, School, User, Teacher, Class, Student
+
+PASSWORD = 'password123'
+
+
+@pytest.fixture
+def app_config():
+    """Config overrides for the app fixture; modules override this fixture"""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    """App on a fresh SQLite file with the outbox sender threads off; yields inside an app context"""
+    overrides = {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}",
+        'WTF_CSRF_ENABLED': False,
+        'SMS_OUTBOX_THREADS': 0,
+        'EMAIL_OUTBOX_THREADS': 0,
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        **app_config
+    }
+    app = create_app(type('TestConfig', (Config,), overrides))
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def school(app):
+    """An elementary school with two teachers, each teaching a class of two students"""
+    school = School(name='دبستان نمونه', type='elementary')
+    db.session.add(school)
+    db.session.flush()
+
+    teachers, classes, students = [], [], []
+    for index in range(2):
+        user = User(username=f'teacher{index}', name=f'معلم {index}', role='teacher', school_id=school.id)
+        user.set_password(PASSWORD)
+        teacher = Teacher(user=user, school_id=school.id)
+        class_obj = Class(name=f'کلاس {index}', grade='1', school_id=school.id, teacher=teacher)
+        roster = [
+            Student(code=f's{index}{number}', first_name=f'دانش‌آموز{number}', last_name=f'کلاس{index}', grade='1',
+                    school_id=school.id, parent_phone=f'0912111{index}{number}00')
+            for number in range(2)
+        ]
+        class_obj.students.extend(roster)
+        db.session.add_all([user, teacher, class_obj, *roster])
+        teachers.append(user)
+        classes.append(class_obj)
+        students.append(roster)
+    db.session.commit()
+    return SimpleNamespace(school=school, teachers=teachers, classes=classes, students=students)
+
+
+@pytest.fixture
+def teacher_client(app, school):
+    """Test client logged in as the first teacher"""
+    client = app.test_client()
+    response = client.post('/login', data={'username': school.teachers[0].username, 'password': PASSWORD})
+    assert response.status_code == 302
+    # درخواست‌های آزمون context برنامه را به اشتراک می‌گذارند؛ کاربر بعدی از user_loader خوانده شود
+    g.pop('_login_user', None)
+    return client
@@ -0,0 +1,153 @@
+import logging
+import socketserver
+import threading
+
+import pytest
+
+from app.models import db, EmailOutbox
+from app.utils.email_outbox import email_outbox
+
+
+class SMTPStub(socketserver.StreamRequestHandler):
+    """Minimal SMTP server: refuses recipients at refused.example.com and records delivered messages"""
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode('ascii'))
+
+    def handle(self):
+        self.server.connections += 1
+        recipients = []
+        self.reply('220 stub ESMTP')
+        for raw in self.rfile:
+            command = raw.decode('utf-8').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 stub')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                if 'refused.example.com' in command:
+                    self.reply('550 mailbox unavailable')
+                else:
+                    recipients.append(command.split(':', 1)[1].strip(' <>'))
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 end with .')
+                lines = []
+                for line in self.rfile:
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(line)
+                self.server.messages.append((recipients, b''.join(lines).decode('utf-8')))
+                self.reply('250 queued')
+            elif verb == 'RSET':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+@pytest.fixture
+def smtp():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStub)
+    server.daemon_threads = True
+    server.connections, server.messages = 0, []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app_config(smtp):
+    return {
+        'EMAIL_ACTIVE': True,
+        # Flask-Mail در حالت TESTING به‌صورت پیش‌فرض چیزی ارسال نمی‌کند
+        'MAIL_SUPPRESS_SEND': False,
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': smtp.server_address[1],
+        'MAIL_USE_TLS': False,
+        'MAIL_USERNAME': None,
+        'MAIL_PASSWORD': None,
+        'MAIL_MAX_EMAILS': None,
+        'EMAIL_OUTBOX_BATCH_SIZE': 50
+    }
+
+
+def queue(recipient, key, category='test', body='متن'):
+    email_outbox.enqueue(recipient, f'موضوع {key}', body, idempotency_key=key, category=category)
+    db.session.commit()
+
+
+def statuses():
+    return {row.idempotency_key: (row.status, row.attempts) for row in EmailOutbox.query.order_by(EmailOutbox.id)}
+
+
+def test_batch_goes_out_over_one_connection(app, smtp):
+    for index in range(3):
+        queue(f'parent{index}@example.com', f'k{index}')
+
+    assert email_outbox.process_due() == 3
+
+    assert smtp.connections == 1
+    assert [recipients for recipients, _ in smtp.messages] == [
+        ['parent0@example.com'], ['parent1@example.com'], ['parent2@example.com']
+    ]
+    assert statuses() == {'k0': ('sent', 1), 'k1': ('sent', 1), 'k2': ('sent', 1)}
+
+
+def test_refused_recipient_fails_on_its_own(app, smtp):
+    queue('a@example.com', 'ok1')
+    queue('b@refused.example.com', 'refused')
+    queue('c@example.com', 'ok2')
+
+    email_outbox.process_due()
+
+    assert smtp.connections == 1
+    assert [recipients for recipients, _ in smtp.messages] == [['a@example.com'], ['c@example.com']]
+    rows = {row.idempotency_key: row for row in EmailOutbox.query}
+    assert rows['ok1'].status == rows['ok2'].status == 'sent'
+    # تلاش بعدی با backoff زمان‌بندی می‌شود
+    assert rows['refused'].status == 'pending' and rows['refused'].attempts == 1
+    assert rows['refused'].last_error and rows['refused'].next_attempt_at > rows['refused'].created_at
+
+
+def test_refused_recipient_fails_permanently_after_max_attempts(app, smtp):
+    email_outbox.max_attempts = 1
+    queue('b@refused.example.com', 'refused')
+
+    email_outbox.process_due()
+
+    assert statuses() == {'refused': ('failed', 1)}
+
+
+def test_unreachable_server_retries_the_whole_batch(app, smtp):
+    app.extensions['mail'].port = 1
+    queue('a@example.com', 'k1')
+    queue('b@example.com', 'k2')
+
+    email_outbox.process_due()
+
+    assert smtp.connections == 0
+    assert statuses() == {'k1': ('pending', 1), 'k2': ('pending', 1)}
+    assert all(row.last_error.startswith('SMTP connection failed') for row in EmailOutbox.query)
+
+
+def test_mock_log_never_contains_password_reset_bodies(app, smtp, caplog):
+    email_outbox.active = False
+    queue('admin@example.com', 'reset', category='password_reset', body='https://example.com/reset-password/SECRET')
+    queue('parent@example.com', 'notice', body='غیبت امروز')
+
+    with caplog.at_level(logging.INFO, logger='app.utils.email_outbox'):
+        email_outbox.process_due()
+
+    assert smtp.connections == 0
+    assert 'SECRET' not in caplog.text
+    assert '[body not logged]' in caplog.text
+    assert 'غیبت امروز' in caplog.text
+    assert statuses() == {'reset': ('sent', 1), 'notice': ('sent', 1)}
@@ -0,0 +1,123 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+from config import Config
+from app.models import db, SmsOutbox, Attendance
+from app.utils.sms_outbox import sms_outbox
+from app.utils.sms_service import sms_service
+
+
+@pytest.fixture(autouse=True)
+def no_coalesce_delay(monkeypatch):
+    monkeypatch.setattr(Config, 'SMS_COALESCE_SECONDS', 0)
+    monkeypatch.setattr(Config, 'SMS_DIGEST_MODE', False)
+
+
+def notify(student, status, day=None):
+    queued = sms_service.send_attendance_notification(student.parent_phone_normalized, student.full_name, status,
+                                                      student_id=student.id, attendance_date=day or date.today())
+    db.session.commit()
+    return queued
+
+
+def current():
+    # ردیف‌ها روی اتصال جداگانه فرستنده تغییر می‌کنند
+    db.session.expire_all()
+    return SmsOutbox.query.one()
+
+
+def rows():
+    db.session.expire_all()
+    return [(row.category, row.status) for row in SmsOutbox.query.order_by(SmsOutbox.id)]
+
+
+def make_due():
+    table = SmsOutbox.__table__
+    with db.engine.begin() as connection:
+        connection.execute(update(table).where(table.c.status == 'pending').values(next_attempt_at=datetime.utcnow()))
+
+
+def test_present_withdraws_pending_message(school):
+    student = school.students[0][0]
+
+    assert notify(student, 'absent')
+    assert not notify(student, 'present')
+
+    assert rows() == [('attendance_absent', 'coalesced')]
+    assert sms_outbox.process_due() == 0
+
+
+def test_absent_late_absent_revives_first_message(school):
+    student = school.students[0][0]
+
+    assert notify(student, 'absent')
+    assert notify(student, 'late')
+    assert rows() == [('attendance_absent', 'coalesced'), ('attendance_late', 'pending')]
+
+    assert notify(student, 'absent')
+    assert rows() == [('attendance_absent', 'pending'), ('attendance_late', 'coalesced')]
+
+    assert sms_outbox.process_due() == 1
+    assert rows() == [('attendance_absent', 'sent'), ('attendance_late', 'coalesced')]
+
+
+def test_resubmitting_identical_form_queues_nothing(school, teacher_client):
+    class_obj = school.classes[0]
+    first, second = school.students[0]
+    today = date.today().isoformat()
+    form = {'date': today, f'status_{first.id}': 'absent', f'status_{second.id}': 'late'}
+
+    for _ in range(2):
+        response = teacher_client.post(f'/teacher/class/{class_obj.id}/attendance?date={today}', data=form)
+        assert response.status_code == 302
+
+    assert Attendance.query.filter_by(class_id=class_obj.id).count() == 2
+    assert sorted(rows()) == [('attendance_absent', 'pending'), ('attendance_late', 'pending')]
+
+
+def test_expired_lease_is_reclaimed(school):
+    notify(school.students[0][0], 'absent')
+
+    # فرستنده‌ای که ردیف را برداشت و پیش از ثبت نتیجه از بین رفت
+    assert len(sms_outbox.claim(10)) == 1
+    assert sms_outbox.claim(10) == []
+    assert sms_outbox.process_due() == 0
+
+    table = SmsOutbox.__table__
+    expired = datetime.utcnow() - timedelta(seconds=sms_outbox.lease_seconds + 1)
+    with db.engine.begin() as connection:
+        connection.execute(update(table).values(claimed_at=expired))
+
+    assert sms_outbox.process_due() == 1
+    row = current()
+    assert (row.status, row.attempts) == ('sent', 2)
+
+
+def test_failures_back_off_until_max_attempts(school, monkeypatch):
+    monkeypatch.setattr(sms_service, 'send_batch',
+                        lambda messages: {local_id: (False, 'provider down') for local_id, _, _ in messages})
+    sms_outbox.max_attempts = 3
+    notify(school.students[0][0], 'absent')
+
+    delays = []
+    for attempt in range(1, 3):
+        before = datetime.utcnow()
+        assert sms_outbox.process_due() == 1
+        row = current()
+        assert (row.status, row.attempts, row.last_error) == ('pending', attempt, 'provider down')
+        delays.append((row.next_attempt_at - before).total_seconds())
+        # تا پایان backoff دوباره برداشته نمی‌شود
+        assert sms_outbox.process_due() == 0
+        make_due()
+
+    base = sms_outbox.retry_base_seconds
+    assert base * 0.8 <= delays[0] <= base * 1.2 + 1
+    assert base * 2 * 0.8 <= delays[1] <= base * 2 * 1.2 + 1
+
+    assert sms_outbox.process_due() == 1
+    row = current()
+    assert (row.status, row.attempts) == ('failed', 3)
+    make_due()
+    assert sms_outbox.process_due() == 0
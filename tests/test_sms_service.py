@@ -0,0 +1,129 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from config import Config
+from app.utils.sms_service import SMSService, SMSRateLimited
+
+
+class KavenegarStub(BaseHTTPRequestHandler):
+    """Answers every POST with the server's next (status, headers, body) and records the form"""
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        self.server.requests.append((self.path, form))
+
+        status, headers, body = self.server.responses.pop(0)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def kavenegar():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KavenegarStub)
+    server.requests, server.responses = [], []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sms(kavenegar, monkeypatch):
+    monkeypatch.setattr(Config, 'SMS_API_BASE_URL', f'http://127.0.0.1:{kavenegar.server_port}/v1')
+    monkeypatch.setattr(Config, 'SMS_API_KEY', 'TESTKEY')
+    monkeypatch.setattr(Config, 'SMS_ACTIVE', True)
+    monkeypatch.setattr(Config, 'SMS_PROVIDER', 'kavenegar')
+    monkeypatch.setattr(Config, 'SMS_BATCH_SIZE', 100)
+    return SMSService()
+
+
+def ok(entries):
+    return 200, {}, {'return': {'status': 200, 'message': 'تایید شد'}, 'entries': entries}
+
+
+def test_send_batch_reads_one_entry_per_recipient(sms, kavenegar):
+    kavenegar.responses.append(ok([
+        {'messageid': 1, 'status': 1, 'statustext': 'در صف ارسال'},
+        {'messageid': 2, 'status': 14, 'statustext': 'مسدود'},
+        {'messageid': 3, 'status': 10, 'statustext': 'رسیده به گیرنده'},
+    ]))
+
+    results = sms.send_batch([(11, '9121112233', 'a'), (12, '9121112234', 'b'), (13, '9121112235', 'c')])
+
+    assert results == {11: (True, None), 12: (False, 'مسدود'), 13: (True, None)}
+    path, form = kavenegar.requests[0]
+    assert path == '/v1/TESTKEY/sms/sendarray.json'
+    assert json.loads(form['receptor']) == ['9121112233', '9121112234', '9121112235']
+    assert json.loads(form['localmessageids']) == ['11', '12', '13']
+
+
+def test_send_batch_fails_recipients_without_an_entry(sms, kavenegar):
+    kavenegar.responses.append(ok([{'messageid': 1, 'status': 1}]))
+    kavenegar.responses.append(ok(None))
+
+    short = sms.send_batch([(1, '9121112233', 'a'), (2, '9121112234', 'b')])
+    missing = sms.send_batch([(3, '9121112233', 'a')])
+
+    assert short == {1: (True, None), 2: (False, 'No result returned for recipient')}
+    assert missing == {3: (False, 'No result returned for recipient')}
+
+
+def test_send_batch_invalid_phone_is_not_sent(sms, kavenegar):
+    kavenegar.responses.append(ok([{'messageid': 1, 'status': 1}]))
+
+    results = sms.send_batch([(1, 'bad', 'a'), (2, '9121112233', 'b')])
+
+    assert results == {1: (False, 'Invalid phone number'), 2: (True, None)}
+    assert json.loads(kavenegar.requests[0][1]['receptor']) == ['9121112233']
+
+
+def test_send_batch_splits_by_batch_size(sms, kavenegar):
+    sms.batch_size = 2
+    kavenegar.responses.append(ok([{'status': 1}, {'status': 1}]))
+    kavenegar.responses.append(ok([{'status': 1}]))
+
+    results = sms.send_batch([(i, f'912111223{i}', 'x') for i in range(3)])
+
+    assert all(sent for sent, _ in results.values()) and len(results) == 3
+    assert [len(json.loads(form['receptor'])) for _, form in kavenegar.requests] == [2, 1]
+
+
+def test_rate_limit_raises_with_retry_after(sms, kavenegar):
+    kavenegar.responses.append((429, {'Retry-After': '7'}, {}))
+
+    with pytest.raises(SMSRateLimited) as raised:
+        sms.send_batch([(1, '9121112233', 'a')])
+
+    assert raised.value.retry_after == 7
+
+
+def test_rate_limit_without_retry_after_waits_a_minute(sms, kavenegar):
+    kavenegar.responses.append((429, {}, {}))
+
+    with pytest.raises(SMSRateLimited) as raised:
+        sms._send_kavenegar_array([(1, '9121112233', 'a')])
+
+    assert raised.value.retry_after == 60
+
+
+def test_provider_error_fails_the_whole_batch(sms, kavenegar):
+    kavenegar.responses.append((200, {}, {'return': {'status': 418, 'message': 'اعتبار کافی نیست'}}))
+
+    results = sms.send_batch([(1, '9121112233', 'a'), (2, '9121112234', 'b')])
+
+    assert results == {1: (False, 'اعتبار کافی نیست'), 2: (False, 'اعتبار کافی نیست')}
@@ -0,0 +1,103 @@
+from datetime import date
+
+import pytest
+
+from app.models import db, Attendance
+
+
+@pytest.fixture
+def app_config():
+    # تغییرات بلافاصله در pull دیده می‌شوند
+    return {'SYNC_SETTLE_SECONDS': 0}
+
+
+def push(client, *operations):
+    response = client.post('/api/sync', json={'operations': list(operations)})
+    assert response.status_code == 200
+    return response.get_json()['results']
+
+
+def pull(client, cursor=None):
+    response = client.get('/api/sync', query_string={'cursor': cursor} if cursor else None)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def attendance(op_id, class_obj, student, status, action='upsert', **data):
+    return {
+        'op_id': op_id,
+        'entity': 'attendance',
+        'action': action,
+        'data': {'class_id': class_obj.id, 'student_id': student.id, 'date': date.today().isoformat(),
+                 'status': status, **data}
+    }
+
+
+def test_cursor_returns_only_rows_changed_since(school, teacher_client):
+    class_obj = school.classes[0]
+    first, second = school.students[0]
+    [before] = push(teacher_client, attendance('op-1', class_obj, first, 'present'))
+
+    snapshot = pull(teacher_client)
+    assert snapshot['snapshot'] is True
+    assert [row['id'] for row in snapshot['changes']['attendance']] == [before['id']]
+
+    [after] = push(teacher_client, attendance('op-2', class_obj, second, 'absent'))
+    changes = pull(teacher_client, snapshot['cursor'])
+
+    assert changes['snapshot'] is False and changes['has_more'] is False
+    assert [(row['id'], row['status']) for row in changes['changes']['attendance']] == [(after['id'], 'absent')]
+    assert changes['cursor'] > snapshot['cursor']
+
+    caught_up = pull(teacher_client, changes['cursor'])
+    assert caught_up['changes']['attendance'] == [] and caught_up['cursor'] == changes['cursor']
+
+
+def test_replayed_op_id_is_a_duplicate(school, teacher_client):
+    operation = attendance('op-1', school.classes[0], school.students[0][0], 'late')
+
+    [applied] = push(teacher_client, operation)
+    [replayed] = push(teacher_client, dict(operation, data=dict(operation['data'], status='absent')))
+
+    assert applied['status'] == 'applied'
+    assert replayed == {'op_id': 'op-1', 'status': 'duplicate', 'id': applied['id']}
+    assert db.session.get(Attendance, applied['id']).status == 'late'
+
+
+def test_push_into_another_teachers_class_is_rejected(school, teacher_client):
+    other_class = school.classes[1]
+    other_student = school.students[1][0]
+
+    [created] = push(teacher_client, attendance('op-1', other_class, other_student, 'absent'))
+
+    assert created['status'] == 'error'
+    assert created['error'] == f'Class {other_class.id} is not taught by this teacher'
+    assert Attendance.query.count() == 0
+
+    # ردیف موجود کلاس دیگر هم با شناسه‌اش قابل تغییر نیست
+    record = Attendance(class_id=other_class.id, student_id=other_student.id, date=date.today(), status='present',
+                        teacher_id=school.teachers[1].id)
+    db.session.add(record)
+    db.session.commit()
+    [updated] = push(teacher_client, attendance('op-2', school.classes[0], school.students[0][0], 'absent',
+                                                id=record.id))
+
+    assert updated['status'] == 'error'
+    db.session.expire_all()
+    assert db.session.get(Attendance, record.id).status == 'present'
+
+
+def test_delete_produces_a_tombstone(school, teacher_client):
+    class_obj = school.classes[0]
+    student = school.students[0][0]
+    [created] = push(teacher_client, attendance('op-1', class_obj, student, 'absent'))
+    cursor = pull(teacher_client)['cursor']
+
+    [deleted] = push(teacher_client, attendance('op-2', class_obj, student, 'absent', action='delete',
+                                                id=created['id']))
+    changes = pull(teacher_client, cursor)
+
+    assert deleted == {'op_id': 'op-2', 'status': 'applied', 'id': created['id']}
+    assert db.session.get(Attendance, created['id']) is None
+    assert changes['changes']['attendance'] == []
+    assert changes['deleted']['attendance'] == [created['id']]